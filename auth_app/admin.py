@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import UserProfile, TravelInterest, PreferredDestination, DestinationTravelInterest, Trip, TravelBuddyRequest, UserPreferences, ChatMessage, TripReview, Subscription, TripNotification, ChatNotification
+from .models import UserProfile, TravelInterest, PreferredDestination, DestinationTravelInterest, Trip, TravelBuddyRequest, UserPreferences, ChatMessage, TripReview, Subscription, TripNotification, ChatNotification, ChatReadCursor, ChatArchiveSegment
 from django.utils import timezone
 
 class UserProfileAdmin(admin.ModelAdmin):
@@ -264,3 +264,19 @@ class ChatNotificationAdmin(admin.ModelAdmin):
     )
 
 admin.site.register(ChatNotification, ChatNotificationAdmin)
+
+class ChatReadCursorAdmin(admin.ModelAdmin):
+    list_display = ('user', 'trip', 'last_read_message_id', 'cleared_message_id', 'updated_at')
+    search_fields = ('user__username', 'trip__destination__name')
+    readonly_fields = ('updated_at',)
+    raw_id_fields = ('user', 'trip')
+
+admin.site.register(ChatReadCursor, ChatReadCursorAdmin)
+
+
+class ChatArchiveSegmentAdmin(admin.ModelAdmin):
+    list_display = ('trip', 'message_count', 'compressed_bytes', 'path', 'created_at')
+    readonly_fields = ('created_at',)
+    raw_id_fields = ('trip',)
+
+admin.site.register(ChatArchiveSegment, ChatArchiveSegmentAdmin)
@@ -0,0 +1,271 @@
+"""
+SQLite-backed channel layer shared by every ASGI worker process on one host.
+
+The in-memory channel layer only delivers group messages to sockets that are
+connected to the same process, so chat rooms break as soon as more than one
+worker runs. In production a Redis channel layer is used instead (see
+CHANNEL_LAYERS in settings.py); this layer is the local stand-in for it: it
+needs no external service, only a SQLite file that all workers can open, so
+several daphne/uvicorn workers on a development machine or a single host can
+share chat_{trip_id} groups.
+
+Design, following channels_redis:
+- Messages are rows in a ``messages`` table keyed by channel name and group
+  memberships are rows in ``group_members``; both expire.
+- Every layer instance (one per worker process) owns a random client prefix.
+  Channels created with new_channel() are "specific.<prefix>!<suffix>" names,
+  and a single background task per process polls for all of them and hands
+  the messages to per-channel asyncio queues, so a process with thousands of
+  sockets still polls the database once per interval.
+- All SQLite access runs on a dedicated thread so the event loop never blocks.
+"""
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import string
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_channel_id ON messages (channel, id);
+CREATE TABLE IF NOT EXISTS group_members (
+    group_name TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (group_name, channel)
+);
+"""
+
+
+def _random_string(length=12):
+    return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(length))
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    """
+    Channel layer storing messages and groups in a shared SQLite database.
+
+    Config options (CHANNEL_LAYERS['default']['CONFIG']):
+        path: SQLite file shared by the worker processes
+        expiry: Seconds before an undelivered message is dropped
+        group_expiry: Seconds before a group membership is dropped
+        capacity: Maximum queued messages per channel
+        poll_interval: Seconds between polls when no messages are waiting
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None,
+                 poll_interval=0.05):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.path = os.fspath(path)
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.client_prefix = f'specific.{_random_string()}!'
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-channel-layer')
+        self._connection = None
+        self._queues = {}
+        self._poller = None
+        self._last_cleanup = 0.0
+
+    # Database access, always on the layer's own thread
+
+    def _db(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _insert_messages(self, rows):
+        """Insert (channel, payload) rows, skipping channels that are at capacity."""
+        db = self._db()
+        now = time.time()
+        full = []
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for channel, payload in rows:
+                queued = db.execute(
+                    'SELECT COUNT(*) FROM messages WHERE channel = ? AND expires > ?', (channel, now)
+                ).fetchone()[0]
+                if queued >= self.get_capacity(channel):
+                    full.append(channel)
+                    continue
+                db.execute(
+                    'INSERT INTO messages (channel, payload, expires) VALUES (?, ?, ?)',
+                    (channel, payload, now + self.expiry)
+                )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return full
+
+    def _pop_messages(self, channel=None, prefix=None, limit=100):
+        """Atomically take the oldest unexpired messages of a channel or of a channel prefix."""
+        db = self._db()
+        now = time.time()
+        cleanup_due = now - self._last_cleanup > 1
+
+        # Idle polls only read, so they never take the write lock
+        if prefix is not None:
+            waiting = db.execute(
+                'SELECT 1 FROM messages WHERE channel >= ? AND channel < ? LIMIT 1', (prefix, prefix + '\uffff')
+            ).fetchone()
+        else:
+            waiting = db.execute('SELECT 1 FROM messages WHERE channel = ? LIMIT 1', (channel,)).fetchone()
+        if not waiting and not cleanup_due:
+            return []
+
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if prefix is not None:
+                # Every name starting with the prefix sorts between prefix and prefix + U+FFFF
+                rows = db.execute(
+                    'SELECT id, channel, payload, expires FROM messages WHERE channel >= ? AND channel < ? '
+                    'ORDER BY id LIMIT ?',
+                    (prefix, prefix + '\uffff', limit)
+                ).fetchall()
+            else:
+                rows = db.execute(
+                    'SELECT id, channel, payload, expires FROM messages WHERE channel = ? ORDER BY id LIMIT ?',
+                    (channel, limit)
+                ).fetchall()
+            if rows:
+                db.executemany('DELETE FROM messages WHERE id = ?', [(row[0],) for row in rows])
+
+            # Drop expired messages and memberships now and then
+            if cleanup_due:
+                db.execute('DELETE FROM messages WHERE expires <= ?', (now,))
+                db.execute('DELETE FROM group_members WHERE expires <= ?', (now,))
+                self._last_cleanup = now
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return [(channel_name, payload) for _, channel_name, payload, expires in rows if expires > now]
+
+    def _group_channels(self, group):
+        return [row[0] for row in self._db().execute(
+            'SELECT channel FROM group_members WHERE group_name = ? AND expires > ?', (group, time.time())
+        )]
+
+    def _group_send(self, group, payload):
+        return self._insert_messages([(channel, payload) for channel in self._group_channels(group)])
+
+    def _group_add(self, group, channel):
+        self._db().execute(
+            'INSERT OR REPLACE INTO group_members (group_name, channel, expires) VALUES (?, ?, ?)',
+            (group, channel, time.time() + self.group_expiry)
+        )
+
+    def _group_discard(self, group, channel):
+        self._db().execute('DELETE FROM group_members WHERE group_name = ? AND channel = ?', (group, channel))
+
+    def _flush(self):
+        db = self._db()
+        db.execute('DELETE FROM messages')
+        db.execute('DELETE FROM group_members')
+
+    # Channel layer API
+
+    @staticmethod
+    def _serialize(message):
+        return json.dumps(message, separators=(',', ':'))
+
+    async def send(self, channel, message):
+        """Send a message onto a (general or specific) channel."""
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+
+        full = await self._run(self._insert_messages, [(channel, self._serialize(message))])
+        if full:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        """
+        Receive the first message that arrives on the channel.
+
+        Channels of this process are served from the shared poller; other
+        channels are polled directly.
+        """
+        assert self.valid_channel_name(channel)
+        if channel.startswith(self.client_prefix):
+            queue = self._queues.setdefault(channel, asyncio.Queue())
+            self._ensure_poller()
+            try:
+                return await queue.get()
+            except asyncio.CancelledError:
+                # The consumer went away; stop buffering messages for it
+                if queue.empty():
+                    self._queues.pop(channel, None)
+                raise
+
+        while True:
+            rows = await self._run(self._pop_messages, channel, None, 1)
+            if rows:
+                return json.loads(rows[0][1])
+            await asyncio.sleep(self.poll_interval)
+
+    def _ensure_poller(self):
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.get_running_loop().create_task(self._poll_specific_channels())
+
+    async def _poll_specific_channels(self):
+        """Fetch messages for every channel of this process and route them to their queues."""
+        while self._queues:
+            rows = await self._run(self._pop_messages, None, self.client_prefix)
+            for channel, payload in rows:
+                queue = self._queues.get(channel)
+                if queue is not None:
+                    queue.put_nowait(json.loads(payload))
+            if not rows:
+                await asyncio.sleep(self.poll_interval)
+
+    async def new_channel(self, prefix='specific'):
+        """Return a new channel name that this process can receive on."""
+        return f'{self.client_prefix}{prefix}.{_random_string()}'
+
+    async def flush(self):
+        """Drop every message and group membership."""
+        self._queues.clear()
+        await self._run(self._flush)
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        """Add the channel to a group, refreshing its expiry."""
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self._run(self._group_add, group, channel)
+
+    async def group_discard(self, group, channel):
+        """Remove the channel from a group."""
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self._run(self._group_discard, group, channel)
+
+    async def group_send(self, group, message):
+        """Send a message to every channel in a group; full channels are skipped."""
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_group_name(group), 'Group name not valid'
+        await self._run(self._group_send, group, self._serialize(message))
@@ -0,0 +1,237 @@
+"""
+Cold archive of the chat history of finished trips.
+
+The archive_chat_history command moves every message of trips that ended (or
+were cancelled) more than CHAT_ARCHIVE_AFTER_DAYS ago out of ChatMessage into
+one compressed segment file per trip and run under CHAT_ARCHIVE_DIR, and
+records it as a ChatArchiveSegment. The hot table and its indexes then only
+hold the chat of active trips.
+
+Segment files are JSON lines (``{"id", "sender", "message", "timestamp"}``)
+written as independent gzip members of CHAT_ARCHIVE_BLOCK_SIZE messages; the
+segment's block index gives each member's first id, offset and length, so a
+history page decompresses a single member. Decompressed members are kept in a
+small per-process LRU cache.
+
+A run only moves messages whose snowflake id is older than
+ARCHIVE_SAFETY_MARGIN_SECONDS, so messages that may still be waiting in a
+write-behind queue (chat_persistence.py) stay in ChatMessage, and it deletes
+exactly the rows it wrote to the segment.
+
+Reads go through archived_messages(), which TripChatMessagesView uses to fill
+history pages past the oldest message still in ChatMessage. Archived messages
+are returned as unsaved ChatMessage instances and are not covered by chat
+search (chat_search.py) or unread counts; TripChatSearchView reports
+newest_archived_id() so clients can tell that older messages were not searched.
+"""
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, Max, OuterRef, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import ChatArchiveSegment, ChatMessage, Trip, UserProfile
+from .snowflake import first_snowflake_at
+
+logger = logging.getLogger(__name__)
+
+# Messages younger than this (by id) are left for the next run: write-behind
+# flushes may still insert ids from that window, and clocks may be skewed
+ARCHIVE_SAFETY_MARGIN_SECONDS = 300
+
+# Rows deleted per DELETE ... WHERE id IN (...) statement
+DELETE_BATCH_SIZE = 500
+
+
+def archive_dir():
+    return getattr(settings, 'CHAT_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'chat_archive'))
+
+
+def archivable_trips(days):
+    """Trips with chat messages that ended or were cancelled more than ``days`` days ago."""
+    cutoff = timezone.now() - timedelta(days=days)
+    return Trip.objects.filter(
+        Q(end_date__lt=cutoff) | Q(is_cancelled=True, cancelled_at__lt=cutoff)
+    ).filter(
+        Exists(ChatMessage.objects.filter(trip_id=OuterRef('id')))
+    ).order_by('id')
+
+
+def _encode_blocks(rows, block_size):
+    # Yields (first message id, gzip member) per block of messages
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        text = ''.join(
+            json.dumps({
+                'id': message_id,
+                'sender': sender_id,
+                'message': message,
+                'timestamp': timestamp.isoformat()
+            }) + '\n'
+            for message_id, sender_id, message, timestamp in block
+        )
+        yield block[0][0], gzip.compress(text.encode('utf-8'), mtime=0)
+
+
+def archive_trip(trip_id, block_size=None):
+    """
+    Move the chat messages of a trip (all but the last
+    ARCHIVE_SAFETY_MARGIN_SECONDS) into a new segment file.
+
+    The file is fully written before the segment row is created and the
+    messages are deleted in one transaction; if that fails, the file is
+    removed again and the messages stay in ChatMessage.
+
+    Args:
+        trip_id: Trip to archive
+        block_size: Messages per gzip member (default CHAT_ARCHIVE_BLOCK_SIZE)
+
+    Returns:
+        ChatArchiveSegment: The new segment, or None if there was nothing to archive
+    """
+    block_size = block_size or getattr(settings, 'CHAT_ARCHIVE_BLOCK_SIZE', 200)
+    margin_ms = (ARCHIVE_SAFETY_MARGIN_SECONDS * 1000) + getattr(settings, 'CHAT_FLUSH_INTERVAL_MS', 200)
+    archive_below_id = first_snowflake_at(int(time.time() * 1000) - margin_ms)
+    rows = list(
+        ChatMessage.objects.filter(trip_id=trip_id, id__lt=archive_below_id).order_by('id')
+        .values_list('id', 'sender_id', 'message', 'timestamp')
+    )
+    if not rows:
+        return None
+    first_id, last_id = rows[0][0], rows[-1][0]
+
+    relative_path = os.path.join(f'trip_{trip_id}', f'{first_id}-{last_id}.jsonl.gz')
+    path = os.path.join(archive_dir(), relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    block_index = []
+    offset = 0
+    with open(path + '.tmp', 'wb') as f:
+        for block_first_id, member in _encode_blocks(rows, block_size):
+            f.write(member)
+            block_index.append([block_first_id, offset, len(member)])
+            offset += len(member)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+    try:
+        with transaction.atomic():
+            segment = ChatArchiveSegment.objects.create(
+                trip_id=trip_id,
+                path=relative_path,
+                first_message_id=first_id,
+                last_message_id=last_id,
+                message_count=len(rows),
+                compressed_bytes=offset,
+                block_index=block_index
+            )
+            # Delete exactly the archived rows; anything inserted meanwhile stays
+            archived_ids = [row[0] for row in rows]
+            for start in range(0, len(archived_ids), DELETE_BATCH_SIZE):
+                ChatMessage.objects.filter(id__in=archived_ids[start:start + DELETE_BATCH_SIZE]).delete()
+    except Exception:
+        os.remove(path)
+        raise
+
+    logger.info(f"Archived {len(rows)} chat messages of trip {trip_id} into {relative_path} ({offset} bytes)")
+    return segment
+
+
+@lru_cache(maxsize=64)
+def _read_block(path, offset, length):
+    """Decompress one gzip member of a segment file into its message rows."""
+    with open(os.path.join(archive_dir(), path), 'rb') as f:
+        f.seek(offset)
+        data = gzip.decompress(f.read(length))
+    return tuple(json.loads(line) for line in data.decode('utf-8').splitlines())
+
+
+def _block_ranges(segment):
+    # (first id, last id, offset, length) of every block of a segment
+    index = segment.block_index
+    for i, (first_id, offset, length) in enumerate(index):
+        last_id = index[i + 1][0] - 1 if i + 1 < len(index) else segment.last_message_id
+        yield first_id, last_id, offset, length
+
+
+def newest_archived_id(trip_id):
+    """
+    Id of the newest archived message of a trip.
+
+    Args:
+        trip_id: Trip to look up
+
+    Returns:
+        int: Every message with this id or lower is archived, or None if nothing is
+    """
+    return ChatArchiveSegment.objects.filter(trip_id=trip_id).aggregate(
+        newest=Max('last_message_id')
+    )['newest']
+
+
+def archived_rows(trip_id, id_gt=None, id_lt=None, count=None, descending=False):
+    """
+    Archived message rows of a trip in an open id range.
+
+    Args:
+        trip_id: Trip whose archive is read
+        id_gt: Only ids above this one
+        id_lt: Only ids below this one
+        count: Maximum number of rows (all if None)
+        descending: Newest first (with ``count``, the newest rows of the range)
+
+    Returns:
+        list: Row dicts (id, sender, message, timestamp)
+    """
+    segments = list(ChatArchiveSegment.objects.filter(trip_id=trip_id).order_by('first_message_id'))
+    blocks = [(segment.path, block) for segment in segments for block in _block_ranges(segment)]
+    if descending:
+        blocks.reverse()
+
+    rows = []
+    for path, (first_id, last_id, offset, length) in blocks:
+        if (id_gt is not None and last_id <= id_gt) or (id_lt is not None and first_id >= id_lt):
+            continue
+        block_rows = [
+            row for row in _read_block(path, offset, length)
+            if (id_gt is None or row['id'] > id_gt) and (id_lt is None or row['id'] < id_lt)
+        ]
+        rows.extend(reversed(block_rows) if descending else block_rows)
+        if count is not None and len(rows) >= count:
+            return rows[:count]
+    return rows
+
+
+def archived_messages(trip_id, id_gt=None, id_lt=None, count=None, descending=False):
+    """
+    Archived messages of a trip as unsaved ChatMessage instances with their
+    senders loaded (one query), in the order of archived_rows().
+    """
+    rows = archived_rows(trip_id, id_gt, id_lt, count, descending)
+    if not rows:
+        return []
+    senders = UserProfile.objects.in_bulk({row['sender'] for row in rows})
+
+    messages = []
+    for row in rows:
+        sender = senders.get(row['sender'])
+        if sender is None:
+            # Deleted users take their messages with them, as in ChatMessage
+            continue
+        messages.append(ChatMessage(
+            id=row['id'],
+            trip_id=trip_id,
+            sender=sender,
+            message=row['message'],
+            timestamp=parse_datetime(row['timestamp'])
+        ))
+    return messages
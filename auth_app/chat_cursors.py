@@ -0,0 +1,170 @@
+"""
+Per-member read cursors of trip chats.
+
+Chat notifications used to be one ChatNotification row per message and
+recipient, so every message cost one insert per member and unread counts
+were COUNT(*) scans over a table growing with messages x members. Now every
+member (and the trip creator) has one ChatReadCursor per trip:
+
+- a message costs a single ChatMessage insert;
+- unread messages are the ``id > last_read_message_id`` range of the trip,
+  served by the ChatMessage(trip, id) index, minus the few messages in
+  ``read_message_ids`` that were marked read while older ones were not;
+- the chat notifications of a user are the messages above their
+  ``cleared_message_id`` in every trip they follow.
+
+Cursors are created when a user creates or joins a trip and deleted when
+they leave it (see signals.py), so the cursors of a user are exactly the
+trip chats they follow. A new cursor starts at the latest message of the
+trip: members are only notified about messages sent after they joined.
+"""
+from itertools import chain
+
+from django.db import transaction
+from django.db.models import F, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import ChatMessage, ChatReadCursor, Trip
+
+
+def latest_message_ids(trip_ids):
+    """
+    Return the id of the newest message of each trip.
+
+    Returns:
+        dict: trip id -> latest message id (trips without messages are omitted)
+    """
+    return dict(
+        ChatMessage.objects.filter(trip_id__in=trip_ids)
+        .order_by()
+        .values('trip_id')
+        .annotate(latest_id=Max('id'))
+        .values_list('trip_id', 'latest_id')
+    )
+
+
+def create_read_cursors(pairs):
+    """
+    Create the cursors of (user_id, trip_id) pairs, positioned at the latest
+    message of each trip. Existing cursors are left untouched.
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return
+    latest = latest_message_ids({trip_id for _, trip_id in pairs})
+    ChatReadCursor.objects.bulk_create([
+        ChatReadCursor(
+            user_id=user_id,
+            trip_id=trip_id,
+            last_read_message_id=latest.get(trip_id, 0),
+            cleared_message_id=latest.get(trip_id, 0)
+        )
+        for user_id, trip_id in pairs
+    ], ignore_conflicts=True)
+
+
+def delete_read_cursors(trip_id, user_ids):
+    """Delete the cursors of users who left a trip; the creator keeps theirs."""
+    ChatReadCursor.objects.filter(trip_id=trip_id, user_id__in=user_ids).exclude(
+        user_id=Trip.objects.filter(id=trip_id).values('user_id')[:1]
+    ).delete()
+
+
+def unread_messages(user):
+    """Messages of the user's trip chats above their read cursor, excluding their own."""
+    return ChatMessage.objects.filter(
+        trip__chat_read_cursors__user=user,
+        id__gt=F('trip__chat_read_cursors__last_read_message_id')
+    ).exclude(sender=user)
+
+
+def unread_count(user):
+    """Number of unread chat messages over all trips the user follows."""
+    read_out_of_order = list(chain.from_iterable(
+        ChatReadCursor.objects.filter(user=user).exclude(read_message_ids=[]).values_list('read_message_ids', flat=True)
+    ))
+    messages = unread_messages(user)
+    if read_out_of_order:
+        messages = messages.exclude(id__in=read_out_of_order)
+    return messages.count()
+
+
+def notification_messages(user):
+    """
+    Messages listed as the user's chat notifications, newest first.
+
+    Every message is annotated with the user's ``last_read_message_id`` and
+    ``read_message_ids`` for its trip so that the read state can be derived
+    without extra queries.
+    """
+    return ChatMessage.objects.filter(
+        trip__chat_read_cursors__user=user,
+        id__gt=F('trip__chat_read_cursors__cleared_message_id')
+    ).exclude(sender=user).annotate(
+        last_read_message_id=F('trip__chat_read_cursors__last_read_message_id'),
+        read_message_ids=F('trip__chat_read_cursors__read_message_ids')
+    ).select_related('sender', 'trip__destination').order_by('-id')
+
+
+def is_message_read(message_id, last_read_message_id, read_message_ids):
+    return message_id <= last_read_message_id or message_id in read_message_ids
+
+
+def mark_messages_read(user, message_ids):
+    """
+    Mark the given messages read.
+
+    Marking messages read never marks other messages read: the cursor of a
+    trip only moves past messages that are all read (or the user's own),
+    and messages read ahead of an older unread one are remembered in the
+    cursor's ``read_message_ids`` until the cursor catches up with them.
+
+    Returns:
+        int: Number of the given messages that belong to the user's chats
+    """
+    ids_by_trip = {}
+    for trip_id, message_id in ChatMessage.objects.filter(
+        id__in=message_ids, trip__chat_read_cursors__user=user
+    ).exclude(sender=user).order_by().values_list('trip_id', 'id'):
+        ids_by_trip.setdefault(trip_id, set()).add(message_id)
+
+    with transaction.atomic():
+        cursors = ChatReadCursor.objects.select_for_update().filter(user=user, trip_id__in=ids_by_trip)
+        for cursor in cursors:
+            read = {
+                message_id for message_id in chain(cursor.read_message_ids, ids_by_trip[cursor.trip_id])
+                if message_id > cursor.last_read_message_id
+            }
+            # Move the cursor over the leading run of read messages; only the
+            # first len(read) + 1 unread messages can be part of that run
+            position = cursor.last_read_message_id
+            for message_id in ChatMessage.objects.filter(
+                trip_id=cursor.trip_id, id__gt=position
+            ).exclude(sender=user).order_by('id').values_list('id', flat=True)[:len(read) + 1]:
+                if message_id not in read:
+                    break
+                position = message_id
+
+            cursor.last_read_message_id = position
+            cursor.read_message_ids = sorted(message_id for message_id in read if message_id > position)
+            cursor.save(update_fields=['last_read_message_id', 'read_message_ids', 'updated_at'])
+    return sum(len(ids) for ids in ids_by_trip.values())
+
+
+def clear_notifications(user):
+    """
+    Mark every chat of the user read and clear its notifications.
+
+    Returns:
+        int: Number of notifications that were cleared
+    """
+    count = notification_messages(user).count()
+    latest = ChatMessage.objects.filter(trip_id=OuterRef('trip_id')).order_by().values('trip_id').annotate(
+        latest_id=Max('id')
+    ).values('latest_id')
+    ChatReadCursor.objects.filter(user=user).update(
+        last_read_message_id=Coalesce(Subquery(latest), F('last_read_message_id')),
+        cleared_message_id=Coalesce(Subquery(latest), F('cleared_message_id')),
+        read_message_ids=[]
+    )
+    return count
@@ -0,0 +1,103 @@
+"""
+Keyset pagination of a trip's chat history.
+
+Message ids increase over time (see snowflake.py), so pages are ``id``
+ranges over the ChatMessage(trip, id) index instead of OFFSET scans:
+
+- ``before_id``: the newest messages older than a message (scrolling back);
+- ``after_id``: the oldest messages newer than a message (scrolling forward);
+- ``since``: catch-up after a reconnect. Returns every message newer than the
+  last one the client saw; if more than a page was missed, only the newest
+  page is returned with ``gap`` set, and the client pages back from there
+  with ``before_id``.
+
+Without any of these the newest page is returned. Pages are always in
+ascending id order. Pages reaching past the oldest message in ChatMessage are
+filled from the chat archive (chat_archive.py).
+"""
+DEFAULT_HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+
+HISTORY_PARAMS = ('limit', 'before_id', 'after_id', 'since')
+
+
+def wants_history_page(query_params):
+    """Whether the request asked for a page rather than the full history."""
+    return any(name in query_params for name in HISTORY_PARAMS)
+
+
+def get_history_params(query_params):
+    """
+    Read ``limit``, ``before_id``, ``after_id`` and ``since`` from a query string.
+
+    Returns:
+        tuple: (limit, mode, message id) where mode is 'before', 'after',
+        'since' or 'latest' (message id is None for 'latest')
+
+    Raises:
+        ValueError: If a parameter is invalid or several modes are combined
+    """
+    limit = int(query_params.get('limit', DEFAULT_HISTORY_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('limit must be at least 1')
+    limit = min(limit, MAX_HISTORY_PAGE_SIZE)
+
+    modes = [(mode, query_params[name]) for mode, name in (
+        ('before', 'before_id'), ('after', 'after_id'), ('since', 'since')
+    ) if name in query_params]
+    if len(modes) > 1:
+        raise ValueError('Use only one of before_id, after_id and since')
+    if not modes:
+        return limit, 'latest', None
+
+    mode, message_id = modes[0]
+    return limit, mode, int(message_id)
+
+
+def history_page(queryset, limit, mode='latest', message_id=None, older=None):
+    """
+    Fetch one page of messages with a single LIMIT query.
+
+    Args:
+        queryset: ChatMessage queryset of one trip
+        limit: Maximum number of messages
+        mode: 'latest', 'before', 'after' or 'since' (see get_history_params)
+        message_id: Position of the page for every mode except 'latest'
+        older: Optional source of the messages older than all of the
+            queryset's (the chat archive), called as
+            ``older(id_gt=, id_lt=, count=, descending=)``; it is only asked
+            when the queryset cannot fill the page
+
+    Returns:
+        dict: messages (ascending id), has_more (older messages exist for
+        'latest'/'before', newer ones for 'after') and gap ('since' missed
+        more than one page)
+    """
+    queryset = queryset.order_by()
+    if mode == 'after':
+        rows = []
+        if older is not None:
+            rows = older(id_gt=message_id, id_lt=None, count=limit + 1, descending=False)
+        if len(rows) <= limit:
+            rows += list(queryset.filter(id__gt=message_id).order_by('id')[:limit + 1 - len(rows)])
+        return {'messages': rows[:limit], 'has_more': len(rows) > limit, 'gap': False}
+
+    if mode == 'before':
+        queryset = queryset.filter(id__lt=message_id)
+    elif mode == 'since':
+        queryset = queryset.filter(id__gt=message_id)
+
+    # Newest first so that LIMIT keeps the latest messages, then flip
+    rows = list(queryset.order_by('-id')[:limit + 1])
+    if len(rows) <= limit and older is not None:
+        rows += older(
+            id_gt=message_id if mode == 'since' else None,
+            id_lt=rows[-1].id if rows else (message_id if mode == 'before' else None),
+            count=limit + 1 - len(rows),
+            descending=True
+        )
+    more = len(rows) > limit
+    messages = rows[:limit][::-1]
+    if mode == 'since':
+        return {'messages': messages, 'has_more': False, 'gap': more}
+    return {'messages': messages, 'has_more': more, 'gap': False}
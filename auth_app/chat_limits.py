@@ -0,0 +1,94 @@
+"""
+Rate limits and backpressure of chat WebSockets.
+
+- Every connection and every user (over all their sockets in the process)
+  has a token bucket. A chat message needs a token from both; messages
+  without one are dropped and the client gets a rate_limited error frame.
+- Every connection sends through a bounded queue drained by its own writer
+  task, so a slow client never stalls the group fan-out. When its queue is
+  full the frame is dropped, and with CHAT_SLOW_CONSUMER_POLICY = 'close'
+  (the default) the socket is closed with 1013 (try again later); the
+  client reconnects and catches up from the history frame.
+
+``chat_counters`` counts received, throttled and dropped frames per process
+and is reported by the admin stats endpoint.
+"""
+import time
+import weakref
+from collections import Counter
+
+from django.conf import settings
+
+# User buckets that are full again are pruned once there are this many
+PRUNE_THRESHOLD = 10000
+
+chat_counters = Counter()
+
+
+class TokenBucket:
+    """Allows ``rate`` events per second on average and bursts of up to ``burst``."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at', '__weakref__')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return self.tokens
+
+    def is_full(self):
+        return self.refill() >= self.burst
+
+
+def take_token(*buckets):
+    """Take one token from every bucket, or from none if any of them is empty."""
+    if any(bucket.refill() < 1 for bucket in buckets):
+        return False
+    for bucket in buckets:
+        bucket.tokens -= 1
+    return True
+
+
+def connection_bucket():
+    return TokenBucket(
+        getattr(settings, 'CHAT_RATE_PER_SECOND', 5),
+        getattr(settings, 'CHAT_RATE_BURST', 10)
+    )
+
+
+_user_buckets = {}
+# Buckets still held by open sockets, which survive pruning of _user_buckets
+_live_user_buckets = weakref.WeakValueDictionary()
+
+
+def user_bucket(user_id):
+    """The bucket shared by all sockets of a user in this process."""
+    bucket = _user_buckets.get(user_id)
+    if bucket is None:
+        bucket = _live_user_buckets.get(user_id)
+    if bucket is None:
+        if len(_user_buckets) > PRUNE_THRESHOLD:
+            # Full buckets behave like new ones, so dropping them loses no state;
+            # those of connected users stay reachable through _live_user_buckets
+            for idle_user_id in [key for key, value in _user_buckets.items() if value.is_full()]:
+                del _user_buckets[idle_user_id]
+        bucket = _live_user_buckets[user_id] = TokenBucket(
+            getattr(settings, 'CHAT_USER_RATE_PER_SECOND', 10),
+            getattr(settings, 'CHAT_USER_RATE_BURST', 20)
+        )
+    _user_buckets[user_id] = bucket
+    return bucket
+
+
+def send_queue_size():
+    return getattr(settings, 'CHAT_SEND_QUEUE_SIZE', 100)
+
+
+def closes_slow_consumers():
+    return getattr(settings, 'CHAT_SLOW_CONSUMER_POLICY', 'close') == 'close'
@@ -0,0 +1,221 @@
+"""
+Write-behind persistence of chat messages sent over WebSockets.
+
+With CHAT_WRITE_BEHIND enabled, ChatConsumer no longer waits for the
+database before broadcasting: the message gets its final snowflake id and
+timestamp in memory, is broadcast at once and queued here. A single asyncio
+flusher per process then persists queued messages of all trips in
+bulk_create micro-batches every CHAT_FLUSH_INTERVAL_MS or as soon as
+CHAT_FLUSH_BATCH_SIZE messages are waiting. Recipients need no rows of
+their own: they find new messages through their read cursors (see
+chat_cursors.py).
+
+The queue lives in process memory. It is drained when the server shuts down
+(ASGI lifespan shutdown, see asgi.py, with an atexit fallback for servers
+without lifespan support), so a graceful restart loses nothing; a crash
+loses at most the messages of the last flush interval.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections
+
+from .models import ChatMessage
+from .snowflake import next_snowflake_id
+
+logger = logging.getLogger(__name__)
+
+# Delay before retrying a batch that failed for a transient reason (e.g. DB restart)
+RETRY_DELAY_SECONDS = 1.0
+
+
+def is_write_behind_enabled():
+    return getattr(settings, 'CHAT_WRITE_BEHIND', False)
+
+
+def persist_messages(messages):
+    """Insert messages; recipients find them through their read cursors."""
+    ChatMessage.objects.bulk_create(messages)
+
+
+def persist_messages_one_by_one(messages):
+    """
+    Insert messages individually so that one bad row (e.g. its trip was
+    deleted meanwhile) does not drop the rest of its batch.
+
+    A message whose id is already taken by another message (a snowflake
+    collision between processes) gets a new id and is inserted again; it is
+    only dropped if it still cannot be inserted.
+
+    Returns:
+        int: Number of messages dropped
+    """
+    dropped = 0
+    for message in messages:
+        try:
+            persist_messages([message])
+        except IntegrityError as e:
+            existing = ChatMessage.objects.filter(id=message.id).first()
+            if existing is None:
+                dropped += 1
+                logger.error(f"Dropping chat message {message.id} for trip {message.trip_id}: {str(e)}")
+                continue
+            if is_same_message(existing, message):
+                # Already persisted by an earlier attempt of this batch
+                continue
+
+            old_id = message.id
+            message.id = next_snowflake_id()
+            logger.warning(f"Chat message id {old_id} already taken; persisting message for trip {message.trip_id} as {message.id}")
+            try:
+                persist_messages([message])
+            except IntegrityError as e:
+                dropped += 1
+                logger.error(f"Dropping chat message {message.id} for trip {message.trip_id}: {str(e)}")
+    return dropped
+
+
+def is_same_message(a, b):
+    return (a.trip_id, a.sender_id, a.message, a.timestamp) == (b.trip_id, b.sender_id, b.message, b.timestamp)
+
+
+class ChatWriteBehindQueue:
+    """Process-wide queue of chat messages waiting to be persisted."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        # Batches taken off the queue whose insert has not finished yet
+        self._in_flight = []
+        self._wakeup = None
+        self._flusher = None
+        self._stopping = False
+        self.flushed = 0
+        self.dropped = 0
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'CHAT_FLUSH_INTERVAL_MS', 200) / 1000
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'CHAT_FLUSH_BATCH_SIZE', 500)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def enqueue(self, message):
+        """
+        Queue an unsaved ChatMessage (with id and timestamp already set).
+
+        Must be called from the event loop; starts the flusher on first use.
+        """
+        with self._lock:
+            self._pending.append(message)
+            pending = len(self._pending)
+
+        if self._flusher is None or self._flusher.done():
+            loop = asyncio.get_running_loop()
+            # A queue stopped by an earlier lifespan (or event loop) starts over
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._flusher = loop.create_task(self._run())
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    def pending_for_trip(self, trip_id):
+        """
+        Messages of a trip that are queued or being inserted, i.e. broadcast
+        but possibly not visible in the database yet. Safe to call from any thread.
+        """
+        with self._lock:
+            return [message for message in self._in_flight + self._pending if message.trip_id == trip_id]
+
+    def _take_batch(self):
+        with self._lock:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:len(batch)]
+            self._in_flight.extend(batch)
+            return batch
+
+    def _landed(self, batch):
+        with self._lock:
+            done = {id(message) for message in batch}
+            self._in_flight = [message for message in self._in_flight if id(message) not in done]
+
+    def _requeue(self, batch):
+        with self._lock:
+            done = {id(message) for message in batch}
+            self._in_flight = [message for message in self._in_flight if id(message) not in done]
+            self._pending[:0] = batch
+
+    def flush_batch(self, batch):
+        """Persist one batch synchronously, isolating bad rows if the batch fails."""
+        close_old_connections()
+        try:
+            persist_messages(batch)
+        except IntegrityError:
+            self.dropped += persist_messages_one_by_one(batch)
+        self.flushed += len(batch)
+        self._landed(batch)
+
+    async def _run(self):
+        """Flush queued messages in micro-batches until the queue is stopped."""
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            while self._pending:
+                batch = self._take_batch()
+                started = time.monotonic()
+                try:
+                    await database_sync_to_async(self.flush_batch)(batch)
+                except Exception as e:
+                    # Transient failure: keep the messages and retry later
+                    logger.error(f"Error flushing {len(batch)} chat messages, retrying: {str(e)}")
+                    self._requeue(batch)
+                    await asyncio.sleep(RETRY_DELAY_SECONDS)
+                    break
+                logger.debug(f"Flushed {len(batch)} chat messages in {(time.monotonic() - started) * 1000:.1f} ms")
+
+    def drain(self):
+        """Synchronously persist everything still queued. Safe to call more than once."""
+        while self._pending:
+            batch = self._take_batch()
+            try:
+                self.flush_batch(batch)
+            except Exception as e:
+                logger.error(f"Error draining {len(batch)} chat messages: {str(e)}")
+                self._requeue(batch)
+                raise
+
+    async def stop(self):
+        """Stop the flusher and drain the queue (ASGI lifespan shutdown)."""
+        self._stopping = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if self._flusher is not None:
+            await self._flusher
+        await database_sync_to_async(self.drain)()
+        logger.info(f"Chat write-behind queue drained ({self.flushed} flushed, {self.dropped} dropped)")
+
+
+chat_write_behind = ChatWriteBehindQueue()
+
+
+@atexit.register
+def _drain_on_exit():
+    # Fallback for servers that do not send lifespan events (e.g. daphne)
+    if len(chat_write_behind):
+        try:
+            chat_write_behind.drain()
+        except Exception as e:
+            logger.error(f"Chat messages lost at shutdown: {str(e)}")
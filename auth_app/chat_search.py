@@ -0,0 +1,286 @@
+"""
+Full-text search over trip chat messages.
+
+The index lives in the database next to ChatMessage and is maintained by the
+database itself on every insert, update and delete, so the WebSocket
+write-behind (bulk_create) and the REST endpoint need no extra work:
+
+- SQLite: an external-content FTS5 table ``auth_app_chatmessage_fts`` over
+  ``auth_app_chatmessage.message`` kept current by triggers. Rebuilding the
+  chat table (SQLite ALTERs in later migrations) drops the triggers, so they
+  are re-created after every migrate (see restore_search_triggers);
+- PostgreSQL: a stored generated ``tsvector`` column with a GIN index;
+- MySQL: an InnoDB FULLTEXT index (migration 0024) queried in boolean mode.
+  Words shorter than innodb_ft_min_token_size are not indexed and are
+  matched with LIKE within the trip's messages.
+
+Queries are the words of the search text ANDed together, the last one as a
+prefix (search as you type). Results are ranked (bm25 on SQLite, ts_rank_cd
+on PostgreSQL, MATCH relevance on MySQL) or listed newest first, and paged by
+keyset cursors rather than OFFSET. Other databases fall back to an unranked
+``icontains`` scan.
+
+Only messages still in ChatMessage are searched: messages moved to the cold
+archive (chat_archive.py) are not indexed, and TripChatSearchView reports the
+newest archived id so clients can tell the results do not reach further back.
+"""
+import html
+import re
+
+from django.db import connection
+
+FTS_TABLE = 'auth_app_chatmessage_fts'
+MESSAGE_TABLE = 'auth_app_chatmessage'
+
+DEFAULT_SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+
+# Snippet highlight markers, replaced by <mark> after escaping the text
+START_MARK = '\x02'
+END_MARK = '\x03'
+
+# Keep the FTS5 table current (created by migration 0019)
+SQLITE_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {MESSAGE_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, message) VALUES (new.id, new.message);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {MESSAGE_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message) VALUES ('delete', old.id, old.message);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF message ON {MESSAGE_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message) VALUES ('delete', old.id, old.message);
+        INSERT INTO {FTS_TABLE}(rowid, message) VALUES (new.id, new.message);
+    END""",
+]
+
+# InnoDB does not index words shorter than innodb_ft_min_token_size (default 3)
+MYSQL_MIN_TOKEN_SIZE = 3
+
+# Words around the first match in snippets built in Python (MySQL)
+SNIPPET_WORDS = 24
+
+
+def restore_search_triggers(connection):
+    """
+    Re-create the SQLite triggers after a migration rebuilt the chat table.
+
+    The rebuild copies the rows with their ids, so the FTS5 table still
+    matches them; only the triggers are lost. Does nothing before the index
+    migration has run or on other databases.
+    """
+    if connection.vendor != 'sqlite' or FTS_TABLE not in connection.introspection.table_names():
+        return
+    with connection.cursor() as cursor:
+        for statement in SQLITE_TRIGGERS:
+            cursor.execute(statement)
+
+
+def search_terms(text):
+    """Words of a search text; punctuation and query operators are dropped."""
+    return re.findall(r'\w+', text.lower())
+
+
+def get_search_params(query_params):
+    """
+    Read ``q``, ``order``, ``limit`` and ``cursor`` from a query string.
+
+    Returns:
+        tuple: (terms, order, limit, cursor) where order is 'rank' or 'recent'
+        and cursor is None or the position after the previous page
+
+    Raises:
+        ValueError: If a parameter is invalid
+    """
+    terms = search_terms(query_params.get('q', ''))
+    if not terms:
+        raise ValueError('q must contain at least one word')
+
+    order = query_params.get('order', 'rank')
+    if order not in ('rank', 'recent'):
+        raise ValueError("order must be 'rank' or 'recent'")
+
+    limit = int(query_params.get('limit', DEFAULT_SEARCH_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('limit must be at least 1')
+    limit = min(limit, MAX_SEARCH_PAGE_SIZE)
+
+    cursor = query_params.get('cursor')
+    if cursor is not None:
+        cursor = parse_cursor(order, cursor)
+    return terms, order, limit, cursor
+
+
+def parse_cursor(order, cursor):
+    # 'rank' cursors are "<rank>:<message id>", 'recent' cursors a message id
+    if order == 'recent':
+        return (None, int(cursor))
+    rank, _, message_id = cursor.partition(':')
+    return (float(rank), int(message_id))
+
+
+def format_cursor(order, rank, message_id):
+    if order == 'recent':
+        return str(message_id)
+    return f'{rank!r}:{message_id}'
+
+
+def highlight(snippet):
+    """HTML-escape a snippet and turn the match markers into <mark> tags."""
+    return html.escape(snippet).replace(START_MARK, '<mark>').replace(END_MARK, '</mark>')
+
+
+def _sqlite_query(trip_id, terms, order, limit, cursor):
+    # Quoted terms cannot be read as FTS5 operators; the last one is a prefix
+    match = ' '.join(f'"{term}"' for term in terms) + '*'
+    sql = f"""
+        SELECT id, score, snippet FROM (
+            SELECT m.id AS id, bm25({FTS_TABLE}) AS score,
+                   snippet({FTS_TABLE}, 0, %s, %s, '…', 12) AS snippet
+            FROM {FTS_TABLE} JOIN {MESSAGE_TABLE} m ON m.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH %s AND m.trip_id = %s
+        ) hits"""
+    params = [START_MARK, END_MARK, match, trip_id]
+    # bm25 is lower for better matches
+    return _paged(sql, params, order, limit, cursor, rank_ascending=True)
+
+
+def _postgres_query(trip_id, terms, order, limit, cursor):
+    query = ' & '.join(terms) + ':*'
+    sql = f"""
+        SELECT id, score, snippet FROM (
+            SELECT m.id AS id, ts_rank_cd(m.search_vector, query) AS score,
+                   ts_headline('simple', m.message, query, %s) AS snippet
+            FROM {MESSAGE_TABLE} m, to_tsquery('simple', %s) query
+            WHERE m.search_vector @@ query AND m.trip_id = %s
+        ) hits"""
+    params = [f'StartSel={START_MARK}, StopSel={END_MARK}, MaxWords=24, MinWords=8', query, trip_id]
+    return _paged(sql, params, order, limit, cursor, rank_ascending=False)
+
+
+def _mysql_query(trip_id, terms, order, limit, cursor):
+    # Boolean mode: every indexed term required, the last one as a prefix.
+    # Terms too short for the index are matched with LIKE instead
+    indexed = [term for term in terms if len(term) >= MYSQL_MIN_TOKEN_SIZE]
+    short = [term for term in terms if len(term) < MYSQL_MIN_TOKEN_SIZE]
+    where = ['m.trip_id = %s']
+    where_params = [trip_id]
+    if indexed:
+        against = ' '.join(f'+{term}' for term in indexed)
+        if indexed[-1] == terms[-1]:
+            against += '*'
+        rank = 'MATCH(m.message) AGAINST (%s IN BOOLEAN MODE)'
+        rank_params = [against]
+        where.append(rank)
+        where_params.append(against)
+    else:
+        rank = '0e0'
+        rank_params = []
+    for term in short:
+        where.append('m.message LIKE %s')
+        where_params.append(f'%{term}%')
+    sql = f"""
+        SELECT id, score, snippet FROM (
+            SELECT m.id AS id, {rank} AS score, m.message AS snippet
+            FROM {MESSAGE_TABLE} m
+            WHERE {' AND '.join(where)}
+        ) hits"""
+    rows = _paged(sql, rank_params + where_params, order, limit, cursor, rank_ascending=False)
+    # MySQL has no snippet function
+    return [(message_id, rank, mark_terms(message, terms)) for message_id, rank, message in rows]
+
+
+def mark_terms(message, terms):
+    """
+    Snippet of a message around its first matching word, with every matching
+    word between the highlight markers (the last term matches as a prefix).
+    """
+    words = list(re.finditer(r'\w+', message))
+    if not words:
+        return message
+    last = terms[-1]
+
+    def matches(word):
+        word = word.lower()
+        return word in terms or word.startswith(last)
+
+    marked = [i for i, word in enumerate(words) if matches(word.group())]
+    first = max(0, (marked[0] if marked else 0) - SNIPPET_WORDS // 3)
+    window = words[first:first + SNIPPET_WORDS]
+    start = 0 if first == 0 else window[0].start()
+    end = len(message) if first + SNIPPET_WORDS >= len(words) else window[-1].end()
+
+    parts = ['…'] if start > 0 else []
+    position = start
+    for word in window:
+        if matches(word.group()):
+            parts += [message[position:word.start()], START_MARK, word.group(), END_MARK]
+            position = word.end()
+    parts.append(message[position:end])
+    if end < len(message):
+        parts.append('…')
+    return ''.join(parts)
+
+
+def _paged(sql, params, order, limit, cursor, rank_ascending):
+    if order == 'recent':
+        if cursor is not None:
+            sql += ' WHERE id < %s'
+            params.append(cursor[1])
+        sql += ' ORDER BY id DESC'
+    else:
+        better = '>' if rank_ascending else '<'
+        if cursor is not None:
+            sql += f' WHERE (score {better} %s OR (score = %s AND id < %s))'
+            params.extend([cursor[0], cursor[0], cursor[1]])
+        sql += f" ORDER BY score {'ASC' if rank_ascending else 'DESC'}, id DESC"
+    sql += ' LIMIT %s'
+    params.append(limit + 1)
+
+    with connection.cursor() as db_cursor:
+        db_cursor.execute(sql, params)
+        return db_cursor.fetchall()
+
+
+def _fallback_query(trip_id, terms, order, limit, cursor):
+    from .models import ChatMessage
+
+    queryset = ChatMessage.objects.filter(trip_id=trip_id)
+    for term in terms:
+        queryset = queryset.filter(message__icontains=term)
+    if cursor is not None:
+        queryset = queryset.filter(id__lt=cursor[1])
+    rows = queryset.order_by('-id').values_list('id', 'message')[:limit + 1]
+    return [(message_id, 0.0, message) for message_id, message in rows]
+
+
+def search_messages(trip_id, terms, order='rank', limit=DEFAULT_SEARCH_PAGE_SIZE, cursor=None):
+    """
+    One page of the messages of a trip matching all search terms.
+
+    Args:
+        trip_id: Trip whose chat is searched
+        terms: Words from search_terms()
+        order: 'rank' (best matches first) or 'recent' (newest first)
+        limit: Maximum number of hits
+        cursor: Position after the previous page (see get_search_params)
+
+    Returns:
+        dict: hits ([(message id, rank, highlighted snippet)]) and
+        next_cursor (None on the last page)
+    """
+    if connection.vendor == 'sqlite':
+        rows = _sqlite_query(trip_id, terms, order, limit, cursor)
+    elif connection.vendor == 'postgresql':
+        rows = _postgres_query(trip_id, terms, order, limit, cursor)
+    elif connection.vendor == 'mysql':
+        rows = _mysql_query(trip_id, terms, order, limit, cursor)
+    else:
+        order = 'recent'
+        rows = _fallback_query(trip_id, terms, order, limit, cursor)
+
+    hits = [(message_id, rank, highlight(snippet)) for message_id, rank, snippet in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last_id, last_rank, _ = hits[-1]
+        next_cursor = format_cursor(order, last_rank, last_id)
+    return {'hits': hits, 'next_cursor': next_cursor}
@@ -0,0 +1,550 @@
+"""
+Compatibility scoring engine for trips.
+
+This module is the single implementation of the trip compatibility score:
+1. Destination Match (Mandatory Filter)
+2. Date Overlap (30%)
+3. Shared Activities (50%)
+4. User Preference Match (20%)
+
+Candidates are loaded into NumPy arrays (start/end epochs, activity bitsets,
+encoded budget/frequency) and scored against a reference in one vectorized
+pass. A ScoringContext holds everything loaded for one request; scores
+against saved trips are memoized in the versioned LRU cache in score_cache.
+
+Candidate sets larger than COMPATIBILITY_SHARD_SIZE are split into shards
+that are scored in a process pool, so one rebuild at a very large destination
+is not bound to a single Python thread. The pool serves offline work (the
+TripCompatibility refresh thread and management commands); request handlers
+only use it when COMPATIBILITY_SHARD_REQUESTS is enabled, since a shared
+process pool would queue concurrent requests behind each other.
+"""
+import heapq
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from types import SimpleNamespace
+
+import django
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Trip, UserPreferences
+from .score_cache import ScoreCache, preferences_version, score_cache, trip_version
+
+# Score weights (must stay in sync with calculate_compatibility_score)
+DATE_WEIGHT = 0.3
+ACTIVITIES_WEIGHT = 0.5
+PREFERENCES_WEIGHT = 0.2
+
+# Points awarded for each matching preference (frequency, budget)
+PREFERENCE_MATCH_POINTS = 10
+
+MICROSECONDS_PER_DAY = 86400 * 10 ** 6
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# Number of set bits for every possible byte value, used to popcount bitsets
+_POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def to_epoch_microseconds(value):
+    """
+    Convert a datetime to integer microseconds since the Unix epoch.
+
+    Naive datetimes are treated as being in the current timezone, the same
+    way the views make user supplied dates timezone-aware.
+    """
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+class _CodeTable:
+    """Maps preference values (including None) to small integer codes."""
+
+    def __init__(self):
+        self.codes = {}
+
+    def encode(self, value):
+        return self.codes.setdefault(value, len(self.codes))
+
+
+class CandidateBatch:
+    """
+    Columnar snapshot of a set of trips, ready for vectorized scoring.
+
+    Attributes:
+        trips (list): The Trip objects, in the order of the arrays below
+        trip_ids (ndarray): Trip ids
+        destination_ids (ndarray): Destination ids
+        starts, ends (ndarray): Start/end dates as epoch microseconds
+        activity_words (ndarray): (n, words) uint64 bitsets of activity ids
+        frequencies, budgets (ndarray): Encoded preference values
+        has_preferences (ndarray): Whether the trip owner has UserPreferences
+    """
+
+    def __init__(self, trips, activity_sets, preferences, bit_positions, frequency_codes, budget_codes):
+        self.trips = trips
+        count = len(trips)
+        words = max(1, -(-len(bit_positions) // 64))
+
+        self.trip_ids = np.fromiter((trip.id for trip in trips), dtype=np.int64, count=count)
+        self.destination_ids = np.fromiter((trip.destination_id for trip in trips), dtype=np.int64, count=count)
+        self.starts = np.fromiter((to_epoch_microseconds(trip.start_date) for trip in trips), dtype=np.int64, count=count)
+        self.ends = np.fromiter((to_epoch_microseconds(trip.end_date) for trip in trips), dtype=np.int64, count=count)
+        self.activity_counts = np.fromiter((len(activity_sets[i]) for i in range(count)), dtype=np.int64, count=count)
+
+        # Build the activity bitsets in one scatter operation
+        self.activity_words = np.zeros((count, words), dtype=np.uint64)
+        rows, positions = [], []
+        for row, interest_ids in enumerate(activity_sets):
+            for interest_id in interest_ids:
+                rows.append(row)
+                positions.append(bit_positions[interest_id])
+        if rows:
+            positions = np.asarray(positions, dtype=np.uint64)
+            np.bitwise_or.at(
+                self.activity_words,
+                (np.asarray(rows, dtype=np.intp), (positions // np.uint64(64)).astype(np.intp)),
+                np.left_shift(np.uint64(1), positions % np.uint64(64))
+            )
+
+        # Encode preferences; users without a UserPreferences row are flagged
+        self.has_preferences = np.zeros(count, dtype=bool)
+        self.frequencies = np.zeros(count, dtype=np.int64)
+        self.budgets = np.zeros(count, dtype=np.int64)
+        for row, prefs in enumerate(preferences):
+            if prefs is None:
+                continue
+            self.has_preferences[row] = True
+            self.frequencies[row] = frequency_codes.encode(prefs[0])
+            self.budgets[row] = budget_codes.encode(prefs[1])
+
+    def __len__(self):
+        return len(self.trips)
+
+
+def shared_activity_count(mask_a, ids_a, mask_b, ids_b):
+    """
+    Count the activities two trips share.
+
+    Uses bitwise AND + popcount on the activity masks when both id sets fit in
+    the mask exactly, and falls back to a set intersection otherwise.
+    """
+    shared_mask = mask_a & mask_b
+    if not shared_mask:
+        return 0
+    if max(ids_a, default=0) <= Trip.ACTIVITY_MASK_BITS and max(ids_b, default=0) <= Trip.ACTIVITY_MASK_BITS:
+        return shared_mask.bit_count()
+    return len(set(ids_a).intersection(ids_b))
+
+
+def score_components(reference, batch):
+    """
+    Compute the unweighted score components of every trip in ``batch``
+    against the single trip in ``reference``.
+
+    Date overlap and preferences are symmetric, and shared activities are
+    returned as raw counts, so the same components can be used to score the
+    pairs in either direction (see activities_score).
+
+    Returns:
+        tuple: (date_score 0-100, shared activity counts, preference points 0-20)
+    """
+    ref_start = reference.starts[0]
+    ref_end = reference.ends[0]
+
+    # 1. Date overlap
+    start_overlap = np.maximum(ref_start, batch.starts)
+    end_overlap = np.minimum(ref_end, batch.ends)
+    overlap_days = (end_overlap - start_overlap) // MICROSECONDS_PER_DAY + 1
+    total_days = np.minimum(
+        (ref_end - ref_start) // MICROSECONDS_PER_DAY + 1,
+        (batch.ends - batch.starts) // MICROSECONDS_PER_DAY + 1
+    )
+    has_overlap = (start_overlap <= end_overlap) & (total_days > 0)
+    date_score = np.zeros(len(batch), dtype=np.float64)
+    np.divide(overlap_days, total_days, out=date_score, where=has_overlap)
+    date_score *= 100
+
+    # 2. Shared activities: bitwise AND + popcount
+    shared_words = np.ascontiguousarray(batch.activity_words & reference.activity_words[0])
+    shared = _POPCOUNT_TABLE[shared_words.view(np.uint8)].reshape(len(batch), -1).sum(axis=1, dtype=np.int64)
+
+    # 3. Preferences (only when both users have set them)
+    preferences_score = np.zeros(len(batch), dtype=np.int64)
+    if reference.has_preferences[0]:
+        preferences_score += (batch.frequencies == reference.frequencies[0]) * PREFERENCE_MATCH_POINTS
+        preferences_score += (batch.budgets == reference.budgets[0]) * PREFERENCE_MATCH_POINTS
+        preferences_score *= batch.has_preferences
+
+    return date_score, shared, preferences_score
+
+
+def activities_score(shared, own_counts, other_counts):
+    """
+    Shared activities score (0-100), normalised by the scoring trip's own
+    activity count, as in the original per-pair activities score.
+    """
+    own_counts = np.broadcast_to(own_counts, shared.shape)
+    other_counts = np.broadcast_to(other_counts, shared.shape)
+    valid = (own_counts > 0) & (other_counts > 0)
+    score = np.zeros(shared.shape, dtype=np.float64)
+    np.divide(shared, own_counts, out=score, where=valid)
+    return score * 100
+
+
+def weighted_score(date_score, activity_score, preferences_score):
+    """Combine the components with the 30/50/20 weights."""
+    return (
+        date_score * DATE_WEIGHT
+        + activity_score * ACTIVITIES_WEIGHT
+        + preferences_score * PREFERENCES_WEIGHT
+    )
+
+
+def score_batch(reference, batch):
+    """
+    Score every trip in ``batch`` against the single trip in ``reference``.
+
+    Mirrors calculate_compatibility_score:
+    1. Destination Match (Mandatory Filter)
+    2. Date Overlap (30%)
+    3. Shared Activities (50%)
+    4. User Preference Match (20%)
+
+    Returns:
+        ndarray: Unrounded float64 scores aligned with ``batch.trips``
+    """
+    if not len(batch):
+        return np.zeros(0, dtype=np.float64)
+
+    date_score, shared, preferences_score = score_components(reference, batch)
+    final_score = weighted_score(
+        date_score,
+        activities_score(shared, reference.activity_counts[0], batch.activity_counts),
+        preferences_score
+    )
+
+    # Mandatory destination match
+    return np.where(batch.destination_ids == reference.destination_ids[0], final_score, 0.0)
+
+
+class ScoringContext:
+    """
+    Everything needed to score candidates against one reference, loaded once
+    per request.
+
+    The reference is either a saved Trip (for_trip) or the trip described by a
+    search request (for_request). Candidate activity sets come from the
+    denormalized Trip.activity_ids column and preferences are loaded in one
+    query per batch of candidates and cached on the context, so scoring a page
+    of N candidates costs O(1) queries. This is the single implementation of
+    the compatibility score; calculate_compatibility_score, the compatible trip
+    views and the serializers all go through it.
+    """
+
+    def __init__(self, reference):
+        self.reference = reference
+        self._preferences = {}
+        self._bit_positions = {}
+        self._frequency_codes = _CodeTable()
+        self._budget_codes = _CodeTable()
+
+    @classmethod
+    def for_trip(cls, trip):
+        """Context for scoring candidates against a saved trip."""
+        return cls(trip)
+
+    @classmethod
+    def for_request(cls, user, destination_id, start_date, end_date, activity_ids):
+        """Context for scoring candidates against trip details sent in a request."""
+        # The reference is not a saved trip; id 0 never matches a real row
+        reference = SimpleNamespace(
+            id=0,
+            user_id=user.id,
+            destination_id=int(destination_id),
+            start_date=start_date,
+            end_date=end_date,
+            activity_ids=list(activity_ids)
+        )
+        return cls(reference)
+
+    def load_preferences(self, user_ids):
+        """Load the preferences of any users not seen yet, in a single query."""
+        missing = set(user_ids)
+        missing.add(self.reference.user_id)
+        missing.difference_update(self._preferences)
+        if not missing:
+            return
+
+        rows = UserPreferences.objects.filter(
+            user_id__in=missing
+        ).values_list('user_id', 'travel_frequency', 'travel_budget')
+        for user_id, frequency, budget in rows:
+            self._preferences[user_id] = (frequency, budget)
+        # Remember users without preferences so they are not queried again
+        for user_id in missing:
+            self._preferences.setdefault(user_id, None)
+
+    def preload_preferences(self, preferences):
+        """Seed the context with already known {user_id: (frequency, budget) or None}."""
+        self._preferences.update(preferences)
+
+    def preferences_for(self, user_id):
+        """Return (travel_frequency, travel_budget) for a loaded user, or None."""
+        return self._preferences.get(user_id)
+
+    def batches(self, candidates):
+        """
+        Build the reference and candidate CandidateBatch objects.
+
+        Returns:
+            tuple: (reference batch of length 1, candidate batch)
+        """
+        candidates = list(candidates)
+        self.load_preferences(trip.user_id for trip in candidates)
+
+        # Assign a bit position to every interest id before sizing the bitsets
+        all_trips = [self.reference] + candidates
+        for trip in all_trips:
+            for interest_id in trip.activity_ids:
+                self._bit_positions.setdefault(interest_id, len(self._bit_positions))
+
+        def make_batch(trips):
+            return CandidateBatch(
+                trips,
+                [set(trip.activity_ids) for trip in trips],
+                [self._preferences.get(trip.user_id) for trip in trips],
+                self._bit_positions,
+                self._frequency_codes,
+                self._budget_codes
+            )
+
+        return make_batch([self.reference]), make_batch(candidates)
+
+    def score(self, candidates, in_request=True):
+        """
+        Score candidates against the reference.
+
+        When the reference is a saved trip, pairs found in the versioned score
+        cache are not rescored.
+
+        Args:
+            candidates (iterable): Trip objects to score
+            in_request (bool): Whether a request waits for the result (see should_shard)
+
+        Returns:
+            list: (score, trip) tuples in candidate order, with scores rounded
+            like calculate_compatibility_score
+        """
+        candidates = list(candidates)
+        if not self.reference.id or not candidates:
+            return self._score_candidates(candidates, in_request)
+
+        self.load_preferences(trip.user_id for trip in candidates)
+        reference_version = trip_version(self.reference)
+        reference_prefs = preferences_version(self.preferences_for(self.reference.user_id))
+        keys = [
+            ScoreCache.make_key(
+                self.reference.id,
+                trip.id,
+                (reference_version, trip_version(trip)),
+                (reference_prefs, preferences_version(self.preferences_for(trip.user_id)))
+            )
+            for trip in candidates
+        ]
+
+        cached = score_cache.get_many(keys)
+        missing = [trip for trip, key in zip(candidates, keys) if key not in cached]
+        computed = self._score_candidates(missing, in_request)
+        key_by_trip = {trip.id: key for trip, key in zip(candidates, keys)}
+        score_cache.set_many((key_by_trip[trip.id], score) for score, trip in computed)
+
+        computed_scores = {trip.id: score for score, trip in computed}
+        return [
+            (cached[key] if key in cached else computed_scores[trip.id], trip)
+            for trip, key in zip(candidates, keys)
+        ]
+
+    def _score_candidates(self, candidates, in_request=True):
+        if should_shard(len(candidates), in_request=in_request):
+            return self.score_sharded(candidates)
+        return self._score_uncached(candidates)
+
+    def _score_uncached(self, candidates):
+        reference, batch = self.batches(candidates)
+        scores = score_batch(reference, batch)
+        # Use Python's round() so results match exactly across code paths
+        return [(round(float(score), 2), trip) for trip, score in zip(batch.trips, scores)]
+
+    def map_shards(self, function, candidates, *args):
+        """
+        Run ``function(reference, shard, preferences, *args)`` for every shard of
+        ``candidates`` in the scoring process pool.
+
+        Trips are sent to the workers as plain namespaces holding only the
+        fields the score depends on, together with the preferences of the
+        users involved, so workers never touch the database.
+
+        Returns:
+            list: The result of every shard, in candidate order
+        """
+        candidates = list(candidates)
+        self.load_preferences(trip.user_id for trip in candidates)
+        size = get_shard_size() or len(candidates)
+        reference = _plain_trip(self.reference)
+
+        futures = []
+        for start in range(0, len(candidates), size):
+            shard = [_plain_trip(trip) for trip in candidates[start:start + size]]
+            user_ids = {trip.user_id for trip in shard}
+            user_ids.add(reference.user_id)
+            preferences = {user_id: self._preferences.get(user_id) for user_id in user_ids}
+            futures.append(get_shard_executor().submit(function, reference, shard, preferences, *args))
+        return [future.result() for future in futures]
+
+    def score_sharded(self, candidates, k=None):
+        """
+        Score candidates in the process pool.
+
+        Args:
+            candidates (iterable): Trip objects to score
+            k (int): When given, each shard returns only its top ``k`` and the
+                merged result is the overall top ``k`` in rank order
+
+        Returns:
+            list: (score, trip) tuples, in candidate order unless ``k`` is given
+        """
+        candidates = list(candidates)
+        trips_by_id = {trip.id: trip for trip in candidates}
+        rows = [row for shard_rows in self.map_shards(_score_shard, candidates, k) for row in shard_rows]
+        if k is not None:
+            rows = heapq.nsmallest(k, rows, key=_rank_key)
+        return [(score, trips_by_id[trip_id]) for score, trip_id in rows]
+
+    def iter_scores(self, candidates, chunk_size=1000, in_request=True):
+        """
+        Lazily score an iterable of candidates in vectorized chunks.
+
+        Memory stays bounded by ``chunk_size`` and each chunk costs at most one
+        preferences query. When the caller may use the process pool (see
+        should_shard), chunks grow to one shard per pool worker, since chunks
+        below COMPATIBILITY_SHARD_SIZE would never be sharded.
+
+        Args:
+            candidates (iterable): Trip objects to score
+            chunk_size (int): Candidates scored per vectorized pass
+            in_request (bool): Whether a request waits for the result
+
+        Yields:
+            tuple: (score, trip)
+        """
+        shard_size = get_shard_size()
+        if should_shard(shard_size + 1, in_request=in_request):
+            chunk_size = max(chunk_size, shard_size * get_shard_worker_count())
+        for chunk in _chunked(candidates, chunk_size):
+            yield from self.score(chunk, in_request=in_request)
+
+
+_shard_executor = None
+_shard_executor_lock = threading.Lock()
+
+
+def get_shard_size():
+    """Candidate count above which scoring is sharded across processes (0 disables)."""
+    return getattr(settings, 'COMPATIBILITY_SHARD_SIZE', 5000)
+
+
+def should_shard(candidate_count, in_request=True):
+    """
+    Whether a candidate set should be scored in the process pool.
+
+    Args:
+        candidate_count (int): Number of candidates
+        in_request (bool): Whether the caller is serving a request; requests
+            are only sharded with COMPATIBILITY_SHARD_REQUESTS enabled
+    """
+    if in_request and not getattr(settings, 'COMPATIBILITY_SHARD_REQUESTS', False):
+        return False
+    size = get_shard_size()
+    return size > 0 and candidate_count > size
+
+
+def get_shard_worker_count():
+    """Number of processes in the scoring pool."""
+    return getattr(settings, 'COMPATIBILITY_SHARD_WORKERS', None) or os.cpu_count() or 1
+
+
+def get_shard_executor():
+    """Return the process pool used for sharded scoring, creating it on first use."""
+    global _shard_executor
+    with _shard_executor_lock:
+        if _shard_executor is None:
+            # Workers set up Django so that this module can be imported there
+            _shard_executor = ProcessPoolExecutor(
+                max_workers=get_shard_worker_count(),
+                initializer=django.setup
+            )
+        return _shard_executor
+
+
+def _plain_trip(trip):
+    """Picklable copy of the trip fields the score depends on."""
+    start_date, end_date = trip.start_date, trip.end_date
+    # Make dates aware here so that workers never need the timezone settings
+    if timezone.is_naive(start_date):
+        start_date = timezone.make_aware(start_date)
+    if timezone.is_naive(end_date):
+        end_date = timezone.make_aware(end_date)
+    return SimpleNamespace(
+        id=trip.id,
+        user_id=trip.user_id,
+        destination_id=trip.destination_id,
+        start_date=start_date,
+        end_date=end_date,
+        activity_ids=list(trip.activity_ids)
+    )
+
+
+def _rank_key(row):
+    return -row[0], row[1]
+
+
+def _score_shard(reference, candidates, preferences, k=None):
+    """Worker: score one shard and return [(score, trip_id)], or only its top ``k``."""
+    context = ScoringContext(reference)
+    context.preload_preferences(preferences)
+    rows = [(score, trip.id) for score, trip in context._score_uncached(candidates)]
+    if k is not None:
+        rows = heapq.nsmallest(k, rows, key=_rank_key)
+    return rows
+
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def compatibility_scores(reference_trip, candidates):
+    """
+    Calculate compatibility scores between a reference trip and many candidates.
+
+    Args:
+        reference_trip (Trip): The trip to compare against
+        candidates (iterable): Trip objects to score
+
+    Returns:
+        dict: {trip_id: score}
+    """
+    return {trip.id: score for score, trip in ScoringContext.for_trip(reference_trip).score(candidates)}
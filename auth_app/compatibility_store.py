@@ -0,0 +1,276 @@
+"""
+Incremental maintenance of the materialized TripCompatibility table.
+
+Only the pairs that involve a changed trip are recomputed: when a scoring
+input of a trip changes (destination, dates, owner, active status or
+activities), its rows (in both directions) are rebuilt against the other
+active trips at its destination; when a user's travel preferences change, the
+rows of that user's active trips are rebuilt. Saves that leave these inputs
+alone (descriptions, member counts, ...) schedule nothing.
+
+Refreshes requested during a transaction are collected and run once, after
+the commit, by a background thread (COMPATIBILITY_REFRESH_IN_BACKGROUND), so a
+trip created with its activities is scored once and the request does not wait
+for it. On SQLite they run inline after the commit instead, since the refresh
+thread's writes would contend with the request's for the database lock. Very large destinations are scored in the shared scoring process pool
+(only off the request path, see should_shard).
+
+Trips whose pairs were never computed (compatibility_refreshed_at is empty,
+e.g. trips created before the table existed) are scored on first read by
+ensure_trip_compatibility(); rebuild_trip_compatibility fills the table in one
+go instead.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .compatibility import ScoringContext, score_components, activities_score, weighted_score, should_shard
+from .models import Trip, TripCompatibility
+
+logger = logging.getLogger(__name__)
+
+# Only trips that can still be joined or viewed as upcoming get scored
+ACTIVE_STATUSES = ('open', 'full')
+
+# Trip fields the stored scores depend on (besides status and activities)
+SCORING_FIELDS = ('user_id', 'destination_id', 'start_date', 'end_date')
+PREFERENCE_FIELDS = ('travel_frequency', 'travel_budget')
+
+
+def _pair_scores(context, candidates):
+    """
+    Score ``candidates`` against the context's reference in both directions.
+
+    Returns:
+        tuple: (date_score, forward_activities, reverse_activities, preferences_score) arrays
+    """
+    reference, batch = context.batches(candidates)
+    date_score, shared, preferences_score = score_components(reference, batch)
+    forward_activities = activities_score(shared, reference.activity_counts[0], batch.activity_counts)
+    reverse_activities = activities_score(shared, batch.activity_counts, reference.activity_counts[0])
+    return date_score, forward_activities, reverse_activities, preferences_score
+
+
+def _pair_scores_shard(reference, candidates, preferences):
+    """Worker: _pair_scores for one shard of a large destination."""
+    context = ScoringContext(reference)
+    context.preload_preferences(preferences)
+    return _pair_scores(context, candidates)
+
+
+def _pair_rows(trip, candidates, in_request=False):
+    """Build TripCompatibility rows for ``trip`` against ``candidates`` in both directions."""
+    candidates = list(candidates)
+    if not candidates:
+        return []
+
+    context = ScoringContext.for_trip(trip)
+    if should_shard(len(candidates), in_request=in_request):
+        shards = context.map_shards(_pair_scores_shard, candidates)
+        date_score, forward_activities, reverse_activities, preferences_score = (
+            np.concatenate(arrays) for arrays in zip(*shards)
+        )
+    else:
+        date_score, forward_activities, reverse_activities, preferences_score = _pair_scores(context, candidates)
+    forward = weighted_score(date_score, forward_activities, preferences_score)
+    reverse = weighted_score(date_score, reverse_activities, preferences_score)
+
+    rows = []
+    for i, candidate in enumerate(candidates):
+        if forward[i] > 0:
+            rows.append(TripCompatibility(
+                trip_id=trip.id,
+                other_trip_id=candidate.id,
+                score=round(float(forward[i]), 2),
+                date_score=float(date_score[i]),
+                activities_score=float(forward_activities[i]),
+                preferences_score=float(preferences_score[i])
+            ))
+        if reverse[i] > 0:
+            rows.append(TripCompatibility(
+                trip_id=candidate.id,
+                other_trip_id=trip.id,
+                score=round(float(reverse[i]), 2),
+                date_score=float(date_score[i]),
+                activities_score=float(reverse_activities[i]),
+                preferences_score=float(preferences_score[i])
+            ))
+    return rows
+
+
+def refresh_trip_compatibility(trip_id, in_request=False):
+    """
+    Recompute every stored pair involving ``trip_id``.
+
+    Args:
+        trip_id: Trip whose pairs are recomputed
+        in_request: Whether a request waits for the result (see should_shard)
+
+    Returns:
+        int: Number of rows written
+    """
+    trip = Trip.objects.filter(id=trip_id).first()
+    with transaction.atomic():
+        TripCompatibility.objects.filter(Q(trip_id=trip_id) | Q(other_trip_id=trip_id)).delete()
+        if trip is None or trip.status not in ACTIVE_STATUSES:
+            return 0
+
+        candidates = Trip.objects.filter(
+            destination_id=trip.destination_id,
+            status__in=ACTIVE_STATUSES
+        ).exclude(user_id=trip.user_id)
+        rows = _pair_rows(trip, candidates, in_request)
+        TripCompatibility.objects.bulk_create(rows, batch_size=500)
+        Trip.objects.filter(id=trip_id).update(compatibility_refreshed_at=timezone.now())
+    return len(rows)
+
+
+def refresh_user_compatibility(user_id):
+    """Recompute the pairs of every active trip owned by ``user_id``."""
+    trip_ids = Trip.objects.filter(
+        user_id=user_id,
+        status__in=ACTIVE_STATUSES
+    ).values_list('id', flat=True)
+    return sum(refresh_trip_compatibility(trip_id) for trip_id in list(trip_ids))
+
+
+def ensure_trip_compatibility(trip):
+    """
+    Compute the pairs of an active trip now if they were never computed, so
+    that readers of TripCompatibility do not mistake a missing row for a
+    score of 0.
+    """
+    if trip.compatibility_refreshed_at is None and trip.status in ACTIVE_STATUSES:
+        refresh_trip_compatibility(trip.id, in_request=True)
+        trip.compatibility_refreshed_at = timezone.now()
+
+
+def trip_scoring_changed(trip):
+    """Whether a saved trip's stored pairs may be out of date."""
+    if trip.changed_since_load(*SCORING_FIELDS):
+        return True
+    was_active = trip.loaded_value('status') in ACTIVE_STATUSES
+    return was_active != (trip.status in ACTIVE_STATUSES)
+
+
+def preferences_changed(preferences):
+    """Whether saved UserPreferences changed the fields that enter the score."""
+    return preferences.changed_since_load(*PREFERENCE_FIELDS)
+
+
+class _TransactionRefreshes(threading.local):
+    # Ids requested by the current thread's transaction, not committed yet
+    def __init__(self):
+        self.trip_ids = set()
+        self.user_ids = set()
+
+
+_requested = _TransactionRefreshes()
+_pending_lock = threading.Lock()
+_pending_trip_ids = set()
+_pending_user_ids = set()
+_refresh_queued = False
+_refresh_executor = None
+
+
+def schedule_trip_refresh(trip_id):
+    """Refresh a trip's pairs after the current transaction commits."""
+    _requested.trip_ids.add(trip_id)
+    transaction.on_commit(_commit_requested)
+
+
+def schedule_user_refresh(user_id):
+    """Refresh the pairs of a user's active trips after the current transaction commits."""
+    _requested.user_ids.add(user_id)
+    transaction.on_commit(_commit_requested)
+
+
+def _commit_requested():
+    # Every schedule_* call registers this callback; the first one to run
+    # after the commit hands all of the transaction's ids over, the others
+    # find nothing left. Ids of a rolled back transaction are only refreshed
+    # with the next commit, which is harmless.
+    global _refresh_queued, _refresh_executor
+    if not _requested.trip_ids and not _requested.user_ids:
+        return
+    with _pending_lock:
+        _pending_trip_ids.update(_requested.trip_ids)
+        _pending_user_ids.update(_requested.user_ids)
+        _requested.trip_ids.clear()
+        _requested.user_ids.clear()
+        if not getattr(settings, 'COMPATIBILITY_REFRESH_IN_BACKGROUND', True):
+            run_now = True
+        elif _refresh_queued:
+            # The queued run has not started yet and will pick these up
+            return
+        else:
+            run_now = False
+            _refresh_queued = True
+            if _refresh_executor is None:
+                _refresh_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='compatibility-refresh')
+
+    if run_now:
+        run_pending_refreshes()
+    else:
+        _refresh_executor.submit(_run_in_background)
+
+
+def _run_in_background():
+    try:
+        run_pending_refreshes()
+    finally:
+        connection.close()
+
+
+def run_pending_refreshes():
+    """
+    Refresh every trip scheduled so far, each once.
+
+    Returns:
+        int: Number of trips refreshed
+    """
+    global _refresh_queued
+    with _pending_lock:
+        trip_ids = set(_pending_trip_ids)
+        user_ids = set(_pending_user_ids)
+        _pending_trip_ids.clear()
+        _pending_user_ids.clear()
+        _refresh_queued = False
+
+    if user_ids:
+        trip_ids.update(Trip.objects.filter(
+            user_id__in=user_ids,
+            status__in=ACTIVE_STATUSES
+        ).values_list('id', flat=True))
+    for trip_id in sorted(trip_ids):
+        try:
+            refresh_trip_compatibility(trip_id)
+        except Exception as e:
+            logger.error(f"Error refreshing compatibility for trip {trip_id}: {str(e)}")
+    return len(trip_ids)
+
+
+def rebuild_destination(destination_id):
+    """
+    Rebuild all pairs at one destination from scratch.
+
+    Returns:
+        int: Number of rows written
+    """
+    trips = list(Trip.objects.filter(destination_id=destination_id, status__in=ACTIVE_STATUSES))
+    with transaction.atomic():
+        TripCompatibility.objects.filter(trip__destination_id=destination_id).delete()
+        rows = []
+        # Each pair is scored once, in both directions, against the trips after it
+        for index, trip in enumerate(trips):
+            candidates = [other for other in trips[index + 1:] if other.user_id != trip.user_id]
+            rows.extend(_pair_rows(trip, candidates))
+        TripCompatibility.objects.bulk_create(rows, batch_size=500)
+        Trip.objects.filter(id__in=[trip.id for trip in trips]).update(compatibility_refreshed_at=timezone.now())
+    return len(rows)
@@ -1,29 +1,171 @@
-import json
+import asyncio
 import logging
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.db.models import Q
 from django.utils import timezone
 from .models import Trip, ChatMessage, UserProfile
+from .chat_limits import (chat_counters, closes_slow_consumers, connection_bucket, send_queue_size, take_token,
+                          user_bucket)
+from .chat_persistence import chat_write_behind, is_write_behind_enabled
+from .membership_cache import trip_membership_cache
+from .presence import presence
+from .snowflake import anext_snowflake_id
+from .structured_logging import get_logger
+from .recent_messages import recent_messages
+from .user_push import user_group_name
+from .wire_formats import (chat_frame, compact_chat_message, decode_frame, dumps_compact, encode_chat_frame,
+                           encode_frame, history_frame, select_subprotocol, sender_metadata)
 
-# Set up logging
+# Set up logging; hot paths use the lazy, sampled structured logger
 logger = logging.getLogger(__name__)
+log = get_logger(__name__)
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
+
+class ChatSocketMixin:
+    """
+    Chat plumbing shared by the per-trip socket (ChatConsumer) and the
+    multiplexed user socket (UserConsumer): the bounded outbound queue,
+    rate limits, membership checks and sending messages to a trip's group.
+    """
+
+    def start_writer(self):
+        # Outgoing frames go through a bounded queue so a slow client
+        # cannot stall the group fan-out
+        self.outbound = asyncio.Queue(maxsize=send_queue_size())
+        self.writer = asyncio.create_task(self.write_frames())
+        self.rate_limit = connection_bucket()
+        self.user_rate_limit = user_bucket(self.user.id)
+        self.rate_limited_notified_at = 0.0
+
+    async def queue_frame(self, frame):
+        """Queue a frame for the writer task; drops it (and maybe closes) if the client is too slow."""
+        try:
+            self.outbound.put_nowait(frame)
+        except asyncio.QueueFull:
+            chat_counters['dropped_frames'] += 1
+            if closes_slow_consumers() and not getattr(self, 'closing_slow', False):
+                self.closing_slow = True
+                chat_counters['closed_slow_consumers'] += 1
+                logger.warning(f"Closing slow chat socket of user {self.user.id}")
+                await self.close(code=1013)
+    
+    async def write_frames(self):
+        """Send queued frames one by one; runs for the lifetime of the connection."""
+        while True:
+            frame = await self.outbound.get()
+            try:
+                await self.send(**frame)
+            except Exception as e:
+                logger.error(f"Error sending message: {str(e)}")
+                return
+    
+    async def throttle(self):
+        """Drop a message over the rate limits, telling the client at most once per second."""
+        chat_counters['throttled'] += 1
+        now = time.monotonic()
+        if now - self.rate_limited_notified_at >= 1:
+            self.rate_limited_notified_at = now
+            await self.queue_frame(encode_frame(self.subprotocol, {'type': 'error', 'code': 'rate_limited'}))
+    
+    async def is_member(self, trip_id):
+        """Whether the user created or joined the trip, served from the membership cache."""
+        try:
+            found, membership = trip_membership_cache.get(trip_id)
+            if not found:
+                membership = await database_sync_to_async(trip_membership_cache.load)(trip_id)
+            
+            if membership is None:
+                logger.error(f"Trip {trip_id} does not exist")
+                return False
+            return membership.allows(self.user.id)
+        except Exception as e:
+            logger.error(f"Error checking trip membership: {str(e)}")
+            return False
+    
+    async def send_chat_message(self, trip_id, message):
+        """Persist (or queue) a chat message of the user and broadcast it to the trip's group."""
+        if not isinstance(message, str) or not message.strip():
+            return
+        
+        chat_counters['received'] += 1
+        if not take_token(self.rate_limit, self.user_rate_limit):
+            await self.throttle()
+            return
+        
+        if is_write_behind_enabled():
+            # Broadcast right away; the message is persisted by the batched flusher
+            chat_message = await self.queue_message(trip_id, message)
+        else:
+            # Save message to database
+            chat_message = await self.save_message(trip_id, message)
+            if chat_message is None:
+                # The trip was deleted while the socket was open
+                await self.send_error('trip_not_found', int(trip_id))
+                return
+        presence.set_typing(trip_id, self.user.id, False)
+        
+        # Encode the frames once; group members forward the one matching their
+        # wire format without re-serializing
+        await self.channel_layer.group_send(
+            f'chat_{trip_id}',
+            {
+                'type': 'chat_message',
+                'trip_id': int(trip_id),
+                'message_id': chat_message.id,
+                'sender_id': self.user.id,
+                'frame': encode_chat_frame(chat_message, self.sender),
+                'compact': dumps_compact(compact_chat_message(chat_message, self.sender))
+            }
+        )
+    
+    async def queue_message(self, trip_id, message_text):
+        """Create the message with its final id and timestamp and queue it for write-behind."""
+        chat_message = ChatMessage(
+            id=await anext_snowflake_id(),
+            trip_id=int(trip_id),
+            sender=self.user,
+            message=message_text,
+            timestamp=timezone.now()
+        )
+        chat_write_behind.enqueue(chat_message)
+        return chat_message
+    
+    async def send_error(self, code, trip_id):
+        await self.queue_frame(encode_frame(self.subprotocol, {'type': 'error', 'code': code, 'trip_id': trip_id}))
+    
+    @database_sync_to_async
+    def save_message(self, trip_id, message_text):
+        """Save a chat message of the user; returns None if the trip no longer exists."""
         try:
-            # Log connection attempt with full scope details
-            logger.info(f"WebSocket connection attempt with scope: {self.scope}")
+            trip = Trip.objects.get(id=trip_id)
+            chat_message = ChatMessage.objects.create(
+                trip=trip,
+                sender=self.user,
+                message=message_text
+            )
+            log.debug('chat_message_saved', trip_id=trip_id, message_id=chat_message.id, user_id=self.user.id)
             
+            return chat_message
+        except Trip.DoesNotExist:
+            logger.error(f"Trip {trip_id} does not exist when saving message")
+            return None
+        except Exception as e:
+            logger.error(f"Error saving message: {str(e)}")
+            raise
+
+
+class ChatConsumer(ChatSocketMixin, AsyncWebsocketConsumer):
+    async def connect(self):
+        try:
             # Get trip_id from URL route parameters
             self.trip_id = self.scope['url_route']['kwargs']['trip_id']
-            logger.info(f"Trip ID from URL: {self.trip_id}")
-            
             self.room_group_name = f'chat_{self.trip_id}'
-            logger.info(f"Room group name: {self.room_group_name}")
             
             # Get the user from the scope
             self.user = self.scope.get('user')
-            logger.info(f"User from scope: {self.user.username} (ID: {self.user.id})")
             
             # Check if user is authenticated
             if self.user.is_anonymous:
@@ -32,27 +174,50 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 return
             
             # Check if user is a member of the trip
-            is_member = await self.is_trip_member()
-            logger.info(f"User {self.user.username} (ID: {self.user.id}) is member of trip {self.trip_id}: {is_member}")
+            is_member = await self.is_member(self.trip_id)
             
             if not is_member:
                 logger.warning(f"User {self.user.username} (ID: {self.user.id}) attempted to access trip {self.trip_id} but is not a member")
                 await self.close()
                 return
             
-            # Join room group
-            logger.info(f"Adding user {self.user.username} to room group {self.room_group_name}")
+            # Resolved once here rather than for every message the user sends
+            self.sender = sender_metadata(self.user)
             
-            # This is the critical part that was missing - actually joining the channel group
+            # Join room group
             await self.channel_layer.group_add(
                 self.room_group_name,
                 self.channel_name
             )
-            logger.info(f"Successfully added to channel group {self.room_group_name}")
+            # Membership pushes close the socket if the user leaves the trip
+            self.user_group_name = user_group_name(self.user.id)
+            await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+            
+            # Accept the connection in the wire format the client asked for, if any
+            self.subprotocol = select_subprotocol(self.scope.get('subprotocols'))
+            await self.accept(subprotocol=self.subprotocol)
+            log.info('chat_socket_accepted', trip_id=self.trip_id, user_id=self.user.id, subprotocol=self.subprotocol)
             
-            # Accept the connection
-            await self.accept()
-            logger.info(f"WebSocket connection accepted for user {self.user.username}")
+            self.start_writer()
+            
+            # Clients that only understand chat_message frames get nothing else
+            # unless they opt in with ?history=1 and/or ?presence=1
+            query = parse_qs(self.scope.get('query_string', b'').decode())
+            self.sends_history = query.get('history') == ['1']
+            self.sends_presence = query.get('presence') == ['1']
+            
+            # Push the latest messages so that opening a chat needs no REST history call
+            recent_messages.join(self.trip_id)
+            self.joined_recent_messages = True
+            if recent_messages.size > 0 and self.sends_history:
+                entries = await recent_messages.get(self.trip_id)
+                await self.queue_frame(history_frame(self.subprotocol, entries))
+            
+            # Announce the user (batched with other changes) and send who is here
+            presence.connect(self.trip_id, self.user.id, self.user.username)
+            self.joined_presence = True
+            if self.sends_presence:
+                await self.queue_frame(encode_frame(self.subprotocol, presence.snapshot(self.trip_id)))
             
         except Exception as e:
             logger.error(f"Error in connect: {str(e)}")
@@ -61,166 +226,236 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     async def disconnect(self, close_code):
         try:
-            logger.info(f"WebSocket disconnect with code: {close_code}")
+            log.info('chat_socket_closed', trip_id=getattr(self, 'trip_id', None), code=close_code)
+            
+            if getattr(self, 'joined_recent_messages', False):
+                recent_messages.leave(self.trip_id)
+            if getattr(self, 'joined_presence', False):
+                presence.disconnect(self.trip_id, self.user.id)
+            if getattr(self, 'writer', None) is not None:
+                self.writer.cancel()
             
             # Check if we have a room_group_name (might not if connection failed early)
             if hasattr(self, 'room_group_name') and hasattr(self, 'channel_name'):
-                logger.info(f"Removing user from room group {self.room_group_name}")
-                
                 # Leave room group
                 await self.channel_layer.group_discard(
                     self.room_group_name,
                     self.channel_name
                 )
-                logger.info(f"Successfully removed from room group")
             else:
                 logger.warning(f"Disconnect called but room_group_name or channel_name not set")
+            if hasattr(self, 'user_group_name'):
+                await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
         except Exception as e:
             logger.error(f"Error in disconnect: {str(e)}")
 
     
-    async def receive(self, text_data):
-        # Parse the received JSON data
-        text_data_json = json.loads(text_data)
-        message = text_data_json.get('message', '')
-        
-        if not message.strip():
+    async def receive(self, text_data=None, bytes_data=None):
+        # Parse the received frame (JSON, or MessagePack with the msgpack subprotocol)
+        try:
+            payload = decode_frame(self.subprotocol, text_data, bytes_data)
+        except ValueError as e:
+            logger.warning(f"Ignoring invalid frame from user {self.user.id}: {str(e)}")
+            return
+        if payload.get('type') == 'typing':
+            # Coalesced into the next presence diff of the room
+            presence.set_typing(self.trip_id, self.user.id, payload.get('active', True) is not False)
             return
         
-        # Save message to database
-        chat_message = await self.save_message(message)
-        
-        # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'sender_id': self.user.id,
-                'sender_username': self.user.username,
-                'sender_profile_picture': self.user.profile_picture.url if self.user.profile_picture else None,
-                'timestamp': chat_message.timestamp.isoformat(),
-                'formatted_timestamp': chat_message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-                'message_id': chat_message.id
-            }
-        )
+        await self.send_chat_message(self.trip_id, payload.get('message', ''))
     
     async def chat_message(self, event):
-        try:
-            logger.info(f"Sending chat message to client: {event}")
-            # Send message to WebSocket
-            await self.send(text_data=json.dumps({
-                'message': event['message'],
-                'sender_id': event['sender_id'],
-                'sender_username': event['sender_username'],
-                'sender_profile_picture': event['sender_profile_picture'],
-                'timestamp': event['timestamp'],
-                'formatted_timestamp': event['formatted_timestamp'],
-                'message_id': event['message_id']
-            }))
-            logger.info("Message sent successfully")
-        except Exception as e:
-            logger.error(f"Error sending message: {str(e)}")
-
+        recent_messages.add(self.trip_id, (event['message_id'], event['frame'], event['compact']))
+        await self.queue_frame(chat_frame(self.subprotocol, event))
     
-    @database_sync_to_async
-    def is_trip_member(self):
+    async def presence_diff(self, event):
+        presence.apply(self.trip_id, event)
+        if self.sends_presence and not event.get('heartbeat'):
+            await self.queue_frame(chat_frame(self.subprotocol, event))
+
+    async def trip_membership(self, event):
+        """Close the socket when the user left (or was removed from) its trip."""
+        if event['trip_id'] != int(self.trip_id) or event['joined']:
+            return
+        # The change may have been made by another process, whose generation bump this one has not seen yet
+        trip_membership_cache.invalidate_local([event['trip_id']])
+        if not await self.is_member(event['trip_id']):
+            log.info('chat_socket_membership_revoked', trip_id=self.trip_id, user_id=self.user.id)
+            await self.close()
+
+    async def trip_notification(self, event):
+        # Pushed to the user's group for the user socket; nothing to do here
+        pass
+
+
+
+class UserConsumer(ChatSocketMixin, AsyncWebsocketConsumer):
+    """
+    One multiplexed socket per user (ws/user/) instead of one ws/chat/<trip_id>/
+    socket per open trip chat: authentication, the trip lookup and the
+    handshake happen once per user.
+
+    The socket follows the chat groups of all the user's trips. For trips the
+    client subscribed to it forwards every chat and presence frame wrapped as
+    ``{"trip_id": ..., "data": <frame>}``; for the other trips it only sends a
+    small ``chat_notification`` frame per message. Trip notifications and
+    membership changes are pushed through the ``user_{user_id}`` group (see
+    user_push.py).
+
+    Control frames sent by the client:
+
+        {"type": "subscribe", "trip_id": 1, "history": true}
+        {"type": "unsubscribe", "trip_id": 1}
+        {"type": "message", "trip_id": 1, "message": "..."}
+        {"type": "typing", "trip_id": 1, "active": true}
+    """
+
+    async def connect(self):
         try:
-            logger.info(f"Checking if user {self.user.id} is a member of trip {self.trip_id}")
+            self.user = self.scope.get('user')
+            if self.user is None or self.user.is_anonymous:
+                logger.warning(f"Anonymous user attempted to connect to the user socket")
+                await self.close()
+                return
             
-            # SUPER IMPORTANT: For testing purposes, allow all authenticated users
-            # This bypasses all membership checks to help isolate connection issues
-            logger.info(f"BYPASSING MEMBERSHIP CHECK: Allowing all authenticated users for testing")
-            return True
+            self.sender = sender_metadata(self.user)
+            self.user_group_name = user_group_name(self.user.id)
+            self.subscriptions = set()
             
-            # The code below is commented out during testing
-            # Uncomment this code when the WebSocket connection is working properly
-            '''
-            # Detailed logging of all trips for debugging
-            all_trips = list(Trip.objects.all().values_list('id', flat=True))
-            logger.info(f"All trip IDs in database: {all_trips}")
+            # Follow every trip of the user for chat notifications
+            self.trip_ids = await self.load_trip_ids()
+            await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+            for trip_id in self.trip_ids:
+                await self.channel_layer.group_add(f'chat_{trip_id}', self.channel_name)
+            
+            self.subprotocol = select_subprotocol(self.scope.get('subprotocols'))
+            await self.accept(subprotocol=self.subprotocol)
+            log.info('user_socket_accepted', user_id=self.user.id, trips=len(self.trip_ids), subprotocol=self.subprotocol)
+            
+            self.start_writer()
+            await self.queue_frame(encode_frame(self.subprotocol, {'type': 'ready', 'trips': sorted(self.trip_ids)}))
             
-            # Get the trip and log its details
-            try:
-                trip = Trip.objects.get(id=self.trip_id)
-                logger.info(f"Found trip {self.trip_id}: creator={trip.user.id}, members={list(trip.members.values_list('id', flat=True))}")
-                
-                # Check membership
-                is_member = trip.members.filter(id=self.user.id).exists()
-                is_creator = trip.user.id == self.user.id
-                logger.info(f"User {self.user.id} is member: {is_member}, is creator: {is_creator}")
-                
-                return is_member or is_creator
-            except Trip.DoesNotExist:
-                logger.error(f"Trip {self.trip_id} does not exist")
-                return False
-            '''
         except Exception as e:
-            logger.error(f"Error checking trip membership: {str(e)}")
-            # Log the full exception traceback for debugging
-            import traceback
-            logger.error(traceback.format_exc())
-            # For testing, allow connection even if there's an error
-            return True
+            logger.error(f"Error in user socket connect: {str(e)}")
+            await self.close()
+            return
     
-    @database_sync_to_async
-    def save_message(self, message_text):
+    async def disconnect(self, close_code):
         try:
-            logger.info(f"Saving message from user {self.user.username} to trip {self.trip_id}")
-            trip = Trip.objects.get(id=self.trip_id)
-            chat_message = ChatMessage.objects.create(
-                trip=trip,
-                sender=self.user,
-                message=message_text
-            )
-            logger.info(f"Message saved successfully with ID: {chat_message.id}")
+            log.info('user_socket_closed', user_id=getattr(getattr(self, 'user', None), 'id', None), code=close_code)
             
-            # Create chat notifications for all trip members except the sender
-            self.create_chat_notifications(trip, chat_message)
-            logger.info(f"Chat notifications created for message ID: {chat_message.id}")
+            for trip_id in list(getattr(self, 'subscriptions', ())):
+                self.leave_room(trip_id)
+            if getattr(self, 'writer', None) is not None:
+                self.writer.cancel()
             
-            return chat_message
-        except Trip.DoesNotExist:
-            logger.error(f"Trip {self.trip_id} does not exist when saving message")
-            raise
+            for trip_id in getattr(self, 'trip_ids', ()):
+                await self.channel_layer.group_discard(f'chat_{trip_id}', self.channel_name)
+            if hasattr(self, 'user_group_name'):
+                await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
         except Exception as e:
-            logger.error(f"Error saving message: {str(e)}")
-            raise
+            logger.error(f"Error in user socket disconnect: {str(e)}")
     
-    def create_chat_notifications(self, trip, chat_message):
-        """Create chat notifications for all trip members except the sender."""
-        from .models import ChatNotification
-        
-        sender = self.user
-        logger.info(f"Creating chat notifications for message from {sender.username} in trip {trip.id}")
-        
-        # Get all trip members (including the creator) except the sender
-        recipients = set()
-        
-        # Add trip creator if not the sender
-        if trip.user != sender:
-            recipients.add(trip.user)
-        
-        # Add all trip members except the sender
-        for member in trip.members.all():
-            if member != sender:
-                recipients.add(member)
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            payload = decode_frame(self.subprotocol, text_data, bytes_data)
+            trip_id = int(payload.get('trip_id'))
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Ignoring invalid frame from user {self.user.id}: {str(e)}")
+            return
+        frame_type = payload.get('type', 'message')
         
-        # Create message preview (truncate to 50 chars)
-        message_preview = chat_message.message[:47] + '...' if len(chat_message.message) > 50 else chat_message.message
+        if frame_type == 'subscribe':
+            await self.subscribe(trip_id, payload.get('history', True) is not False)
+        elif frame_type == 'unsubscribe':
+            if trip_id in self.subscriptions:
+                self.leave_room(trip_id)
+            await self.queue_frame(encode_frame(self.subprotocol, {'type': 'unsubscribed', 'trip_id': trip_id}))
+        elif trip_id not in self.subscriptions:
+            await self.send_error('not_subscribed', trip_id)
+        elif frame_type == 'typing':
+            presence.set_typing(trip_id, self.user.id, payload.get('active', True) is not False)
+        elif frame_type == 'message':
+            await self.send_chat_message(trip_id, payload.get('message', ''))
+        else:
+            logger.warning(f"Ignoring frame of unknown type {frame_type} from user {self.user.id}")
+    
+    async def subscribe(self, trip_id, with_history):
+        """Start forwarding a trip's chat: acknowledgement, history and presence snapshot."""
+        if trip_id not in self.subscriptions:
+            if not await self.is_member(trip_id):
+                await self.send_error('forbidden', trip_id)
+                return
+            if trip_id not in self.trip_ids:
+                # Joined after connecting and the membership push has not arrived (yet)
+                self.trip_ids.add(trip_id)
+                await self.channel_layer.group_add(f'chat_{trip_id}', self.channel_name)
+            self.subscriptions.add(trip_id)
+            recent_messages.join(trip_id)
+            presence.connect(trip_id, self.user.id, self.user.username)
         
-        # Create a notification for each recipient
-        notification_count = 0
-        for recipient in recipients:
-            ChatNotification.objects.create(
-                user=recipient,
-                trip=trip,
-                chat_message=chat_message,
-                sender=sender,
-                message_preview=message_preview,
-                is_read=False
-            )
-            notification_count += 1
+        await self.queue_frame(encode_frame(self.subprotocol, {'type': 'subscribed', 'trip_id': trip_id}))
+        if with_history and recent_messages.size > 0:
+            entries = await recent_messages.get(trip_id)
+            await self.queue_frame(history_frame(self.subprotocol, entries, trip_id))
+        await self.queue_frame(encode_frame(self.subprotocol, presence.snapshot(trip_id), trip_id))
+    
+    def leave_room(self, trip_id):
+        self.subscriptions.discard(trip_id)
+        recent_messages.leave(trip_id)
+        presence.disconnect(trip_id, self.user.id)
+    
+    async def chat_message(self, event):
+        trip_id = event.get('trip_id')
+        if trip_id in self.subscriptions:
+            recent_messages.add(trip_id, (event['message_id'], event['frame'], event['compact']))
+            await self.queue_frame(chat_frame(self.subprotocol, event, trip_id))
+        elif trip_id is not None and event.get('sender_id') != self.user.id:
+            await self.queue_frame(encode_frame(self.subprotocol, {
+                'type': 'chat_notification',
+                'trip_id': trip_id,
+                'message_id': event['message_id'],
+                'sender_id': event.get('sender_id')
+            }))
+    
+    async def presence_diff(self, event):
+        trip_id = event.get('trip_id')
+        if trip_id in self.subscriptions:
+            presence.apply(trip_id, event)
+            if not event.get('heartbeat'):
+                await self.queue_frame(chat_frame(self.subprotocol, event, trip_id))
+    
+    async def trip_notification(self, event):
+        await self.queue_frame(encode_frame(self.subprotocol, {
+            'type': 'trip_notification',
+            'notification': event['notification']
+        }))
+    
+    async def trip_membership(self, event):
+        """Follow or drop a trip's chat group after the user joined or left it."""
+        trip_id = event['trip_id']
+        # The change may have been made by another process, whose generation bump this one has not seen yet
+        trip_membership_cache.invalidate_local([trip_id])
+        is_member = await self.is_member(trip_id)
         
-        logger.info(f"Created {notification_count} chat notifications for message ID: {chat_message.id}")
-        return notification_count
+        if is_member and trip_id not in self.trip_ids:
+            self.trip_ids.add(trip_id)
+            await self.channel_layer.group_add(f'chat_{trip_id}', self.channel_name)
+        elif not is_member and trip_id in self.trip_ids:
+            if trip_id in self.subscriptions:
+                self.leave_room(trip_id)
+            self.trip_ids.discard(trip_id)
+            await self.channel_layer.group_discard(f'chat_{trip_id}', self.channel_name)
+        await self.queue_frame(encode_frame(self.subprotocol, {
+            'type': 'trip_membership',
+            'trip_id': trip_id,
+            'joined': is_member
+        }))
+    
+    @database_sync_to_async
+    def load_trip_ids(self):
+        """Ids of the trips the user created or joined, in one query."""
+        return set(
+            Trip.objects.filter(Q(user_id=self.user.id) | Q(members__id=self.user.id))
+            .values_list('id', flat=True).distinct()
+        )
@@ -0,0 +1,325 @@
+"""
+In-process interval index of open trips, keyed by destination.
+
+find_travel_buddies needs every open trip at a destination whose
+[start_date, end_date] overlaps the searcher's trip. Instead of scanning all
+trips at the destination, each destination keeps an interval tree so an
+overlap query costs O(log n + k).
+
+The index for a destination is loaded from the database on first use. Every
+committed save or delete of a trip (signals.py, on commit) increments its
+destination's generation counter in the 'shared' cache (see CACHES in
+settings); queries read that counter and reload a tree that is behind, so
+changes made by other worker processes are seen by the next query. The
+process that made a change applies it to its own tree instead of reloading,
+as long as no other change came in between. Trees are also reloaded after
+TRIP_INDEX_TTL_SECONDS, and the rebuild_trip_index management command bumps
+an index-wide generation that makes every process drop all its trees.
+
+Counters are incremented with cache.incr, which is atomic on Redis; the
+file-based cache (single host) may lose a concurrent increment, which only
+delays the reload until the next change or the TTL.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .compatibility import to_epoch_microseconds
+from .models import Trip
+
+logger = logging.getLogger(__name__)
+
+GENERATION_CACHE_KEY = 'trip_interval_index:generation'
+# Minimum delay between two reads of a shared generation by one process, for
+# caches that can afford to lag behind other processes (similarity index,
+# chat memberships); the interval index checks on every query
+GENERATION_CHECK_SECONDS = 1.0
+
+
+def destination_generation_key(destination_id):
+    return f'trip_interval_index:destination:{destination_id}'
+
+
+# Pending changes are applied by a full rebuild once they exceed this many, or
+# 1/REBUILD_FRACTION of the tree, whichever is larger
+MIN_PENDING_BEFORE_REBUILD = 32
+REBUILD_FRACTION = 8
+
+
+class IntervalTree:
+    """
+    Interval tree over closed intervals [start, end].
+
+    Intervals are stored sorted by start; the implicit binary tree over that
+    array keeps the maximum end of every subtree, which lets queries skip
+    subtrees that cannot overlap. Mutations do not touch the arrays: inserted
+    intervals wait in a small pending list that queries scan linearly, and
+    removed ones are skipped. Once the pending changes outgrow
+    MIN_PENDING_BEFORE_REBUILD (or a fraction of the tree), the next query
+    rebuilds the arrays (O(n log n)) and applies them all at once.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._starts = []
+        self._ends = []
+        self._keys = []
+        self._max_end = []
+        self._built = set()
+        # Changes since the last rebuild: intervals to scan and built keys to skip
+        self._added = {}
+        self._removed = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def add(self, key, start, end, value=None):
+        """Insert or replace the interval stored under ``key``."""
+        self._entries[key] = (start, end, value)
+        self._added[key] = (start, end, value)
+        if key in self._built:
+            self._removed.add(key)
+
+    def remove(self, key):
+        """Remove the interval stored under ``key`` if present."""
+        if self._entries.pop(key, None) is None:
+            return
+        self._added.pop(key, None)
+        if key in self._built:
+            self._removed.add(key)
+
+    def _needs_rebuild(self):
+        pending = len(self._added) + len(self._removed)
+        return pending > max(MIN_PENDING_BEFORE_REBUILD, len(self._entries) // REBUILD_FRACTION)
+
+    def _rebuild(self):
+        items = sorted(self._entries.items(), key=lambda item: item[1][0])
+        self._keys = [key for key, _ in items]
+        self._starts = [entry[0] for _, entry in items]
+        self._ends = [entry[1] for _, entry in items]
+        self._max_end = [0] * len(items)
+        if items:
+            self._build(0, len(items))
+        self._built = set(self._keys)
+        self._added.clear()
+        self._removed.clear()
+
+    def _build(self, lo, hi):
+        mid = (lo + hi) // 2
+        max_end = self._ends[mid]
+        if lo < mid:
+            max_end = max(max_end, self._build(lo, mid))
+        if mid + 1 < hi:
+            max_end = max(max_end, self._build(mid + 1, hi))
+        self._max_end[mid] = max_end
+        return max_end
+
+    def overlapping(self, start, end):
+        """
+        Return [(key, start, end, value)] for intervals overlapping [start, end].
+        """
+        if self._needs_rebuild():
+            self._rebuild()
+
+        results = [
+            (key, entry_start, entry_end, value)
+            for key, (entry_start, entry_end, value) in self._added.items()
+            if entry_start <= end and entry_end >= start
+        ]
+        removed = self._removed
+        stack = [(0, len(self._keys))]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            # Nothing in this subtree ends late enough to overlap
+            if self._max_end[mid] < start:
+                continue
+            stack.append((lo, mid))
+            # Everything right of mid starts even later
+            if self._starts[mid] <= end:
+                key = self._keys[mid]
+                if self._ends[mid] >= start and key not in removed:
+                    results.append((key, self._starts[mid], self._ends[mid], self._entries[key][2]))
+                stack.append((mid + 1, hi))
+        return results
+
+
+class TripIntervalIndex:
+    """Per-destination interval trees over open trips."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trees = {}
+        self._loaded_at = {}
+        # Destination generation each tree was loaded at (or brought up to)
+        self._tree_generations = {}
+        self._trip_destinations = {}
+        self._generation = None
+
+    @staticmethod
+    def _is_indexed(trip):
+        return trip.status == 'open'
+
+    def _load(self, destination_id, destination_generation):
+        tree = IntervalTree()
+        trips = Trip.objects.filter(
+            destination_id=destination_id,
+            status='open'
+        ).values_list('id', 'user_id', 'start_date', 'end_date')
+        for trip_id, user_id, start_date, end_date in trips:
+            tree.add(trip_id, to_epoch_microseconds(start_date), to_epoch_microseconds(end_date), user_id)
+            self._trip_destinations[trip_id] = destination_id
+        self._trees[destination_id] = tree
+        self._loaded_at[destination_id] = time.monotonic()
+        self._tree_generations[destination_id] = destination_generation
+        return tree
+
+    def _drop(self, destination_id):
+        self._trees.pop(destination_id, None)
+        self._loaded_at.pop(destination_id, None)
+        self._tree_generations.pop(destination_id, None)
+
+    def _shared_generations(self, destination_id):
+        """
+        Read the index-wide and the destination's generation in one round trip.
+
+        A missing destination generation (new key, evicted or cleared cache)
+        is created with a fresh time-based value, so trees loaded before can
+        never match it.
+        """
+        cache = caches['shared']
+        key = destination_generation_key(destination_id)
+        values = cache.get_many([GENERATION_CACHE_KEY, key])
+        if key not in values:
+            cache.add(key, time.time_ns(), None)
+            values[key] = cache.get(key)
+        return values.get(GENERATION_CACHE_KEY), values[key]
+
+    def _tree_for(self, destination_id):
+        try:
+            generation, destination_generation = self._shared_generations(destination_id)
+        except Exception as e:
+            # Without the shared cache other processes' changes are invisible: query the database
+            logger.warning(f"Error reading the trip interval index generation: {str(e)}")
+            return self._load(destination_id, None)
+
+        if generation != self._generation:
+            self._generation = generation
+            self._trees.clear()
+            self._loaded_at.clear()
+            self._tree_generations.clear()
+            self._trip_destinations.clear()
+
+        tree = self._trees.get(destination_id)
+        if (
+            tree is None
+            or self._tree_generations[destination_id] != destination_generation
+            or time.monotonic() - self._loaded_at[destination_id] > settings.TRIP_INDEX_TTL_SECONDS
+        ):
+            tree = self._load(destination_id, destination_generation)
+        return tree
+
+    def overlapping(self, destination_id, start_date, end_date):
+        """
+        Return [(trip_id, user_id, start_epoch_us)] for open trips at the
+        destination whose dates overlap [start_date, end_date].
+        """
+        start = to_epoch_microseconds(start_date)
+        end = to_epoch_microseconds(end_date)
+        with self._lock:
+            tree = self._tree_for(destination_id)
+            return [
+                (trip_id, user_id, trip_start)
+                for trip_id, trip_start, _, user_id in tree.overlapping(start, end)
+            ]
+
+    def _bump(self, destination_id):
+        """Increment a destination's shared generation; the new value, or None if the cache failed."""
+        cache = caches['shared']
+        key = destination_generation_key(destination_id)
+        try:
+            cache.add(key, time.time_ns(), None)
+            return cache.incr(key)
+        except Exception as e:
+            logger.warning(f"Error publishing a change of destination {destination_id}: {str(e)}")
+            return None
+
+    def _apply(self, destination_id, generation, change):
+        # Apply this process's own change to a loaded tree if nobody else changed
+        # the destination since the tree was loaded; otherwise reload it on next use
+        tree = self._trees.get(destination_id)
+        if tree is None:
+            return
+        known = self._tree_generations.get(destination_id)
+        if generation is None or known is None or generation != known + 1:
+            self._drop(destination_id)
+            return
+        change(tree)
+        self._tree_generations[destination_id] = generation
+
+    def update_trip(self, trip, previous_destination_id=None):
+        """
+        Publish a committed save of a trip and apply it to this process's trees.
+
+        Args:
+            trip: The saved trip
+            previous_destination_id: Its destination before the save, if it moved
+        """
+        destination_ids = {trip.destination_id, previous_destination_id} - {None}
+        generations = {destination_id: self._bump(destination_id) for destination_id in destination_ids}
+        with self._lock:
+            previous = self._trip_destinations.pop(trip.id, None)
+            for destination_id in {previous} - {None} - destination_ids:
+                # Moved away from a destination this process knew it at but the caller did not
+                self._drop(destination_id)
+            for destination_id, generation in generations.items():
+                def change(tree, destination_id=destination_id):
+                    tree.remove(trip.id)
+                    if destination_id == trip.destination_id and self._is_indexed(trip):
+                        tree.add(
+                            trip.id,
+                            to_epoch_microseconds(trip.start_date),
+                            to_epoch_microseconds(trip.end_date),
+                            trip.user_id
+                        )
+                        self._trip_destinations[trip.id] = destination_id
+                self._apply(destination_id, generation, change)
+
+    def remove_trip(self, trip_id, destination_id):
+        """Publish a committed delete of a trip and drop it from this process's trees."""
+        generation = self._bump(destination_id)
+        with self._lock:
+            self._trip_destinations.pop(trip_id, None)
+            self._apply(destination_id, generation, lambda tree: tree.remove(trip_id))
+
+    def rebuild(self, destination_ids=None):
+        """
+        Reload the given destinations (or every destination with open trips)
+        from the database.
+
+        Returns:
+            dict: {destination_id: number of indexed trips}
+        """
+        if destination_ids is None:
+            destination_ids = Trip.objects.filter(status='open').values_list('destination_id', flat=True).order_by().distinct()
+        with self._lock:
+            counts = {}
+            for destination_id in destination_ids:
+                self._drop(destination_id)
+                counts[destination_id] = len(self._tree_for(destination_id))
+            return counts
+
+    def invalidate_all_processes(self):
+        """Bump the shared generation so every process reloads its trees."""
+        caches['shared'].set(GENERATION_CACHE_KEY, time.time_ns(), None)
+
+
+trip_interval_index = TripIntervalIndex()
@@ -0,0 +1,36 @@
+"""
+ASGI lifespan handler.
+
+Channels' ProtocolTypeRouter does not handle lifespan events itself; this
+app leases the worker's snowflake id on startup (see snowflake.py) and, on
+shutdown, drains work that is still held in memory before the worker exits.
+"""
+import logging
+
+from channels.db import database_sync_to_async
+
+from .chat_persistence import chat_write_behind
+from .snowflake import prepare_generator
+
+logger = logging.getLogger(__name__)
+
+
+async def lifespan_application(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await database_sync_to_async(prepare_generator)()
+            except Exception as e:
+                # Retried when the first chat message needs an id
+                logger.warning(f"Error leasing a snowflake worker id on startup: {str(e)}")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            try:
+                await chat_write_behind.stop()
+            except Exception as e:
+                logger.error(f"Error draining chat messages on shutdown: {str(e)}")
+                await send({'type': 'lifespan.shutdown.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from auth_app.chat_archive import archivable_trips, archive_trip
+
+
+class Command(BaseCommand):
+    help = (
+        'Move the chat messages of trips that ended or were cancelled more than --days days ago '
+        'into compressed archive segments (read through by the trip chat endpoint)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 90),
+            help='Archive trips finished more than this many days ago (default CHAT_ARCHIVE_AFTER_DAYS)'
+        )
+        parser.add_argument('--block-size', type=int, default=None,
+                            help='Messages per compressed block (default CHAT_ARCHIVE_BLOCK_SIZE)')
+        parser.add_argument('--limit', type=int, default=None, help='Archive at most this many trips')
+        parser.add_argument('--dry-run', action='store_true', help='Only list the trips that would be archived')
+
+    def handle(self, *args, **options):
+        trip_ids = list(archivable_trips(options['days']).values_list('id', flat=True)[:options['limit']])
+        if options['dry_run']:
+            self.stdout.write(f'{len(trip_ids)} trips would be archived: {trip_ids}')
+            return
+
+        messages = 0
+        compressed_bytes = 0
+        for trip_id in trip_ids:
+            segment = archive_trip(trip_id, options['block_size'])
+            if segment is None:
+                continue
+            messages += segment.message_count
+            compressed_bytes += segment.compressed_bytes
+            self.stdout.write(f'Trip {trip_id}: {segment.message_count} messages, {segment.compressed_bytes} bytes')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {messages} messages of {len(trip_ids)} trips into {compressed_bytes} compressed bytes'
+        ))
@@ -0,0 +1,306 @@
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import AccessToken
+
+from auth_app import views
+from auth_app.compatibility_store import rebuild_destination
+from auth_app.interval_index import trip_interval_index
+from auth_app.models import PreferredDestination, TravelInterest, Trip, UserPreferences, UserProfile
+from auth_app.score_cache import score_cache
+
+DEFAULT_SIZES = ['200:100', '1000:500', '4000:2000']
+
+
+def parse_size(value):
+    """Parse a USERS:TRIPS_PER_DESTINATION dataset size."""
+    try:
+        users, trips_per_destination = (int(part) for part in value.split(':'))
+    except ValueError:
+        raise CommandError(f'Invalid size "{value}", expected USERS:TRIPS_PER_DESTINATION')
+    if users < 2 or trips_per_destination < 1:
+        raise CommandError(f'Invalid size "{value}", need at least 2 users and 1 trip per destination')
+    return users, trips_per_destination
+
+
+class SyntheticDataset:
+    """
+    Seeded generator of users, interests, preferences and trips.
+
+    Interest popularity follows a Zipf-like distribution controlled by
+    ``interest_skew`` and a ``preference_rate`` fraction of users have
+    UserPreferences. Rows are inserted with bulk_create so that no signals
+    run while seeding; the derived indexes are rebuilt afterwards.
+    """
+
+    def __init__(self, seed, users, destinations, trips_per_destination, interests,
+                 activities_per_trip, preference_rate, interest_skew):
+        self.rng = random.Random(seed)
+        self.prefix = f'bench-{seed}-{time.time_ns()}'
+        self.user_count = users
+        self.destination_count = destinations
+        self.trips_per_destination = trips_per_destination
+        self.interest_count = interests
+        self.activities_per_trip = activities_per_trip
+        self.preference_rate = preference_rate
+        self.interest_weights = [1 / (rank + 1) ** interest_skew for rank in range(interests)]
+
+    def _pick_activities(self, interests):
+        count = self.rng.randint(1, self.activities_per_trip)
+        picked = set()
+        while len(picked) < min(count, len(interests)):
+            picked.add(self.rng.choices(interests, weights=self.interest_weights)[0].id)
+        return sorted(picked)
+
+    def create(self):
+        """
+        Insert the dataset.
+
+        Returns:
+            tuple: (list of destinations, list of trips)
+        """
+        interests = TravelInterest.objects.bulk_create([
+            TravelInterest(name=f'{self.prefix}-interest-{i}') for i in range(self.interest_count)
+        ])
+        destinations = PreferredDestination.objects.bulk_create([
+            PreferredDestination(name=f'{self.prefix}-destination-{i}') for i in range(self.destination_count)
+        ])
+        users = UserProfile.objects.bulk_create([
+            UserProfile(
+                username=f'{self.prefix}-user-{i}',
+                email=f'{self.prefix}-user-{i}@example.com',
+                password='!'
+            )
+            for i in range(self.user_count)
+        ])
+
+        frequencies = [choice for choice, _ in UserPreferences.TRAVEL_FREQUENCY_CHOICES]
+        budgets = [choice for choice, _ in UserPreferences.TRAVEL_BUDGET_CHOICES]
+        UserPreferences.objects.bulk_create([
+            UserPreferences(
+                user=user,
+                travel_frequency=self.rng.choice(frequencies),
+                travel_budget=self.rng.choice(budgets)
+            )
+            for user in users
+            if self.rng.random() < self.preference_rate
+        ])
+
+        now = timezone.now()
+        trips = []
+        for destination in destinations:
+            for _ in range(self.trips_per_destination):
+                start_date = now + timedelta(days=self.rng.randint(1, 120), hours=self.rng.randint(0, 23))
+                activity_ids = self._pick_activities(interests)
+                trips.append(Trip(
+                    user=self.rng.choice(users),
+                    destination=destination,
+                    start_date=start_date,
+                    end_date=start_date + timedelta(days=self.rng.randint(1, 14)),
+                    max_members=self.rng.randint(2, 8),
+                    status='open',
+                    activity_ids=activity_ids,
+                    activity_mask=Trip.activity_mask_for(activity_ids)
+                ))
+        trips = Trip.objects.bulk_create(trips, batch_size=1000)
+
+        Trip.activities.through.objects.bulk_create([
+            Trip.activities.through(trip_id=trip.id, travelinterest_id=activity_id)
+            for trip in trips
+            for activity_id in trip.activity_ids
+        ], batch_size=5000)
+
+        destination_ids = [destination.id for destination in destinations]
+        for destination_id in destination_ids:
+            rebuild_destination(destination_id)
+        trip_interval_index.rebuild(destination_ids)
+        return destinations, trips
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark find_travel_buddies, get_compatible_trips and CompatibleTripsView '
+        'on seeded synthetic datasets and write the results as JSON. Every dataset is '
+        'created inside a transaction that is rolled back afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size',
+            action='append',
+            dest='sizes',
+            help='Dataset size as USERS:TRIPS_PER_DESTINATION (can be repeated; default: %s)' % ' '.join(DEFAULT_SIZES)
+        )
+        parser.add_argument('--destinations', type=int, default=4, help='Number of destinations')
+        parser.add_argument('--interests', type=int, default=60, help='Number of travel interests')
+        parser.add_argument('--activities-per-trip', type=int, default=6, help='Maximum activities per trip')
+        parser.add_argument('--preference-rate', type=float, default=0.8,
+                            help='Fraction of users with travel preferences')
+        parser.add_argument('--interest-skew', type=float, default=1.0,
+                            help='Zipf exponent of interest popularity (0 = uniform)')
+        parser.add_argument('--samples', type=int, default=10, help='Reference trips queried per dataset')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs per reference trip')
+        parser.add_argument('--keep-cache', action='store_true',
+                            help='Do not clear the pairwise score cache before each run')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed')
+        parser.add_argument('--output', default='benchmark_matching.json', help='Path of the JSON results file')
+
+    def handle(self, *args, **options):
+        sizes = [parse_size(size) for size in options['sizes'] or DEFAULT_SIZES]
+        self.factory = APIRequestFactory()
+        self.options = options
+
+        results = []
+        for users, trips_per_destination in sizes:
+            self.stdout.write(f'Dataset: {users} users, {trips_per_destination} trips per destination')
+            with transaction.atomic():
+                dataset = SyntheticDataset(
+                    options['seed'], users, options['destinations'], trips_per_destination,
+                    options['interests'], options['activities_per_trip'],
+                    options['preference_rate'], options['interest_skew']
+                )
+                destinations, trips = dataset.create()
+                references = random.Random(options['seed']).sample(trips, min(options['samples'], len(trips)))
+
+                for endpoint, call in self.endpoints():
+                    result = self.measure(call, references)
+                    result.update({
+                        'endpoint': endpoint,
+                        'users': users,
+                        'trips_per_destination': trips_per_destination,
+                        'total_trips': len(trips)
+                    })
+                    results.append(result)
+                    self.stdout.write(
+                        f"  {endpoint}: median {result['wall_ms']['median']} ms, "
+                        f"p95 {result['wall_ms']['p95']} ms, {result['queries']['median']} queries, "
+                        f"peak {result['peak_memory_kb']} KiB"
+                    )
+
+                transaction.set_rollback(True)
+
+            # Drop index and cache entries of the rolled back dataset
+            trip_interval_index.rebuild([destination.id for destination in destinations])
+            score_cache.clear()
+
+        with open(options['output'], 'w') as f:
+            json.dump({'meta': self.metadata(), 'results': results}, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {len(results)} results to {options["output"]}'))
+
+    def endpoints(self):
+        return [
+            ('find_travel_buddies', self.call_find_travel_buddies),
+            ('get_compatible_trips', self.call_get_compatible_trips),
+            ('CompatibleTripsView.post', self.call_compatible_trips_view),
+        ]
+
+    def call_find_travel_buddies(self, trip):
+        request = self.factory.post('/api/find-travel-buddies/', {
+            'trip_id': trip.id,
+            'destination': trip.destination_id,
+            'start_date': trip.start_date.isoformat(),
+            'end_date': trip.end_date.isoformat()
+        }, format='json', HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(trip.user)}')
+        return views.find_travel_buddies(request)
+
+    def call_get_compatible_trips(self, trip):
+        request = self.factory.post('/api/compatible-trips/', {
+            'destinationId': trip.destination_id,
+            'startDate': trip.start_date.isoformat(),
+            'endDate': trip.end_date.isoformat()
+        }, format='json')
+        force_authenticate(request, user=trip.user)
+        return views.get_compatible_trips(request)
+
+    def call_compatible_trips_view(self, trip):
+        request = self.factory.post('/api/compatible-trips/', {
+            'destinationId': trip.destination_id,
+            'activities': trip.activity_ids,
+            'startDate': trip.start_date.isoformat(),
+            'endDate': trip.end_date.isoformat()
+        }, format='json')
+        force_authenticate(request, user=trip.user)
+        return views.CompatibleTripsView.as_view()(request)
+
+    def run_once(self, call, trip):
+        if not self.options['keep_cache']:
+            score_cache.clear()
+        response = call(trip)
+        if hasattr(response, 'render'):
+            response.render()
+        if response.status_code != 200:
+            raise CommandError(f'Request for trip {trip.id} failed with status {response.status_code}')
+
+    def measure(self, call, references):
+        """
+        Time ``call`` for every reference trip.
+
+        Wall time and query counts come from untraced runs; peak memory comes
+        from one separate run per reference under tracemalloc, which would
+        otherwise distort the timings.
+        """
+        timings = []
+        query_counts = []
+        for trip in references:
+            for _ in range(self.options['repeat']):
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    self.run_once(call, trip)
+                    timings.append((time.perf_counter() - started) * 1000)
+                query_counts.append(len(queries))
+
+        peak = 0
+        for trip in references:
+            tracemalloc.start()
+            try:
+                self.run_once(call, trip)
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+
+        timings.sort()
+        return {
+            'runs': len(timings),
+            'wall_ms': {
+                'min': round(timings[0], 3),
+                'median': round(statistics.median(timings), 3),
+                'p95': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+                'max': round(timings[-1], 3)
+            },
+            'queries': {
+                'median': statistics.median(query_counts),
+                'max': max(query_counts)
+            },
+            'peak_memory_kb': round(peak / 1024, 1)
+        }
+
+    def metadata(self):
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+
+        options = {key: value for key, value in self.options.items() if key in (
+            'sizes', 'destinations', 'interests', 'activities_per_trip', 'preference_rate',
+            'interest_skew', 'samples', 'repeat', 'keep_cache', 'seed'
+        )}
+        return {
+            'commit': commit,
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'options': options
+        }
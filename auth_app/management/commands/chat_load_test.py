@@ -0,0 +1,320 @@
+import asyncio
+import json
+import platform
+import random
+import time
+from collections import Counter
+from datetime import timedelta
+
+import websockets
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from auth_app.models import PreferredDestination, Trip, UserProfile
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Prefix of the message texts sent by the load generator: "<tag>:<trip id>:<perf_counter_ns>"
+MESSAGE_TAG = 'chat-load'
+
+
+def percentiles(values):
+    """Summary of a list of millisecond timings."""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(fraction):
+        return round(values[min(len(values) - 1, int(len(values) * fraction))], 3)
+
+    return {
+        'count': len(values),
+        'min': round(values[0], 3),
+        'p50': at(0.5),
+        'p90': at(0.9),
+        'p99': at(0.99),
+        'max': round(values[-1], 3)
+    }
+
+
+class SeededChats:
+    """
+    Users and trips the load generator connects as.
+
+    Every trip gets ``users_per_trip`` users: the first one creates it, the
+    others are members. Rows are named after the seed so that a second run
+    with the same seed reuses them; they are committed (the server runs in
+    another process) and removed by cleanup().
+    """
+
+    def __init__(self, seed, trips, users_per_trip):
+        self.prefix = f'chatload-{seed}'
+        self.trip_count = trips
+        self.users_per_trip = users_per_trip
+
+    def create(self):
+        """
+        Returns:
+            list: (trip id, [users]) for every seeded trip
+        """
+        destination, _ = PreferredDestination.objects.get_or_create(name=f'{self.prefix}-destination')
+        usernames = [f'{self.prefix}-user-{i}' for i in range(self.trip_count * self.users_per_trip)]
+        existing = set(UserProfile.objects.filter(username__in=usernames).values_list('username', flat=True))
+        UserProfile.objects.bulk_create([
+            UserProfile(username=username, email=f'{username}@example.com', password='!')
+            for username in usernames if username not in existing
+        ], batch_size=1000)
+        users_by_name = UserProfile.objects.filter(username__in=usernames).in_bulk(field_name='username')
+        users = [users_by_name[username] for username in usernames]
+
+        existing_trips = list(Trip.objects.filter(destination=destination).order_by('id'))
+        start_date = timezone.now() + timedelta(days=30)
+        new_trips = Trip.objects.bulk_create([
+            Trip(
+                user=users[i * self.users_per_trip],
+                destination=destination,
+                start_date=start_date,
+                end_date=start_date + timedelta(days=7),
+                max_members=self.users_per_trip,
+                status='open'
+            )
+            for i in range(len(existing_trips), self.trip_count)
+        ])
+        trips = (existing_trips + new_trips)[:self.trip_count]
+
+        rooms = []
+        memberships = []
+        for i, trip in enumerate(trips):
+            trip_users = users[i * self.users_per_trip:(i + 1) * self.users_per_trip]
+            memberships.extend(
+                Trip.members.through(trip_id=trip.id, userprofile_id=user.id) for user in trip_users[1:]
+            )
+            rooms.append((trip.id, trip_users))
+        Trip.members.through.objects.bulk_create(memberships, ignore_conflicts=True, batch_size=5000)
+        return rooms
+
+    def cleanup(self):
+        """Delete the seeded users, trips and destination (their messages cascade)."""
+        Trip.objects.filter(destination__name=f'{self.prefix}-destination').delete()
+        PreferredDestination.objects.filter(name=f'{self.prefix}-destination').delete()
+        UserProfile.objects.filter(username__startswith=f'{self.prefix}-user-').delete()
+
+
+class LoadRun:
+    """Sockets, sender and measurements of one load test."""
+
+    def __init__(self, options, rooms):
+        self.options = options
+        self.rooms = rooms
+        self.sockets = []
+        self.sockets_per_trip = Counter()
+        self.connect_ms = []
+        self.latency_ms = []
+        self.errors = Counter()
+        self.sent = Counter()
+        self.received = 0
+        self.readers = []
+        self.closing = False
+
+    def url(self, trip_id, user):
+        return f"{self.options['url'].rstrip('/')}/ws/chat/{trip_id}/?token={AccessToken.for_user(user)}&history=0"
+
+    async def open_socket(self, trip_id, user, semaphore):
+        async with semaphore:
+            url = self.url(trip_id, user)
+            started = time.perf_counter()
+            try:
+                socket = await websockets.connect(
+                    url,
+                    open_timeout=self.options['connect_timeout'],
+                    ping_interval=None,
+                    max_size=None,
+                    compression='deflate' if self.options['deflate'] else None,
+                    subprotocols=[self.options['subprotocol']] if self.options['subprotocol'] else None
+                )
+            except Exception as e:
+                self.errors[f'connect: {type(e).__name__}'] += 1
+                return
+            self.connect_ms.append((time.perf_counter() - started) * 1000)
+            self.sockets.append((trip_id, socket))
+            self.sockets_per_trip[trip_id] += 1
+            self.readers.append(asyncio.create_task(self.read(socket)))
+
+    @staticmethod
+    def message_text(frame):
+        if isinstance(frame, bytes):
+            payload = msgpack.unpackb(frame)
+        else:
+            payload = json.loads(frame)
+        if not isinstance(payload, dict):
+            return None
+        if payload.get('type') == 'error':
+            return payload
+        return payload.get('message', payload.get('m'))
+
+    async def read(self, socket):
+        try:
+            async for frame in socket:
+                received_at = time.perf_counter_ns()
+                text = self.message_text(frame)
+                if isinstance(text, dict):
+                    self.errors[f"server: {text.get('code')}"] += 1
+                elif isinstance(text, str) and text.startswith(MESSAGE_TAG + ':'):
+                    sent_at = int(text.split(':')[2])
+                    self.latency_ms.append((received_at - sent_at) / 1e6)
+                    self.received += 1
+        except websockets.ConnectionClosed as e:
+            if not self.closing:
+                self.errors[f'closed: {e.code}'] += 1
+        except Exception as e:
+            self.errors[f'read: {type(e).__name__}'] += 1
+
+    async def send_messages(self):
+        """Send messages from random sockets at the configured total rate."""
+        rng = random.Random(self.options['seed'])
+        interval = 1 / self.options['rate']
+        deadline = time.perf_counter() + self.options['duration']
+        next_send = time.perf_counter()
+        while time.perf_counter() < deadline and self.sockets:
+            trip_id, socket = rng.choice(self.sockets)
+            text = f'{MESSAGE_TAG}:{trip_id}:{time.perf_counter_ns()}'
+            try:
+                await socket.send(json.dumps({'message': text}))
+                self.sent[trip_id] += 1
+            except Exception as e:
+                self.errors[f'send: {type(e).__name__}'] += 1
+
+            next_send += interval
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.options['connect_concurrency'])
+        targets = [
+            (trip_id, user)
+            for trip_id, users in self.rooms
+            for user in users
+            for _ in range(self.options['sockets_per_user'])
+        ]
+
+        ramp_started = time.perf_counter()
+        await asyncio.gather(*(self.open_socket(trip_id, user, semaphore) for trip_id, user in targets))
+        ramp_seconds = time.perf_counter() - ramp_started
+
+        send_started = time.perf_counter()
+        await self.send_messages()
+        send_seconds = time.perf_counter() - send_started
+        # Let the last messages arrive
+        await asyncio.sleep(self.options['drain'])
+
+        self.closing = True
+        await asyncio.gather(*(socket.close() for _, socket in self.sockets), return_exceptions=True)
+        for reader in self.readers:
+            reader.cancel()
+
+        expected = sum(count * self.sockets_per_trip[trip_id] for trip_id, count in self.sent.items())
+        sent = sum(self.sent.values())
+        return {
+            'sockets': {'requested': len(targets), 'open': len(self.sockets), 'ramp_seconds': round(ramp_seconds, 3)},
+            'connect_ms': percentiles(self.connect_ms),
+            'delivery_latency_ms': percentiles(self.latency_ms),
+            'messages': {
+                'sent': sent,
+                'sent_per_second': round(sent / send_seconds, 1) if send_seconds else 0,
+                'expected_deliveries': expected,
+                'delivered': self.received,
+                'delivered_per_second': round(self.received / (send_seconds + self.options['drain']), 1),
+                'delivery_ratio': round(self.received / expected, 4) if expected else None
+            },
+            'errors': dict(self.errors)
+        }
+
+
+class Command(BaseCommand):
+    help = (
+        'Open many authenticated chat WebSockets against a running server, send messages '
+        'at a fixed rate and report connect time, end-to-end delivery latency, throughput '
+        'and errors as JSON. Seeds users and trips named after --seed (reused by later runs).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='ws://localhost:8001', help='Base WebSocket URL of the server')
+        parser.add_argument('--trips', type=int, default=100, help='Number of trip chat rooms')
+        parser.add_argument('--users-per-trip', type=int, default=10, help='Users (creator + members) per trip')
+        parser.add_argument('--sockets-per-user', type=int, default=1, help='Sockets opened by every user')
+        parser.add_argument('--rate', type=float, default=50, help='Messages sent per second over all sockets')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to send messages for')
+        parser.add_argument('--drain', type=float, default=2, help='Seconds to wait for deliveries after sending')
+        parser.add_argument('--connect-concurrency', type=int, default=200,
+                            help='Maximum WebSocket handshakes in flight')
+        parser.add_argument('--connect-timeout', type=float, default=10, help='Handshake timeout in seconds')
+        parser.add_argument('--subprotocol', default=None,
+                            help='Wire format subprotocol to request, e.g. travelbuddy.chat.json-min.v1')
+        parser.add_argument('--deflate', action='store_true', help='Offer permessage-deflate')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed and name of the seeded data')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the seeded users and trips afterwards')
+        parser.add_argument('--output', default='chat_load_test.json', help='Path of the JSON results file')
+
+    def handle(self, *args, **options):
+        if options['rate'] <= 0 or options['trips'] < 1 or options['users_per_trip'] < 1:
+            raise CommandError('--rate, --trips and --users-per-trip must be positive')
+        if options['subprotocol'] and 'msgpack' in options['subprotocol'] and msgpack is None:
+            raise CommandError('The msgpack subprotocol needs the msgpack package')
+        self.raise_open_file_limit()
+
+        seeded = SeededChats(options['seed'], options['trips'], options['users_per_trip'])
+        rooms = seeded.create()
+        sockets = options['trips'] * options['users_per_trip'] * options['sockets_per_user']
+        self.stdout.write(f'Opening {sockets} sockets over {len(rooms)} trips against {options["url"]}')
+
+        try:
+            result = asyncio.run(LoadRun(options, rooms).run())
+        finally:
+            if options['cleanup']:
+                seeded.cleanup()
+
+        self.stdout.write(
+            f"  open sockets: {result['sockets']['open']}/{result['sockets']['requested']} "
+            f"in {result['sockets']['ramp_seconds']} s"
+        )
+        for name in ('connect_ms', 'delivery_latency_ms'):
+            summary = result[name]
+            if summary:
+                self.stdout.write(f"  {name}: p50 {summary['p50']}, p90 {summary['p90']}, p99 {summary['p99']}, max {summary['max']}")
+        messages = result['messages']
+        self.stdout.write(
+            f"  sent {messages['sent']} ({messages['sent_per_second']}/s), delivered {messages['delivered']} "
+            f"of {messages['expected_deliveries']} ({messages['delivered_per_second']}/s)"
+        )
+        if result['errors']:
+            self.stdout.write(self.style.WARNING(f"  errors: {result['errors']}"))
+
+        meta = {
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'options': {key: value for key, value in options.items() if key in (
+                'url', 'trips', 'users_per_trip', 'sockets_per_user', 'rate', 'duration', 'drain',
+                'connect_concurrency', 'subprotocol', 'deflate', 'seed'
+            )}
+        }
+        with open(options['output'], 'w') as f:
+            json.dump({'meta': meta, 'result': result}, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Wrote results to {options["output"]}'))
+
+    def raise_open_file_limit(self):
+        """Every socket needs a file descriptor; lift the soft limit as far as allowed."""
+        try:
+            import resource
+        except ImportError:
+            return
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+            except (ValueError, OSError):
+                pass
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from auth_app.similarity_index import similar_trip_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the MinHash/LSH index of open trips used by the similar trips endpoint'
+
+    def handle(self, *args, **options):
+        count = similar_trip_index.rebuild()
+
+        # Tell running server processes to drop their in-memory index
+        similar_trip_index.invalidate_all_processes()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt similarity index with {count} open trips'))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from auth_app.compatibility_store import ACTIVE_STATUSES, rebuild_destination
+from auth_app.models import Trip
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the materialized TripCompatibility table'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--destination',
+            type=int,
+            action='append',
+            dest='destinations',
+            help='Only rebuild pairs for this destination id (can be repeated)'
+        )
+
+    def handle(self, *args, **options):
+        destination_ids = options['destinations']
+        if not destination_ids:
+            destination_ids = Trip.objects.filter(
+                status__in=ACTIVE_STATUSES
+            ).values_list('destination_id', flat=True).order_by().distinct()
+
+        total = 0
+        for destination_id in destination_ids:
+            count = rebuild_destination(destination_id)
+            total += count
+            self.stdout.write(f'Destination {destination_id}: {count} pairs stored')
+
+        self.stdout.write(self.style.SUCCESS(f'Stored {total} compatibility pairs'))
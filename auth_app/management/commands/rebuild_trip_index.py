@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from auth_app.interval_index import trip_interval_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-destination interval index of open trips used by find_travel_buddies'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--destination',
+            type=int,
+            action='append',
+            dest='destinations',
+            help='Only rebuild the index for this destination id (can be repeated)'
+        )
+
+    def handle(self, *args, **options):
+        counts = trip_interval_index.rebuild(options['destinations'])
+        for destination_id, count in sorted(counts.items()):
+            self.stdout.write(f'Destination {destination_id}: {count} open trips indexed')
+
+        # Tell running server processes to drop their in-memory trees
+        trip_interval_index.invalidate_all_processes()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt interval index for {len(counts)} destinations'))
@@ -0,0 +1,171 @@
+"""
+Per-process cache of who may join a trip's chat.
+
+ChatConsumer checks membership on every WebSocket connect. After a deploy
+or a network blip every client reconnects at once, and without a cache each
+socket would query the trip and its members. Entries map a trip id to its
+creator and member ids and are shared by all sockets of the process:
+
+- in the process that makes a change, the signals in signals.py drop the
+  entry right away (members added or removed, creator or status changed,
+  trip deleted) and bump a generation in the 'shared' cache;
+- every other process notices the new generation within
+  GENERATION_CHECK_SECONDS and drops all of its entries;
+- entries also expire after CHAT_MEMBERSHIP_CACHE_TTL_SECONDS, a backstop
+  for a shared cache that is unavailable.
+
+Lookups of cached trips never leave the event loop; misses, and the
+generation check once per GENERATION_CHECK_SECONDS, run on the database
+thread, where concurrent misses for the same trip are serialized and only
+the first one queries.
+
+Membership is checked when a socket connects (or subscribes to a trip).
+Afterwards, sockets react to the ``trip_membership`` push sent when a user
+leaves a trip, or to every socket of a trip's chat when it is cancelled (see
+user_push.py), and stop following its chat. The history of a cancelled
+trip's chat stays readable over REST.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .interval_index import GENERATION_CHECK_SECONDS
+from .models import Trip
+
+logger = logging.getLogger(__name__)
+
+GENERATION_CACHE_KEY = 'chat_membership:generation'
+
+# Expired entries are pruned once the cache grows beyond this many trips
+PRUNE_THRESHOLD = 10000
+
+
+class TripMembership:
+    """Creator and member ids of one trip; the chat of a cancelled trip admits nobody."""
+
+    __slots__ = ('creator_id', 'member_ids', 'cancelled')
+
+    def __init__(self, creator_id, member_ids, cancelled=False):
+        self.creator_id = creator_id
+        self.member_ids = frozenset(member_ids)
+        self.cancelled = cancelled
+
+    def allows(self, user_id):
+        if self.cancelled:
+            return False
+        return user_id == self.creator_id or user_id in self.member_ids
+
+
+class TripMembershipCache:
+    """TTL cache of trip id -> TripMembership (None for missing trips)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generation = None
+        self._generation_checked_at = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'CHAT_MEMBERSHIP_CACHE_TTL_SECONDS', 60)
+
+    def get(self, trip_id):
+        """
+        Return the cached membership of a trip without touching the database.
+
+        Returns:
+            tuple: (found, TripMembership or None if the trip does not exist)
+        """
+        now = time.monotonic()
+        if self._generation_checked_at is None or now - self._generation_checked_at >= GENERATION_CHECK_SECONDS:
+            # Due for a generation check, which load() does off the event loop
+            return False, None
+        entry = self._entries.get(trip_id)
+        if entry is None or now - entry[0] > self.ttl:
+            return False, None
+        self.hits += 1
+        return True, entry[1]
+
+    def load(self, trip_id):
+        """Return the membership of a trip, querying the database on a miss."""
+        with self._lock:
+            self._check_generation()
+            found, membership = self.get(trip_id)
+            if found:
+                return membership
+
+            self.misses += 1
+            trip = Trip.objects.filter(id=trip_id).values_list('user_id', 'status').first()
+            if trip is None:
+                membership = None
+            else:
+                membership = TripMembership(
+                    trip[0],
+                    Trip.members.through.objects.filter(trip_id=trip_id).values_list('userprofile_id', flat=True),
+                    cancelled=trip[1] == 'cancelled'
+                )
+
+            if len(self._entries) > PRUNE_THRESHOLD:
+                self._prune()
+            self._entries[trip_id] = (time.monotonic(), membership)
+            return membership
+
+    def is_member(self, trip_id, user_id):
+        """Whether the user created or joined the trip."""
+        membership = self.load(trip_id)
+        return membership is not None and membership.allows(user_id)
+
+    def _prune(self):
+        now = time.monotonic()
+        ttl = self.ttl
+        for trip_id in [trip_id for trip_id, entry in self._entries.items() if now - entry[0] > ttl]:
+            del self._entries[trip_id]
+
+    def _check_generation(self):
+        now = time.monotonic()
+        if self._generation_checked_at is not None and now - self._generation_checked_at < GENERATION_CHECK_SECONDS:
+            return
+        try:
+            generation = caches['shared'].get(GENERATION_CACHE_KEY)
+        except Exception as e:
+            logger.warning(f"Error reading the chat membership generation: {str(e)}")
+            generation = self._generation
+        if generation != self._generation:
+            self._generation = generation
+            self._entries.clear()
+        self._generation_checked_at = now
+
+    def _bump_generation(self):
+        generation = time.time_ns()
+        try:
+            caches['shared'].set(GENERATION_CACHE_KEY, generation, None)
+            # This process already dropped what changed
+            self._generation = generation
+        except Exception as e:
+            logger.warning(f"Error publishing a chat membership change: {str(e)}")
+
+    def invalidate(self, trip_ids):
+        """Drop trips here and make every other process drop its entries."""
+        for trip_id in trip_ids:
+            self._entries.pop(trip_id, None)
+        self._bump_generation()
+
+    def invalidate_local(self, trip_ids):
+        """Drop trips from this process only."""
+        for trip_id in trip_ids:
+            self._entries.pop(trip_id, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._bump_generation()
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+trip_membership_cache = TripMembershipCache()
@@ -0,0 +1,36 @@
+# Generated by Django 5.0.2 on 2026-10-17 17:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth_app', '0014_trip_is_cancelled'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TripCompatibility',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(help_text='Weighted compatibility score (0-100)')),
+                ('date_score', models.FloatField(help_text='Date overlap score (0-100)')),
+                ('activities_score', models.FloatField(help_text='Shared activities score (0-100)')),
+                ('preferences_score', models.FloatField(help_text='Matching preference points (0-20)')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('other_trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='auth_app.trip')),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='compatibilities', to='auth_app.trip')),
+            ],
+            options={
+                'verbose_name': 'Trip Compatibility',
+                'verbose_name_plural': 'Trip Compatibilities',
+                'indexes': [models.Index(fields=['trip', '-score'], name='trip_compat_score_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='tripcompatibility',
+            constraint=models.UniqueConstraint(fields=('trip', 'other_trip'), name='unique_trip_compatibility'),
+        ),
+    ]
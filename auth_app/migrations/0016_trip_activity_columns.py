@@ -0,0 +1,41 @@
+# Generated by Django 5.0.2 on 2026-10-17 17:31
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+ACTIVITY_MASK_BITS = 63
+
+
+def backfill_activity_columns(apps, schema_editor):
+    Trip = apps.get_model('auth_app', 'Trip')
+    activities = defaultdict(list)
+    for trip_id, interest_id in Trip.activities.through.objects.values_list('trip_id', 'travelinterest_id'):
+        activities[trip_id].append(interest_id)
+
+    for trip_id, interest_ids in activities.items():
+        mask = 0
+        for interest_id in interest_ids:
+            mask |= 1 << ((interest_id - 1) % ACTIVITY_MASK_BITS)
+        Trip.objects.filter(pk=trip_id).update(activity_ids=sorted(interest_ids), activity_mask=mask)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth_app', '0015_tripcompatibility'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='activity_ids',
+            field=models.JSONField(blank=True, default=list, help_text="Sorted TravelInterest ids of this trip's activities"),
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='activity_mask',
+            field=models.BigIntegerField(default=0, help_text='Activities folded into a 63-bit mask (exact for interest ids 1-63)'),
+        ),
+        migrations.RunPython(backfill_activity_columns, migrations.RunPython.noop),
+    ]
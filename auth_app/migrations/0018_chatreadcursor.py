@@ -0,0 +1,93 @@
+# Generated by Django 5.0.2 on 2026-10-17 17:50
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max, Min
+
+
+def create_read_cursors(apps, schema_editor):
+    """
+    Create a cursor for every trip creator and member, derived from their
+    ChatNotification rows: the cursor is read up to just before the oldest
+    unread notification and cleared up to just before the oldest remaining
+    notification. Without notifications, everything counts as read and cleared.
+    """
+    Trip = apps.get_model('auth_app', 'Trip')
+    ChatMessage = apps.get_model('auth_app', 'ChatMessage')
+    ChatNotification = apps.get_model('auth_app', 'ChatNotification')
+    ChatReadCursor = apps.get_model('auth_app', 'ChatReadCursor')
+
+    latest = dict(
+        ChatMessage.objects.order_by().values('trip_id').annotate(latest_id=Max('id')).values_list('trip_id', 'latest_id')
+    )
+    oldest = {
+        (row['user_id'], row['trip_id']): row
+        for row in ChatNotification.objects.order_by().values('user_id', 'trip_id').annotate(
+            oldest_id=Min('chat_message_id'),
+            oldest_unread_id=Min('chat_message_id', filter=models.Q(is_read=False))
+        )
+    }
+
+    followers = set(Trip.objects.values_list('user_id', 'id'))
+    followers.update(Trip.members.through.objects.values_list('userprofile_id', 'trip_id'))
+
+    cursors = []
+    for user_id, trip_id in followers:
+        latest_id = latest.get(trip_id, 0)
+        notifications = oldest.get((user_id, trip_id))
+        if notifications is None:
+            last_read_id = cleared_id = latest_id
+        else:
+            cleared_id = notifications['oldest_id'] - 1
+            unread_id = notifications['oldest_unread_id']
+            last_read_id = latest_id if unread_id is None else unread_id - 1
+        cursors.append(ChatReadCursor(
+            user_id=user_id,
+            trip_id=trip_id,
+            last_read_message_id=last_read_id,
+            cleared_message_id=cleared_id
+        ))
+    ChatReadCursor.objects.bulk_create(cursors, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth_app', '0017_chatmessage_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('cleared_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Chat Read Cursor',
+                'verbose_name_plural': 'Chat Read Cursors',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['trip', 'id'], name='chat_msg_trip_id_idx'),
+        ),
+        migrations.AddField(
+            model_name='chatreadcursor',
+            name='trip',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_read_cursors', to='auth_app.trip'),
+        ),
+        migrations.AddField(
+            model_name='chatreadcursor',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_read_cursors', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='chatreadcursor',
+            constraint=models.UniqueConstraint(fields=('user', 'trip'), name='unique_chat_read_cursor'),
+        ),
+        migrations.RunPython(create_read_cursors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.0.2 on 2026-10-17 18:10
+
+from django.db import migrations
+
+# The SQL is frozen here rather than imported from auth_app.chat_search, so
+# that later changes to that module do not change what this migration does
+SQLITE_INSTALL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS auth_app_chatmessage_fts USING fts5(
+        message, content='auth_app_chatmessage', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS auth_app_chatmessage_fts_ai AFTER INSERT ON auth_app_chatmessage BEGIN
+        INSERT INTO auth_app_chatmessage_fts(rowid, message) VALUES (new.id, new.message);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS auth_app_chatmessage_fts_ad AFTER DELETE ON auth_app_chatmessage BEGIN
+        INSERT INTO auth_app_chatmessage_fts(auth_app_chatmessage_fts, rowid, message) VALUES ('delete', old.id, old.message);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS auth_app_chatmessage_fts_au AFTER UPDATE OF message ON auth_app_chatmessage BEGIN
+        INSERT INTO auth_app_chatmessage_fts(auth_app_chatmessage_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        INSERT INTO auth_app_chatmessage_fts(rowid, message) VALUES (new.id, new.message);
+    END""",
+    # Index the existing messages
+    "INSERT INTO auth_app_chatmessage_fts(auth_app_chatmessage_fts) VALUES ('rebuild')",
+]
+
+SQLITE_UNINSTALL = [
+    'DROP TRIGGER IF EXISTS auth_app_chatmessage_fts_ai',
+    'DROP TRIGGER IF EXISTS auth_app_chatmessage_fts_ad',
+    'DROP TRIGGER IF EXISTS auth_app_chatmessage_fts_au',
+    'DROP TABLE IF EXISTS auth_app_chatmessage_fts',
+]
+
+POSTGRES_INSTALL = [
+    """ALTER TABLE auth_app_chatmessage ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', coalesce(message, ''))) STORED""",
+    'CREATE INDEX IF NOT EXISTS chat_msg_search_idx ON auth_app_chatmessage USING GIN (search_vector)',
+]
+
+POSTGRES_UNINSTALL = [
+    'DROP INDEX IF EXISTS chat_msg_search_idx',
+    'ALTER TABLE auth_app_chatmessage DROP COLUMN IF EXISTS search_vector',
+]
+
+STATEMENTS = {
+    'sqlite': (SQLITE_INSTALL, SQLITE_UNINSTALL),
+    'postgresql': (POSTGRES_INSTALL, POSTGRES_UNINSTALL),
+}
+
+
+def run_statements(schema_editor, install):
+    statements = STATEMENTS.get(schema_editor.connection.vendor)
+    if statements is None:
+        return
+    for statement in statements[0 if install else 1]:
+        schema_editor.execute(statement)
+
+
+def create_search_index(apps, schema_editor):
+    """Create the FTS5 table and triggers (SQLite) or the tsvector column (PostgreSQL) and index existing messages."""
+    run_statements(schema_editor, install=True)
+
+
+def drop_search_index(apps, schema_editor):
+    run_statements(schema_editor, install=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth_app', '0018_chatreadcursor'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
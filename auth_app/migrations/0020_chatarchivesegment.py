@@ -0,0 +1,34 @@
+# Generated by Django 5.0.2 on 2026-10-17 18:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth_app', '0019_chat_message_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(help_text='File path relative to CHAT_ARCHIVE_DIR', max_length=255)),
+                ('first_message_id', models.BigIntegerField()),
+                ('last_message_id', models.BigIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('compressed_bytes', models.PositiveBigIntegerField()),
+                ('block_index', models.JSONField(default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_archive_segments', to='auth_app.trip')),
+            ],
+            options={
+                'verbose_name': 'Chat Archive Segment',
+                'verbose_name_plural': 'Chat Archive Segments',
+                'ordering': ['trip', 'first_message_id'],
+                'indexes': [models.Index(fields=['trip', 'first_message_id'], name='chat_archive_trip_idx')],
+            },
+        ),
+    ]
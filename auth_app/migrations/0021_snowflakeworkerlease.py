@@ -0,0 +1,39 @@
+from datetime import datetime, timezone
+
+from django.db import migrations, models
+
+# Worker ids 0-31 (snowflake.WORKER_BITS = 5)
+WORKER_IDS = range(32)
+
+
+def create_leases(apps, schema_editor):
+    SnowflakeWorkerLease = apps.get_model('auth_app', 'SnowflakeWorkerLease')
+    expired = datetime(2000, 1, 1, tzinfo=timezone.utc)
+    SnowflakeWorkerLease.objects.bulk_create([
+        SnowflakeWorkerLease(worker_id=worker_id, owner='', expires_at=expired)
+        for worker_id in WORKER_IDS
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth_app', '0020_chatarchivesegment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnowflakeWorkerLease',
+            fields=[
+                ('worker_id', models.PositiveSmallIntegerField(primary_key=True, serialize=False)),
+                ('owner', models.CharField(blank=True, help_text='host:pid:token of the process holding the lease', max_length=100)),
+                ('expires_at', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Snowflake Worker Lease',
+                'verbose_name_plural': 'Snowflake Worker Leases',
+                'ordering': ['worker_id'],
+            },
+        ),
+        migrations.RunPython(create_leases, migrations.RunPython.noop),
+    ]
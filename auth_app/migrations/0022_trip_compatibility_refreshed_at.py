@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-17 18:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth_app', '0021_snowflakeworkerlease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='compatibility_refreshed_at',
+            field=models.DateTimeField(blank=True, help_text="When this trip's TripCompatibility rows were last computed (empty if never)", null=True),
+        ),
+    ]
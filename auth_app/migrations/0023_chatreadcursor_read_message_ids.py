@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-17 18:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth_app', '0022_trip_compatibility_refreshed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatreadcursor',
+            name='read_message_ids',
+            field=models.JSONField(blank=True, default=list, help_text='Ids above last_read_message_id already read'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.2 on 2026-10-17 18:40
+
+from django.db import migrations
+
+# The index lives in its own migration, not in 0019, so that databases which
+# already applied 0019 get it too. MySQL DDL is not transactional, so both
+# directions check for the index first and can be re-run after a partial
+# failure or on a database where it was created by hand.
+INDEX_NAME = 'chat_msg_search_ft'
+
+
+def has_fulltext_index(schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, 'auth_app_chatmessage')
+    return INDEX_NAME in constraints
+
+
+def create_fulltext_index(apps, schema_editor):
+    """Create the InnoDB FULLTEXT index searched by chat_search on MySQL, unless it exists."""
+    if schema_editor.connection.vendor == 'mysql' and not has_fulltext_index(schema_editor):
+        schema_editor.execute(f'CREATE FULLTEXT INDEX {INDEX_NAME} ON auth_app_chatmessage (message)')
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql' and has_fulltext_index(schema_editor):
+        schema_editor.execute(f'DROP INDEX {INDEX_NAME} ON auth_app_chatmessage')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth_app', '0023_chatreadcursor_read_message_ids'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
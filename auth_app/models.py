@@ -1,6 +1,7 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.utils import timezone
+from .snowflake import next_snowflake_id
 
 class UserProfile(AbstractUser):
     """Custom User Model with additional fields for user details."""
@@ -71,7 +72,36 @@ class DestinationTravelInterest(models.Model):
         return f"{self.destination.name} - {self.interest.name}"
 
 
-class Trip(models.Model):
+class TracksLoadedValues:
+    """Model mixin remembering field values as loaded from (or last saved to) the database."""
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        deferred = self.get_deferred_fields()
+        self._loaded_values = {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+            if field.attname not in deferred
+        }
+
+    def loaded_value(self, attname, default=None):
+        return getattr(self, '_loaded_values', {}).get(attname, default)
+
+    def changed_since_load(self, *attnames):
+        """Whether any of the fields differs from its loaded value (always True for new instances)."""
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None or any(attname not in loaded for attname in attnames):
+            return True
+        return any(loaded[attname] != getattr(self, attname) for attname in attnames)
+
+
+class Trip(TracksLoadedValues, models.Model):
     """Model for storing trip details"""
     
     TRIP_STATUS_CHOICES = [
@@ -128,6 +158,21 @@ class Trip(models.Model):
         db_index=True,  # Add index for faster filtering
         help_text="Flag to quickly identify cancelled trips"
     )
+    # Denormalized copies of ``activities`` kept in sync by m2m_changed (see signals.py)
+    activity_ids = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="Sorted TravelInterest ids of this trip's activities"
+    )
+    activity_mask = models.BigIntegerField(
+        default=0,
+        help_text="Activities folded into a 63-bit mask (exact for interest ids 1-63)"
+    )
+    compatibility_refreshed_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text="When this trip's TripCompatibility rows were last computed (empty if never)"
+    )
 
     def __str__(self):
         return f"Trip to {self.destination.name} ({self.start_date.date()} - {self.end_date.date()})"
@@ -136,6 +181,29 @@ class Trip(models.Model):
     def creator(self):
         return self.user
 
+    # Interest ids 1..ACTIVITY_MASK_BITS map to distinct bits; larger ids wrap around
+    ACTIVITY_MASK_BITS = 63
+
+    @classmethod
+    def activity_mask_for(cls, activity_ids):
+        """Fold TravelInterest ids into a mask usable for bitwise overlap tests"""
+        mask = 0
+        for activity_id in activity_ids:
+            mask |= 1 << ((int(activity_id) - 1) % cls.ACTIVITY_MASK_BITS)
+        return mask
+
+    def sync_activity_columns(self):
+        """Refresh activity_ids/activity_mask from the activities relation"""
+        self.activity_ids = sorted(self.activities.values_list('id', flat=True))
+        self.activity_mask = self.activity_mask_for(self.activity_ids)
+        # Update the columns directly so the save() status logic and post_save signals don't run
+        Trip.objects.filter(pk=self.pk).update(
+            activity_ids=self.activity_ids,
+            activity_mask=self.activity_mask
+        )
+        if hasattr(self, '_loaded_values'):
+            self._loaded_values.update(activity_ids=self.activity_ids, activity_mask=self.activity_mask)
+
     def is_full(self):
         """Check if the trip has reached its member limit"""
         return self.members.count() >= self.max_members
@@ -191,6 +259,37 @@ class Trip(models.Model):
         ordering = ['-start_date']
 
 
+class TripCompatibility(models.Model):
+    """Materialized compatibility score of ``trip`` towards ``other_trip``.
+
+    Scores are directional (shared activities are normalised by the first trip's
+    activities), so both directions of a pair are stored. Rows are maintained
+    incrementally by the signals in signals.py.
+    """
+    
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='compatibilities')
+    other_trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField(help_text="Weighted compatibility score (0-100)")
+    date_score = models.FloatField(help_text="Date overlap score (0-100)")
+    activities_score = models.FloatField(help_text="Shared activities score (0-100)")
+    preferences_score = models.FloatField(help_text="Matching preference points (0-20)")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Trip Compatibility"
+        verbose_name_plural = "Trip Compatibilities"
+        constraints = [
+            models.UniqueConstraint(fields=['trip', 'other_trip'], name="unique_trip_compatibility")
+        ]
+        indexes = [
+            # Top-k lookups: WHERE trip_id = ? ORDER BY score DESC
+            models.Index(fields=['trip', '-score'], name='trip_compat_score_idx')
+        ]
+
+    def __str__(self):
+        return f"Trip {self.trip_id} → Trip {self.other_trip_id}: {self.score}"
+
+
 class TravelBuddyRequest(models.Model):
     """Model for managing travel buddy requests"""
     
@@ -246,7 +345,7 @@ class TravelBuddyRequest(models.Model):
         return self.status == 'rejected'
 
 
-class UserPreferences(models.Model):
+class UserPreferences(TracksLoadedValues, models.Model):
     """Model to store user travel preferences (budget & frequency)."""
     
     user = models.OneToOneField(UserProfile, on_delete=models.CASCADE, related_name='preferences')
@@ -291,16 +390,28 @@ class ChatMessage(models.Model):
     trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='chat_messages')
     sender = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='sent_messages')
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set by the application (not on insert) so write-behind batches keep the send time
+    timestamp = models.DateTimeField(default=timezone.now)
     
     class Meta:
         ordering = ['timestamp']
         verbose_name = "Chat Message"
         verbose_name_plural = "Chat Messages"
+        indexes = [
+            # Unread ranges and history pages: WHERE trip_id = ? AND id > ?
+            models.Index(fields=['trip', 'id'], name='chat_msg_trip_id_idx')
+        ]
     
     def __str__(self):
         return f"{self.sender.username} in {self.trip}: {self.message[:30]}"
 
+    def save(self, *args, **kwargs):
+        """Assign a time-ordered snowflake id before the first insert"""
+        if self._state.adding and self.id is None:
+            self.id = next_snowflake_id()
+            kwargs.setdefault('force_insert', True)
+        super().save(*args, **kwargs)
+
 
 class TripReview(models.Model):
     """Model for storing user reviews for completed trips."""
@@ -366,7 +477,12 @@ class TripNotification(models.Model):
 
 
 class ChatNotification(models.Model):
-    """Model for storing chat-related notifications for users."""
+    """
+    Model for storing chat-related notifications for users.
+
+    No longer written: chat notifications are derived from ChatReadCursor.
+    Existing rows were converted to cursors by migration 0018.
+    """
     
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='chat_notifications')
     trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='chat_notifications')
@@ -395,6 +511,94 @@ class ChatNotification(models.Model):
         self.save()
 
 
+class ChatReadCursor(models.Model):
+    """
+    How far a user has read the chat of one trip.
+
+    Every trip member and the trip creator has one cursor per trip. Messages
+    of the trip with an id above ``last_read_message_id`` (and not sent by the
+    user) are unread, except those listed in ``read_message_ids``, which were
+    read out of order while older messages are still unread; messages up to
+    ``cleared_message_id`` are no longer listed as chat notifications.
+    Message ids increase over time (see
+    snowflake.py), so both are plain ``id > cursor`` ranges over
+    ChatMessage(trip, id).
+    """
+    
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='chat_read_cursors')
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='chat_read_cursors')
+    last_read_message_id = models.BigIntegerField(default=0)
+    read_message_ids = models.JSONField(default=list, blank=True, help_text="Ids above last_read_message_id already read")
+    cleared_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name = "Chat Read Cursor"
+        verbose_name_plural = "Chat Read Cursors"
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'trip'], name="unique_chat_read_cursor")
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} in {self.trip}: read up to {self.last_read_message_id}"
+
+
+class ChatArchiveSegment(models.Model):
+    """
+    Chat messages of a finished trip moved out of ChatMessage into a
+    compressed file (see chat_archive.py).
+
+    The file is JSON lines in independent gzip members of ``block_size``
+    messages each (still a valid .gz as a whole); ``block_index`` lists
+    ``[first message id, byte offset, byte length]`` per member, so reading a
+    page decompresses one member rather than the whole file. Archived ids are
+    lower than the ids of the trip's remaining messages, because a run moves
+    every message the trip has at that point.
+    """
+    
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='chat_archive_segments')
+    path = models.CharField(max_length=255, help_text="File path relative to CHAT_ARCHIVE_DIR")
+    first_message_id = models.BigIntegerField()
+    last_message_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    compressed_bytes = models.PositiveBigIntegerField()
+    block_index = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['trip', 'first_message_id']
+        verbose_name = "Chat Archive Segment"
+        verbose_name_plural = "Chat Archive Segments"
+        indexes = [
+            models.Index(fields=['trip', 'first_message_id'], name='chat_archive_trip_idx')
+        ]
+    
+    def __str__(self):
+        return f"{self.trip}: {self.message_count} archived messages"
+
+
+class SnowflakeWorkerLease(models.Model):
+    """
+    Lease on one of the 32 snowflake worker ids (see snowflake.py).
+
+    Processes without CHAT_WORKER_ID claim an expired lease before issuing
+    their first chat id and keep renewing it, so no two running processes
+    issue ids with the same worker id. One row per worker id is created by the migration.
+    """
+
+    worker_id = models.PositiveSmallIntegerField(primary_key=True)
+    owner = models.CharField(max_length=100, blank=True, help_text="host:pid:token of the process holding the lease")
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ['worker_id']
+        verbose_name = "Snowflake Worker Lease"
+        verbose_name_plural = "Snowflake Worker Leases"
+
+    def __str__(self):
+        return f"Worker {self.worker_id}: {self.owner or 'free'}"
+
+
 class Subscription(models.Model):
     """Model to store premium user subscription details"""
     
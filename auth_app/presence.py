@@ -0,0 +1,272 @@
+"""
+In-memory presence and typing indicators of trip chats.
+
+Every process keeps, for each chat_{trip_id} group it has sockets in, a view
+of who is online and who is typing in the room. Changes are not broadcast
+one by one: they accumulate in a pending diff that one flusher task per
+process sends as a single presence_diff group event every
+CHAT_PRESENCE_INTERVAL_MS. Keystrokes therefore cost nothing beyond a dict
+update, and a typing user is announced once, not once per key.
+
+- Local users (with a socket in this process) are online while connected;
+  they stop typing after CHAT_TYPING_TIMEOUT_SECONDS without a typing frame
+  or when they send a message.
+- Users of other processes are learned from their presence_diff events.
+  While a room has users of other processes, each process re-announces its
+  local users every third of CHAT_PRESENCE_TTL_SECONDS as a heartbeat;
+  remote users without a heartbeat for a whole TTL (e.g. their worker
+  crashed) go offline. A heartbeat changes nothing for clients, so its
+  event is marked ``heartbeat`` and sockets do not forward it; rooms with
+  only local users send none.
+- When a process gets its first socket in a room it asks the other
+  processes to re-announce, so its view fills within one interval.
+
+Chat sockets opened with ``?presence=1`` get a snapshot of the room on
+connect and the presence_diff frames; other sockets are tracked but sent
+neither.
+
+Nothing is written to the database.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import random
+import string
+import time
+from collections import Counter, deque
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .wire_formats import dumps_compact
+
+logger = logging.getLogger(__name__)
+
+
+class RoomPresence:
+    """Presence view and pending diff of one chat room in this process."""
+
+    def __init__(self):
+        self.local = Counter()
+        self.names = {}
+        self.online = {}
+        self.typing = {}
+        self.announced_at = 0.0
+        self.announce_due = False
+        self.seen_events = deque(maxlen=64)
+        self.reset_pending()
+
+    def reset_pending(self):
+        self.pending_online = set()
+        self.pending_heartbeat = set()
+        self.pending_offline = set()
+        self.pending_typing = set()
+        self.pending_stopped = set()
+        self.pending_sync = False
+
+    def has_pending(self):
+        return bool(self.pending_online or self.pending_heartbeat or self.pending_offline or self.pending_typing
+                    or self.pending_stopped or self.pending_sync)
+
+    def has_remote_users(self):
+        # Local users never expire
+        return any(expires_at != float('inf') for expires_at in self.online.values())
+
+    def set_online(self, user_id):
+        self.pending_offline.discard(user_id)
+        self.pending_online.add(user_id)
+
+    def set_offline(self, user_id):
+        self.online.pop(user_id, None)
+        self.pending_online.discard(user_id)
+        self.pending_heartbeat.discard(user_id)
+        self.pending_offline.add(user_id)
+        self.stop_typing(user_id)
+
+    def stop_typing(self, user_id):
+        if self.typing.pop(user_id, None) is not None:
+            if user_id in self.pending_typing:
+                # Never announced, so there is nothing to take back
+                self.pending_typing.discard(user_id)
+            else:
+                self.pending_stopped.add(user_id)
+
+
+class PresenceRegistry:
+    """Presence of every chat room this process has sockets in."""
+
+    def __init__(self):
+        self.rooms = {}
+        self.origin = ''.join(random.choice(string.ascii_letters) for _ in range(8))
+        self._sequence = itertools.count()
+        self._flusher = None
+        self.diffs_sent = 0
+
+    @property
+    def interval(self):
+        return getattr(settings, 'CHAT_PRESENCE_INTERVAL_MS', 300) / 1000
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'CHAT_PRESENCE_TTL_SECONDS', 30)
+
+    @property
+    def typing_timeout(self):
+        return getattr(settings, 'CHAT_TYPING_TIMEOUT_SECONDS', 5)
+
+    def connect(self, trip_id, user_id, username):
+        """Register a local socket of a user; must be called from the event loop."""
+        room = self.rooms.get(trip_id)
+        if room is None:
+            room = self.rooms[trip_id] = RoomPresence()
+        if not room.local:
+            # First local socket: ask the other processes who is here
+            room.pending_sync = True
+        room.local[user_id] += 1
+        room.names[user_id] = username
+        if user_id not in room.online:
+            room.set_online(user_id)
+        room.online[user_id] = float('inf')
+        self._ensure_flusher()
+
+    def disconnect(self, trip_id, user_id):
+        """Unregister a local socket; the user goes offline with their last socket."""
+        room = self.rooms.get(trip_id)
+        if room is None or not room.local[user_id]:
+            return
+        room.local[user_id] -= 1
+        if not room.local[user_id]:
+            del room.local[user_id]
+            room.set_offline(user_id)
+
+    def set_typing(self, trip_id, user_id, active=True):
+        """Record a typing frame of a local user."""
+        room = self.rooms.get(trip_id)
+        if room is None or user_id not in room.local:
+            return
+        if not active:
+            room.stop_typing(user_id)
+            return
+        if user_id not in room.typing:
+            room.pending_stopped.discard(user_id)
+            room.pending_typing.add(user_id)
+        room.typing[user_id] = time.monotonic() + self.typing_timeout
+
+    def snapshot(self, trip_id):
+        """Full presence frame of a room, sent to sockets when they join."""
+        room = self.rooms.get(trip_id)
+        if room is None:
+            return {'type': 'presence', 'online': [], 'typing': []}
+        return {
+            'type': 'presence',
+            'online': [{'id': user_id, 'username': room.names.get(user_id)} for user_id in sorted(room.online)],
+            'typing': sorted(room.typing)
+        }
+
+    def apply(self, trip_id, event):
+        """
+        Apply a presence_diff group event to this process's view. Every local
+        socket of the room calls this for the same event; only the first call
+        has an effect.
+        """
+        room = self.rooms.get(trip_id)
+        if room is None or event['id'] in room.seen_events:
+            return
+        room.seen_events.append(event['id'])
+        now = time.monotonic()
+
+        for user in event['online']:
+            room.names[user['id']] = user['username']
+            if user['id'] not in room.local:
+                room.online[user['id']] = now + self.ttl
+        for user_id in event['offline']:
+            if user_id not in room.local:
+                room.online.pop(user_id, None)
+                room.typing.pop(user_id, None)
+        for user_id in event['typing']:
+            if user_id not in room.local:
+                room.typing[user_id] = now + self.typing_timeout
+        for user_id in event['stopped_typing']:
+            if user_id not in room.local:
+                room.typing.pop(user_id, None)
+        if event.get('sync') and event['id'].split(':')[0] != self.origin:
+            room.announce_due = True
+
+    def _expire(self, room, now):
+        for user_id, expires_at in list(room.online.items()):
+            if expires_at < now:
+                # A remote user whose process stopped announcing them
+                room.set_offline(user_id)
+        for user_id, expires_at in list(room.typing.items()):
+            if expires_at < now:
+                if user_id in room.local:
+                    room.stop_typing(user_id)
+                else:
+                    del room.typing[user_id]
+
+        if room.local and room.announce_due:
+            # Answer to a process that just joined the room; its sockets'
+            # snapshots did not have our users yet, so clients get this one
+            room.pending_online.update(room.local)
+            room.announced_at = now
+            room.announce_due = False
+        elif room.local and room.has_remote_users() and now - room.announced_at > self.ttl / 3:
+            # Heartbeat of the local users for the other processes
+            room.pending_heartbeat.update(room.local)
+            room.announced_at = now
+
+    def _build_event(self, trip_id, room):
+        diff = {
+            'type': 'presence_diff',
+            'online': [{'id': user_id, 'username': room.names.get(user_id)} for user_id in sorted(room.pending_online)],
+            'offline': sorted(room.pending_offline),
+            'typing': sorted(room.pending_typing),
+            'stopped_typing': sorted(room.pending_stopped)
+        }
+        # Other processes get the heartbeat too; the frame only has the changes
+        announced = room.pending_online | room.pending_heartbeat
+        event = dict(
+            diff,
+            online=[{'id': user_id, 'username': room.names.get(user_id)} for user_id in sorted(announced)],
+            id=f'{self.origin}:{next(self._sequence)}',
+            sync=room.pending_sync,
+            heartbeat=not any(diff[key] for key in ('online', 'offline', 'typing', 'stopped_typing')),
+            trip_id=trip_id
+        )
+        event['frame'] = json.dumps(diff)
+        event['compact'] = dumps_compact(diff)
+        room.reset_pending()
+        return event
+
+    def _ensure_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        """Send the pending diff of every room once per interval while there are rooms."""
+        channel_layer = get_channel_layer()
+        while self.rooms:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            for trip_id, room in list(self.rooms.items()):
+                self._expire(room, now)
+                if room.has_pending():
+                    event = self._build_event(trip_id, room)
+                    try:
+                        await channel_layer.group_send(f'chat_{trip_id}', event)
+                        self.diffs_sent += 1
+                    except Exception as e:
+                        logger.error(f"Error sending presence of trip {trip_id}: {str(e)}")
+                if not room.local and not room.has_pending():
+                    del self.rooms[trip_id]
+
+    def stats(self):
+        return {
+            'rooms': len(self.rooms),
+            'local_users': sum(len(room.local) for room in self.rooms.values()),
+            'diffs_sent': self.diffs_sent
+        }
+
+
+presence = PresenceRegistry()
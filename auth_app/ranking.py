@@ -0,0 +1,108 @@
+"""
+Top-k ranking and cursor pagination for the compatible-trip endpoints.
+
+Results are ordered by (score DESC, trip_id ASC). A cursor encodes the
+(score, trip_id) of the last row of a page, so the next page is "everything
+ranked after that row" and pages stay stable while scores are unchanged.
+"""
+import base64
+import heapq
+import json
+
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(score, trip_id):
+    """Encode the position of a row as an opaque cursor string."""
+    raw = json.dumps([score, trip_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        score, trip_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return float(score), int(trip_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+
+
+def get_page_params(request):
+    """
+    Read ``limit`` and ``cursor`` from the request body or query string.
+
+    Returns:
+        tuple: (limit or None when pagination was not requested, decoded cursor or None)
+
+    Raises:
+        ValueError: If limit or cursor are invalid
+    """
+    data = request.data if hasattr(request.data, 'get') else {}
+    limit = data.get('limit', request.query_params.get('limit'))
+    cursor = data.get('cursor', request.query_params.get('cursor'))
+
+    if limit is None and cursor is None:
+        return None, None
+
+    limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+    if limit < 1:
+        raise ValueError('limit must be at least 1')
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    return limit, decode_cursor(cursor) if cursor else None
+
+
+def is_after_cursor(score, trip_id, cursor):
+    """Whether a row ranks strictly after the cursor position."""
+    cursor_score, cursor_trip_id = cursor
+    return score < cursor_score or (score == cursor_score and trip_id > cursor_trip_id)
+
+
+def after_cursor_q(cursor, score_field='score', id_field='other_trip_id'):
+    """Q object selecting the rows ranked after ``cursor`` for keyset pagination in SQL."""
+    cursor_score, cursor_trip_id = cursor
+    return Q(**{f'{score_field}__lt': cursor_score}) | Q(**{score_field: cursor_score, f'{id_field}__gt': cursor_trip_id})
+
+
+def top_k(rows, limit, cursor=None):
+    """
+    Select one page from ``rows`` with a bounded heap.
+
+    Memory stays O(limit) no matter how many rows are scanned.
+
+    Args:
+        rows (iterable): (score, trip_id, payload) tuples, in any order
+        limit (int): Page size
+        cursor (tuple): Optional decoded (score, trip_id) of the previous page's last row
+
+    Returns:
+        tuple: (list of rows for the page in rank order, next cursor or None)
+    """
+    if cursor is not None:
+        rows = (row for row in rows if is_after_cursor(row[0], row[1], cursor))
+
+    # Keep one extra row to know whether there is a next page
+    page = heapq.nsmallest(limit + 1, rows, key=lambda row: (-row[0], row[1]))
+    return paginate_ranked(page, limit)
+
+
+def paginate_ranked(rows, limit):
+    """
+    Split already ranked rows (with up to one extra look-ahead row) into a page
+    and the cursor for the next one.
+    """
+    rows = list(rows)
+    if len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    last = page[-1]
+    return page, encode_cursor(last[0], last[1])
@@ -0,0 +1,138 @@
+"""
+Per-process ring buffers of the latest chat messages of each trip.
+
+ChatConsumer pushes the buffer of a trip as a "history" frame right after a
+socket that asked for it (``?history=1``) is accepted, so clients no longer
+need a REST history call to open a chat. Entries hold the messages' pre-encoded frames (see wire_formats.py),
+so the history frame is a string join.
+
+A buffer is filled from the database when the first socket of the process
+joins the trip (concurrent joins share that one query) and is then kept
+current by the chat_message group events every socket of the trip receives,
+whichever worker the message was sent through. When the last socket of the
+trip leaves the process, the buffer is dropped: without a socket in the
+group the process would no longer see new messages.
+
+Messages still waiting for write-behind persistence in another process when
+a buffer is filled are missed by that buffer; the REST history endpoint
+(?since=) remains the source of truth.
+"""
+import asyncio
+from collections import Counter, deque
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .chat_persistence import chat_write_behind
+from .models import ChatMessage
+from .wire_formats import compact_chat_message, dumps_compact, encode_chat_frame, sender_metadata
+
+
+def message_entry(chat_message, sender):
+    """Buffer entry of a message: (id, default frame, compact frame)."""
+    return (
+        chat_message.id,
+        encode_chat_frame(chat_message, sender),
+        dumps_compact(compact_chat_message(chat_message, sender))
+    )
+
+
+class RecentMessageBuffers:
+    """Ring buffers of the last CHAT_HISTORY_BUFFER_SIZE messages of the trips with local sockets."""
+
+    def __init__(self):
+        self._buffers = {}
+        self._loading = {}
+        self._sockets = Counter()
+        self.loads = 0
+
+    @property
+    def size(self):
+        return getattr(settings, 'CHAT_HISTORY_BUFFER_SIZE', 50)
+
+    def join(self, trip_id):
+        """Register a socket of this process in the trip's chat group."""
+        self._sockets[trip_id] += 1
+
+    def leave(self, trip_id):
+        """Unregister a socket; drops the buffer when it was the trip's last one."""
+        self._sockets[trip_id] -= 1
+        if self._sockets[trip_id] <= 0:
+            del self._sockets[trip_id]
+            self._buffers.pop(trip_id, None)
+
+    def _query(self, trip_id, size):
+        # Messages of this process that are broadcast but not persisted yet. Read
+        # before the query: a message persisted in between is then found in one
+        # of the two (duplicates collapse below)
+        pending = chat_write_behind.pending_for_trip(trip_id)
+        messages = list(
+            ChatMessage.objects.filter(trip_id=trip_id).select_related('sender').order_by('-id')[:size]
+        )
+        messages.extend(pending)
+
+        senders = {}
+        entries = {}
+        for message in messages:
+            if message.sender_id not in senders:
+                senders[message.sender_id] = sender_metadata(message.sender)
+            entries[message.id] = message_entry(message, senders[message.sender_id])
+        return [entries[message_id] for message_id in sorted(entries)[-size:]]
+
+    async def get(self, trip_id):
+        """
+        Return the buffered entries of a trip, oldest first, loading them on
+        first access.
+        """
+        buffer = self._buffers.get(trip_id)
+        if buffer is not None:
+            return list(buffer)
+
+        loading = self._loading.get(trip_id)
+        if loading is not None:
+            # Another socket is loading this trip already
+            await asyncio.shield(loading['future'])
+            return list(self._buffers.get(trip_id, ()))
+
+        loading = self._loading[trip_id] = {'future': asyncio.get_running_loop().create_future(), 'early': []}
+        try:
+            self.loads += 1
+            entries = await database_sync_to_async(self._query)(trip_id, self.size)
+            buffer = deque(entries, maxlen=self.size)
+            if trip_id in self._sockets:
+                self._buffers[trip_id] = buffer
+            # Messages broadcast while the query was running
+            for entry in loading['early']:
+                self._insert(buffer, entry)
+            return list(buffer)
+        finally:
+            del self._loading[trip_id]
+            loading['future'].set_result(None)
+
+    def add(self, trip_id, entry):
+        """Record a broadcast message. Safe to call once per receiving socket."""
+        buffer = self._buffers.get(trip_id)
+        if buffer is not None:
+            self._insert(buffer, entry)
+        elif trip_id in self._loading:
+            self._loading[trip_id]['early'].append(entry)
+
+    @staticmethod
+    def _insert(buffer, entry):
+        if buffer and entry[0] <= buffer[-1][0]:
+            # Duplicate, or a message of another worker that arrived late
+            if any(existing[0] == entry[0] for existing in buffer):
+                return
+            if buffer.maxlen and len(buffer) == buffer.maxlen and entry[0] < buffer[0][0]:
+                return
+            entries = sorted([*buffer, entry])
+            buffer.clear()
+            buffer.extend(entries)
+            return
+        buffer.append(entry)
+
+    def stats(self):
+        return {'trips': len(self._buffers), 'sockets': sum(self._sockets.values()), 'loads': self.loads}
+
+
+recent_messages = RecentMessageBuffers()
@@ -6,6 +6,9 @@ websocket_urlpatterns = [
     # Simple pattern for chat WebSocket
     path('ws/chat/<int:trip_id>/', consumers.ChatConsumer.as_asgi()),
     
+    # One multiplexed socket per user for all their trip chats and notifications
+    path('ws/user/', consumers.UserConsumer.as_asgi()),
+    
     # Alternative pattern using re_path for more flexibility
     # re_path(r'^ws/chat/(?P<trip_id>\d+)/?$', consumers.ChatConsumer.as_asgi()),
 ]
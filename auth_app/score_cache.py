@@ -0,0 +1,144 @@
+"""
+Bounded, versioned LRU cache of pairwise compatibility scores.
+
+Users re-run the buddy search for the same trip many times, so the same
+(trip, candidate) pairs would otherwise be rescored on every request.
+
+Entries are keyed by (trip_id, candidate_trip_id, trip_version, prefs_version).
+The versions are the data the score depends on (destination, dates and
+activity ids of both trips, preferences of both owners), so a changed trip
+or preference can never be served a stale score, even when the change was
+made by another worker process. The signals in signals.py also
+drop the affected entries eagerly so that they do not occupy the cache until
+they are evicted.
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+def trip_version(trip):
+    """Version of the trip fields that affect its compatibility scores: the values themselves."""
+    return (trip.destination_id, trip.start_date, trip.end_date, tuple(sorted(trip.activity_ids)))
+
+
+def preferences_version(preferences):
+    """Version of a (travel_frequency, travel_budget) tuple, or of missing preferences (None)."""
+    return preferences
+
+
+class ScoreCache:
+    """Thread-safe LRU mapping of cache keys to scores, with hit/miss counters."""
+
+    def __init__(self, maxsize=None):
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # trip id -> keys of the entries it takes part in, for eager invalidation
+        self._keys_by_trip = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        if self._maxsize is not None:
+            return self._maxsize
+        return getattr(settings, 'COMPATIBILITY_CACHE_SIZE', 50000)
+
+    @staticmethod
+    def make_key(trip_id, candidate_trip_id, trip_versions, prefs_versions):
+        """
+        Build a cache key.
+
+        Args:
+            trip_id (int): Reference trip id
+            candidate_trip_id (int): Candidate trip id
+            trip_versions (tuple): (reference trip version, candidate trip version)
+            prefs_versions (tuple): (reference owner version, candidate owner version)
+
+        The versions are kept as they are rather than hashed: two different
+        versions whose hashes collide would otherwise share a cached score.
+        """
+        return (trip_id, candidate_trip_id, trip_versions, prefs_versions)
+
+    def get_many(self, keys):
+        """
+        Look up several keys at once.
+
+        Returns:
+            dict: {key: score} for the keys that were cached
+        """
+        found = {}
+        with self._lock:
+            for key in keys:
+                score = self._entries.get(key)
+                if score is None:
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = score
+                self.hits += 1
+        return found
+
+    def set_many(self, items):
+        """Store (key, score) pairs, evicting the least recently used entries."""
+        maxsize = self.maxsize
+        if maxsize <= 0:
+            return
+
+        with self._lock:
+            for key, score in items:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                self._entries[key] = score
+                self._keys_by_trip.setdefault(key[0], set()).add(key)
+                self._keys_by_trip.setdefault(key[1], set()).add(key)
+
+            while len(self._entries) > maxsize:
+                key, _ = self._entries.popitem(last=False)
+                self._forget_key(key)
+
+    def _forget_key(self, key):
+        for trip_id in (key[0], key[1]):
+            keys = self._keys_by_trip.get(trip_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_trip[trip_id]
+
+    def invalidate_trips(self, trip_ids):
+        """Drop every entry in which one of ``trip_ids`` is either side of the pair."""
+        with self._lock:
+            for trip_id in trip_ids:
+                for key in list(self._keys_by_trip.get(trip_id, ())):
+                    self._entries.pop(key, None)
+                    self._forget_key(key)
+
+    def clear(self):
+        """Drop all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_trip.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Return cache statistics for sizing the cache.
+
+        Returns:
+            dict: size, maxsize, hits, misses and hit_rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+score_cache = ScoreCache()
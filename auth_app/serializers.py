@@ -1,7 +1,9 @@
 from rest_framework import serializers
-from .models import UserProfile, TravelInterest, PreferredDestination, DestinationTravelInterest, Trip, TravelBuddyRequest, UserPreferences, ChatMessage, TripReview, TripNotification, ChatNotification
+from .models import UserProfile, TravelInterest, PreferredDestination, DestinationTravelInterest, Trip, TravelBuddyRequest, UserPreferences, ChatMessage, TripReview, TripNotification, TripCompatibility
 from django.conf import settings
 from . import views
+from .chat_cursors import is_message_read
+from .compatibility_store import ensure_trip_compatibility
 from django.utils import timezone
 
 class UserProfileSerializer(serializers.ModelSerializer):
@@ -57,6 +59,29 @@ class UserProfileSerializer(serializers.ModelSerializer):
         return user
 
 
+class UserProfileCompatibilityListSerializer(serializers.ListSerializer):
+    """
+    Loads the stored scores of every listed user in a single query instead of
+    one query per user.
+    """
+
+    def to_representation(self, data):
+        users = list(data.all() if hasattr(data, 'all') else data)
+        reference_trip = self.context.get('reference_trip')
+        if reference_trip:
+            ensure_trip_compatibility(reference_trip)
+            scores = {}
+            rows = TripCompatibility.objects.filter(
+                trip=reference_trip,
+                other_trip__user__in=users
+            ).order_by('other_trip__user_id', '-other_trip__start_date').values_list('other_trip__user_id', 'score')
+            # Keep the score of each user's latest-starting trip, like the single-object path
+            for user_id, score in rows:
+                scores.setdefault(user_id, score)
+            self.context['compatibility_by_user'] = scores
+        return super().to_representation(users)
+
+
 class UserProfileCompatibilitySerializer(serializers.ModelSerializer):
     """
     Serializer for UserProfile that includes compatibility score with a reference trip.
@@ -67,6 +92,7 @@ class UserProfileCompatibilitySerializer(serializers.ModelSerializer):
     class Meta:
         model = UserProfile
         fields = ['id', 'username', 'profile_picture', 'gender', 'compatibility_score']
+        list_serializer_class = UserProfileCompatibilityListSerializer
 
     def get_profile_picture(self, obj):
         """
@@ -86,18 +112,20 @@ class UserProfileCompatibilitySerializer(serializers.ModelSerializer):
         reference_trip = self.context.get('reference_trip')
         if not reference_trip:
             return 0
+
+        # Scores preloaded by UserProfileCompatibilityListSerializer
+        preloaded = self.context.get('compatibility_by_user')
+        if preloaded is not None:
+            return preloaded.get(obj.id) or 0
             
-        # Get one of the user's trips to the same destination
-        user_trips = Trip.objects.filter(
-            user=obj,
-            destination=reference_trip.destination
-        ).exclude(id=reference_trip.id)
+        # Read the precomputed score of the user's first trip to the same destination
+        ensure_trip_compatibility(reference_trip)
+        score = TripCompatibility.objects.filter(
+            trip=reference_trip,
+            other_trip__user=obj
+        ).order_by('-other_trip__start_date').values_list('score', flat=True).first()
         
-        if not user_trips.exists():
-            return 0
-            
-        # Calculate compatibility score with the first matching trip
-        return views.calculate_compatibility_score(reference_trip, user_trips.first())
+        return score or 0
 
 
 class TravelInterestSerializer(serializers.ModelSerializer):
@@ -373,6 +401,22 @@ class CompatibleTripSerializer(serializers.ModelSerializer):
             for activity in obj.activities.all()
         ]
 
+class SimilarTripSerializer(CompatibleTripSerializer):
+    """
+    Serializer for trips with a similar activity profile, at any destination.
+    """
+    similarity = serializers.SerializerMethodField()
+
+    class Meta(CompatibleTripSerializer.Meta):
+        fields = CompatibleTripSerializer.Meta.fields + ['similarity']
+
+    def get_similarity(self, obj):
+        """
+        Get the Jaccard similarity of the trip's activities from the context.
+        """
+        similarities = self.context.get('similarities', {})
+        return similarities.get(int(obj.id), 0)
+
 class MyBuddiesSerializer(serializers.ModelSerializer):
     """
     Serializer for displaying trips and their confirmed buddies.
@@ -558,23 +602,46 @@ class TripNotificationSerializer(serializers.ModelSerializer):
 
 
 class ChatNotificationSerializer(serializers.ModelSerializer):
+    """
+    Chat notification of a user, derived from an unread-or-uncleared
+    ChatMessage (see chat_cursors.notification_messages).
+
+    The notification id is the message id. Expects messages annotated with
+    the recipient's ``last_read_message_id`` and ``read_message_ids`` and
+    the recipient in the ``user`` context entry.
+    """
+    user = serializers.SerializerMethodField()
     trip_name = serializers.CharField(source='trip.destination.name', read_only=True)
+    chat_message = serializers.IntegerField(source='id', read_only=True)
     sender_name = serializers.CharField(source='sender.username', read_only=True)
     sender_picture = serializers.SerializerMethodField()
+    message_preview = serializers.SerializerMethodField()
+    is_read = serializers.SerializerMethodField()
+    created_at = serializers.DateTimeField(source='timestamp', read_only=True)
     formatted_date = serializers.SerializerMethodField()
     
     class Meta:
-        model = ChatNotification
+        model = ChatMessage
         fields = [
             'id', 'user', 'trip', 'trip_name', 'chat_message', 'sender', 'sender_name',
             'sender_picture', 'message_preview', 'is_read', 'created_at', 'formatted_date'
         ]
-        read_only_fields = ['user', 'created_at']
+        read_only_fields = fields
+    
+    def get_user(self, obj):
+        return self.context['user'].id
     
     def get_sender_picture(self, obj):
         if obj.sender and obj.sender.profile_picture:
             return f"http://localhost:8000{obj.sender.profile_picture.url}"
         return None
     
+    def get_message_preview(self, obj):
+        # Truncated to 50 chars like the former ChatNotification.message_preview
+        return obj.message[:47] + '...' if len(obj.message) > 50 else obj.message
+    
+    def get_is_read(self, obj):
+        return is_message_read(obj.id, obj.last_read_message_id, obj.read_message_ids)
+    
     def get_formatted_date(self, obj):
-        return obj.created_at.strftime('%B %d, %Y at %I:%M %p')
\ No newline at end of file
+        return obj.timestamp.strftime('%B %d, %Y at %I:%M %p')
\ No newline at end of file
@@ -0,0 +1,278 @@
+import os
+from copy import copy
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed, post_migrate
+from django.dispatch import receiver
+
+from .chat_archive import archive_dir
+from .chat_cursors import create_read_cursors, delete_read_cursors
+from .chat_search import restore_search_triggers
+from .compatibility_store import preferences_changed, schedule_trip_refresh, schedule_user_refresh, trip_scoring_changed
+from .interval_index import trip_interval_index
+from .membership_cache import trip_membership_cache
+from .models import ChatArchiveSegment, Trip, TravelInterest, TripNotification, UserPreferences
+from .score_cache import score_cache
+from .similarity_index import similar_trip_index
+from .user_push import notification_payload, push_to_user, push_trip_closed, push_trip_membership
+
+
+def _changed_activity_trip_ids(instance, action, reverse, pk_set):
+    """Return the ids of trips whose activities were changed by an m2m_changed event."""
+    if not reverse:
+        return [instance.pk]
+
+    # Changed from the TravelInterest side: pk_set holds the affected trips,
+    # except for clear() where they were captured in pre_clear
+    if action == 'pre_clear':
+        instance._cleared_trip_ids = list(instance.trip_set.values_list('id', flat=True))
+        return []
+    if action == 'post_clear':
+        return getattr(instance, '_cleared_trip_ids', [])
+    return list(pk_set or [])
+
+
+@receiver(post_save, sender=Trip)
+def update_trip_interval_index(sender, instance, created, **kwargs):
+    """Keep the destination interval index in sync with saved trips, once the save is committed."""
+    if not created and not instance.changed_since_load('destination_id', 'start_date', 'end_date', 'status', 'user_id'):
+        return
+    previous_destination_id = None if created else instance.loaded_value('destination_id')
+    transaction.on_commit(partial(trip_interval_index.update_trip, copy(instance), previous_destination_id))
+
+
+@receiver(post_delete, sender=Trip)
+def remove_trip_from_interval_index(sender, instance, **kwargs):
+    """Drop deleted trips from the destination interval index, once the delete is committed."""
+    transaction.on_commit(partial(trip_interval_index.remove_trip, instance.id, instance.destination_id))
+
+
+def _update_similar_trip_index_on_commit(trip):
+    transaction.on_commit(partial(similar_trip_index.update_trip, copy(trip)))
+
+
+@receiver(post_save, sender=Trip)
+def update_similar_trip_index(sender, instance, created, **kwargs):
+    """Keep the activity similarity index in sync with saved trips, once the save is committed."""
+    if created or instance.changed_since_load('status', 'user_id', 'destination_id', 'activity_ids'):
+        _update_similar_trip_index_on_commit(instance)
+
+
+@receiver(post_delete, sender=Trip)
+def remove_trip_from_similar_trip_index(sender, instance, **kwargs):
+    """Drop deleted trips from the activity similarity index, once the delete is committed."""
+    transaction.on_commit(partial(similar_trip_index.remove_trip, instance.id))
+
+
+# Must be connected before the compatibility refresh below, which reads the columns
+@receiver(m2m_changed, sender=Trip.activities.through)
+def sync_trip_activity_columns(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep Trip.activity_ids/activity_mask and the similarity index in sync with Trip.activities."""
+    trip_ids = _changed_activity_trip_ids(instance, action, reverse, pk_set)
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        instance.sync_activity_columns()
+        _update_similar_trip_index_on_commit(instance)
+    else:
+        for trip in Trip.objects.filter(id__in=trip_ids):
+            trip.sync_activity_columns()
+            _update_similar_trip_index_on_commit(trip)
+
+
+@receiver(pre_delete, sender=TravelInterest)
+def capture_trips_of_deleted_interest(sender, instance, **kwargs):
+    """Remember which trips lose an activity when a TravelInterest is deleted."""
+    instance._cleared_trip_ids = list(instance.trip_set.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=TravelInterest)
+def sync_trips_of_deleted_interest(sender, instance, **kwargs):
+    """Deleting a TravelInterest removes it from trips without firing m2m_changed."""
+    trip_ids = getattr(instance, '_cleared_trip_ids', [])
+    for trip in Trip.objects.filter(id__in=trip_ids):
+        trip.sync_activity_columns()
+        _update_similar_trip_index_on_commit(trip)
+        schedule_trip_refresh(trip.id)
+    score_cache.invalidate_trips(trip_ids)
+
+
+@receiver(post_save, sender=Trip)
+def refresh_compatibility_on_trip_save(sender, instance, created, **kwargs):
+    """Recompute the materialized compatibility pairs of a saved trip if its scoring inputs changed."""
+    if created or trip_scoring_changed(instance):
+        schedule_trip_refresh(instance.id)
+
+
+@receiver(m2m_changed, sender=Trip.activities.through)
+def refresh_compatibility_on_activities_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Recompute compatibility pairs when a trip's activities change."""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    for trip_id in _changed_activity_trip_ids(instance, action, reverse, pk_set):
+        schedule_trip_refresh(trip_id)
+
+
+@receiver(post_save, sender=UserPreferences)
+def refresh_compatibility_on_preferences_save(sender, instance, **kwargs):
+    """Recompute compatibility pairs of a user's trips when their scored preferences change."""
+    if preferences_changed(instance):
+        schedule_user_refresh(instance.user_id)
+
+
+@receiver(post_delete, sender=UserPreferences)
+def refresh_compatibility_on_preferences_delete(sender, instance, **kwargs):
+    """Recompute compatibility pairs of a user's trips when their preferences are removed."""
+    schedule_user_refresh(instance.user_id)
+
+
+@receiver(post_save, sender=Trip)
+@receiver(post_delete, sender=Trip)
+def invalidate_cached_scores_on_trip_change(sender, instance, **kwargs):
+    """Drop cached pair scores of a saved or deleted trip."""
+    score_cache.invalidate_trips([instance.id])
+
+
+@receiver(m2m_changed, sender=Trip.activities.through)
+def invalidate_cached_scores_on_activities_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drop cached pair scores of trips whose activities changed."""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    score_cache.invalidate_trips(_changed_activity_trip_ids(instance, action, reverse, pk_set))
+
+
+@receiver(post_save, sender=UserPreferences)
+@receiver(post_delete, sender=UserPreferences)
+def invalidate_cached_scores_on_preferences_change(sender, instance, **kwargs):
+    """Drop cached pair scores of every trip owned by a user whose preferences changed."""
+    score_cache.invalidate_trips(list(Trip.objects.filter(user_id=instance.user_id).values_list('id', flat=True)))
+
+
+@receiver(post_save, sender=Trip)
+def create_creator_read_cursor(sender, instance, created, **kwargs):
+    """The creator of a new trip follows its chat."""
+    if created:
+        create_read_cursors([(instance.user_id, instance.id)])
+
+
+@receiver(m2m_changed, sender=Trip.members.through)
+def sync_chat_read_cursors(sender, instance, action, reverse, pk_set, **kwargs):
+    """Create the chat read cursors of joining members and drop those of leaving members."""
+    if action == 'pre_clear':
+        # pk_set is empty for clear(); remember the removed side first
+        if reverse:
+            instance._cleared_chat_trip_ids = list(instance.joined_trips.values_list('id', flat=True))
+        else:
+            instance._cleared_chat_member_ids = list(instance.members.values_list('id', flat=True))
+        return
+    if action == 'post_clear':
+        action = 'post_remove'
+        pk_set = getattr(instance, '_cleared_chat_trip_ids' if reverse else '_cleared_chat_member_ids', [])
+
+    if action == 'post_add':
+        if reverse:
+            create_read_cursors((instance.id, trip_id) for trip_id in pk_set)
+        else:
+            create_read_cursors((user_id, instance.id) for user_id in pk_set)
+    elif action == 'post_remove':
+        if reverse:
+            for trip_id in pk_set:
+                delete_read_cursors(trip_id, [instance.id])
+        else:
+            delete_read_cursors(instance.id, pk_set)
+
+
+@receiver(post_save, sender=Trip)
+def invalidate_trip_membership_on_trip_save(sender, instance, created, **kwargs):
+    """Drop the cached chat membership of a new trip, or of a trip whose creator or status changed."""
+    if created:
+        trip_membership_cache.invalidate_local([instance.id])
+    elif instance.changed_since_load('user_id', 'status'):
+        trip_membership_cache.invalidate([instance.id])
+        if instance.status == 'cancelled' and instance.loaded_value('status') != 'cancelled':
+            # Its chat admits nobody any more: close the sockets following it
+            push_trip_closed(instance.id)
+
+
+@receiver(post_delete, sender=Trip)
+def invalidate_trip_membership_on_trip_delete(sender, instance, **kwargs):
+    """Drop the cached chat membership of a deleted trip."""
+    trip_membership_cache.invalidate([instance.id])
+
+
+@receiver(m2m_changed, sender=Trip.members.through)
+def invalidate_trip_membership_on_members_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drop the cached chat membership of trips whose members changed."""
+    if action == 'pre_clear' and reverse:
+        # pk_set is empty for clear(); remember the user's trips first
+        instance._cleared_membership_trip_ids = list(instance.joined_trips.values_list('id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        trip_membership_cache.invalidate([instance.id])
+    elif action == 'post_clear':
+        trip_membership_cache.invalidate(getattr(instance, '_cleared_membership_trip_ids', []))
+    else:
+        trip_membership_cache.invalidate(pk_set)
+
+
+@receiver(post_save, sender=TripNotification)
+def push_trip_notification(sender, instance, created, **kwargs):
+    """Push new trip notifications to the user's sockets."""
+    if created:
+        push_to_user(instance.user_id, {'type': 'trip_notification', 'notification': notification_payload(instance)})
+
+
+@receiver(post_save, sender=Trip)
+def push_created_trip_membership(sender, instance, created, **kwargs):
+    """The creator's sockets follow the chat of a new trip."""
+    if created:
+        push_trip_membership(instance.user_id, instance.id, True)
+
+
+@receiver(m2m_changed, sender=Trip.members.through)
+def push_trip_membership_changes(sender, instance, action, reverse, pk_set, **kwargs):
+    """Make the sockets of joining and leaving members follow or drop the trip's chat."""
+    if action == 'pre_clear':
+        # pk_set is empty for clear(); remember the removed side first
+        if reverse:
+            instance._cleared_push_trip_ids = list(instance.joined_trips.values_list('id', flat=True))
+        else:
+            instance._cleared_push_member_ids = list(instance.members.values_list('id', flat=True))
+        return
+    if action == 'post_clear':
+        action = 'post_remove'
+        pk_set = getattr(instance, '_cleared_push_trip_ids' if reverse else '_cleared_push_member_ids', [])
+    if action not in ('post_add', 'post_remove'):
+        return
+
+    joined = action == 'post_add'
+    if reverse:
+        for trip_id in pk_set:
+            push_trip_membership(instance.id, trip_id, joined)
+    else:
+        for user_id in pk_set:
+            push_trip_membership(user_id, instance.id, joined)
+
+
+@receiver(post_migrate)
+def restore_chat_search_triggers(sender, using, **kwargs):
+    """SQLite drops the search triggers when a migration rebuilds the chat table."""
+    if sender.name == 'auth_app':
+        from django.db import connections
+        restore_search_triggers(connections[using])
+
+
+@receiver(post_delete, sender=ChatArchiveSegment)
+def remove_chat_archive_file(sender, instance, **kwargs):
+    """Delete the segment file with its row (e.g. when the trip is deleted)."""
+    try:
+        os.remove(os.path.join(archive_dir(), instance.path))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,254 @@
+"""
+MinHash/LSH index of open trips over their activity sets.
+
+Every other matching path requires the destination to match. To find trips
+with a similar activity profile at any destination without comparing against
+every trip, each trip gets a MinHash signature of its TravelInterest ids and
+the signature is split into bands; trips that agree on all rows of at least
+one band land in the same bucket. A query only looks at the trips sharing a
+bucket with the reference and ranks them by exact Jaccard similarity.
+
+With NUM_BANDS bands of ROWS_PER_BAND rows, a pair with Jaccard similarity s
+becomes a candidate with probability 1 - (1 - s^ROWS_PER_BAND)^NUM_BANDS,
+i.e. ~0.73 at s = 0.2, ~0.95 at s = 0.3 and above 0.999 at s = 0.5. Trips
+only list a handful of activities, so the bands are kept short.
+
+The index is loaded from the database on first use. Every committed change
+to an open trip (signals.py, on commit) increments a change counter in the
+'shared' cache; each process reads it at most once per
+GENERATION_CHECK_SECONDS and reloads if another process changed a trip since
+its last load. Its own changes are applied in place as long as no other
+change came in between. The index is also reloaded after
+SIMILAR_TRIP_INDEX_TTL_SECONDS, and the rebuild_similarity_index management
+command bumps a generation counter that makes every process reload.
+"""
+import logging
+import random
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+
+from .interval_index import GENERATION_CHECK_SECONDS
+from .models import Trip
+
+logger = logging.getLogger(__name__)
+
+GENERATION_CACHE_KEY = 'similar_trip_index:generation'
+CHANGES_CACHE_KEY = 'similar_trip_index:changes'
+
+NUM_BANDS = 32
+ROWS_PER_BAND = 2
+NUM_PERMUTATIONS = NUM_BANDS * ROWS_PER_BAND
+
+# Universal hash functions h(x) = (a * x + b) mod p; p < 2^31 keeps a * x within uint64
+_PRIME = (1 << 31) - 1
+_rng = random.Random(20240917)
+_HASH_A = np.array([_rng.randrange(1, _PRIME) for _ in range(NUM_PERMUTATIONS)], dtype=np.uint64)
+_HASH_B = np.array([_rng.randrange(0, _PRIME) for _ in range(NUM_PERMUTATIONS)], dtype=np.uint64)
+
+
+def minhash_signature(activity_ids):
+    """
+    Compute the MinHash signature of a set of TravelInterest ids.
+
+    Returns:
+        ndarray: NUM_PERMUTATIONS uint64 values, or None for an empty set
+    """
+    if not activity_ids:
+        return None
+    ids = np.fromiter((int(activity_id) % _PRIME for activity_id in set(activity_ids)), dtype=np.uint64)
+    hashes = (_HASH_A[:, None] * ids[None, :] + _HASH_B[:, None]) % np.uint64(_PRIME)
+    return hashes.min(axis=1)
+
+
+def band_keys(signature):
+    """Split a signature into one hashable bucket key per band."""
+    return [
+        signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND].tobytes()
+        for band in range(NUM_BANDS)
+    ]
+
+
+def jaccard(a, b):
+    """Exact Jaccard similarity of two sets."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class SimilarTripIndex:
+    """LSH buckets over the MinHash signatures of open trips."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = [{} for _ in range(NUM_BANDS)]
+        # trip id -> (user_id, destination_id, activity set, band keys)
+        self._trips = {}
+        self._loaded_at = None
+        self._generation = None
+        # Value of the shared change counter the loaded index reflects
+        self._changes = None
+        self._generation_checked_at = None
+
+    @staticmethod
+    def _is_indexed(trip):
+        return trip.status == 'open'
+
+    def _add(self, trip_id, user_id, destination_id, activity_ids):
+        signature = minhash_signature(activity_ids)
+        if signature is None:
+            return
+        keys = band_keys(signature)
+        for band, key in enumerate(keys):
+            self._buckets[band].setdefault(key, set()).add(trip_id)
+        self._trips[trip_id] = (user_id, destination_id, frozenset(activity_ids), keys)
+
+    def _remove(self, trip_id):
+        entry = self._trips.pop(trip_id, None)
+        if entry is None:
+            return
+        for band, key in enumerate(entry[3]):
+            bucket = self._buckets[band].get(key)
+            if bucket is not None:
+                bucket.discard(trip_id)
+                if not bucket:
+                    del self._buckets[band][key]
+
+    def _load(self):
+        self._buckets = [{} for _ in range(NUM_BANDS)]
+        self._trips = {}
+        trips = Trip.objects.filter(status='open').values_list('id', 'user_id', 'destination_id', 'activity_ids')
+        for trip_id, user_id, destination_id, activity_ids in trips:
+            self._add(trip_id, user_id, destination_id, activity_ids)
+        self._loaded_at = time.monotonic()
+
+    @staticmethod
+    def _shared_generations():
+        """
+        Read the generation and change counters in one round trip.
+
+        A missing change counter (evicted or cleared cache) is created with a
+        fresh time-based value, so an index loaded before can never match it.
+        """
+        cache = caches['shared']
+        values = cache.get_many([GENERATION_CACHE_KEY, CHANGES_CACHE_KEY])
+        if CHANGES_CACHE_KEY not in values:
+            cache.add(CHANGES_CACHE_KEY, time.time_ns(), None)
+            values[CHANGES_CACHE_KEY] = cache.get(CHANGES_CACHE_KEY)
+        return values.get(GENERATION_CACHE_KEY), values[CHANGES_CACHE_KEY]
+
+    def _ensure_loaded(self):
+        now = time.monotonic()
+        if self._generation_checked_at is None or now - self._generation_checked_at >= GENERATION_CHECK_SECONDS:
+            self._generation_checked_at = now
+            try:
+                generation, changes = self._shared_generations()
+            except Exception as e:
+                # Without the shared cache other processes' changes are invisible: reload from the database
+                logger.warning(f"Error reading the similarity index generation: {str(e)}")
+                generation, changes = None, None
+                self._loaded_at = None
+            if generation != self._generation or changes != self._changes:
+                self._generation = generation
+                self._changes = changes
+                self._loaded_at = None
+        if self._loaded_at is None or now - self._loaded_at > settings.SIMILAR_TRIP_INDEX_TTL_SECONDS:
+            self._load()
+
+    def similar(self, activity_ids, exclude_trip_id=None, exclude_user_id=None, min_similarity=0.0):
+        """
+        Find open trips at any destination with a similar set of activities.
+
+        Args:
+            activity_ids (iterable): TravelInterest ids of the reference
+            exclude_trip_id (int): Trip to leave out (usually the reference itself)
+            exclude_user_id (int): Leave out trips created by this user
+            min_similarity (float): Minimum exact Jaccard similarity
+
+        Returns:
+            list: (similarity, trip_id, user_id, destination_id) tuples, unordered
+        """
+        activities = frozenset(activity_ids)
+        signature = minhash_signature(activities)
+        if signature is None:
+            return []
+
+        with self._lock:
+            self._ensure_loaded()
+            candidates = set()
+            for band, key in enumerate(band_keys(signature)):
+                candidates.update(self._buckets[band].get(key, ()))
+            candidates.discard(exclude_trip_id)
+
+            results = []
+            for trip_id in candidates:
+                user_id, destination_id, other_activities, _ = self._trips[trip_id]
+                if user_id == exclude_user_id:
+                    continue
+                similarity = jaccard(activities, other_activities)
+                if similarity >= min_similarity:
+                    results.append((round(similarity, 4), trip_id, user_id, destination_id))
+            return results
+
+    @staticmethod
+    def _bump():
+        """Increment the shared change counter; the new value, or None if the cache failed."""
+        cache = caches['shared']
+        try:
+            cache.add(CHANGES_CACHE_KEY, time.time_ns(), None)
+            return cache.incr(CHANGES_CACHE_KEY)
+        except Exception as e:
+            logger.warning(f"Error publishing a similarity index change: {str(e)}")
+            return None
+
+    def _apply(self, changes, change):
+        # Apply this process's own change if nobody else changed a trip since
+        # the index was loaded; otherwise reload it on next use
+        if self._loaded_at is None:
+            return
+        if changes is None or self._changes is None or changes != self._changes + 1:
+            self._loaded_at = None
+            return
+        change()
+        self._changes = changes
+
+    def update_trip(self, trip):
+        """Publish a committed save or activity change of a trip and apply it to this process's index."""
+        changes = self._bump()
+
+        def change():
+            self._remove(trip.id)
+            if self._is_indexed(trip):
+                self._add(trip.id, trip.user_id, trip.destination_id, trip.activity_ids)
+
+        with self._lock:
+            self._apply(changes, change)
+
+    def remove_trip(self, trip_id):
+        """Publish a committed delete of a trip and drop it from this process's index."""
+        changes = self._bump()
+        with self._lock:
+            self._apply(changes, lambda: self._remove(trip_id))
+
+    def rebuild(self):
+        """
+        Reload the index from the database.
+
+        Returns:
+            int: Number of indexed trips
+        """
+        with self._lock:
+            self._generation, self._changes = self._shared_generations()
+            self._generation_checked_at = time.monotonic()
+            self._load()
+            return len(self._trips)
+
+    def invalidate_all_processes(self):
+        """Bump the shared generation so every process reloads its index."""
+        caches['shared'].set(GENERATION_CACHE_KEY, time.time_ns(), None)
+
+
+similar_trip_index = SimilarTripIndex()
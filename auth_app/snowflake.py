@@ -0,0 +1,265 @@
+"""
+Time-ordered 53-bit ids ("snowflakes") assigned by the application server.
+
+Chat messages get their id before they are written to the database, so a
+message can be broadcast with its final id while it is still queued for
+write-behind persistence. Ids are laid out as
+
+    | 41 bits: milliseconds since EPOCH_MS | 5 bits: worker | 7 bits: sequence |
+
+which keeps them increasing over time (so "id > cursor" means "newer") and
+below 2^53 so JavaScript clients can handle them as plain numbers. Each
+worker can issue 128 ids per millisecond; after that the generator waits for
+the next millisecond.
+
+Every running process must use a distinct worker id. Either set
+CHAT_WORKER_ID per process, or leave it unset and each process leases a free
+id from the SnowflakeWorkerLease table: the lease lasts
+CHAT_WORKER_LEASE_SECONDS and is renewed by a background thread every third
+of that. A process whose lease could not be renewed in time stops using the
+id and leases a new one, so an id is only handed to another process after its
+previous holder stopped issuing it (assuming host clocks are synchronized, as
+time-ordered ids already do). When all 32 ids are leased, the process refuses
+to issue ids.
+
+Only processes that issue chat ids hold a lease: ASGI workers lease theirs at
+lifespan startup, any other process on its first chat message. Management
+commands, shells and the runserver autoreloader parent never lease one. A
+lease is released when its process exits and a crashed process's lease is
+free again after CHAT_WORKER_LEASE_SECONDS, so the 32 ids bound the number of
+processes issuing chat ids at the same time, not the number ever started.
+
+Leasing queries the database, so async code (the chat consumers) uses
+anext_snowflake_id(), which leases on a database thread instead of blocking
+the event loop.
+"""
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# 2024-01-01T00:00:00Z
+EPOCH_MS = 1704067200000
+
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class SnowflakeGenerator:
+    """Thread-safe generator of increasing snowflake ids for one worker."""
+
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f'worker_id must be between 0 and {MAX_WORKER_ID}')
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now_ms = int(time.time() * 1000) - EPOCH_MS
+            # Never go back in time, even if the clock does
+            if now_ms < self._last_ms:
+                now_ms = self._last_ms
+
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond
+                    while now_ms <= self._last_ms:
+                        time.sleep(0.0001)
+                        now_ms = int(time.time() * 1000) - EPOCH_MS
+            else:
+                self._sequence = 0
+
+            self._last_ms = now_ms
+            return (now_ms << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+def snowflake_timestamp_ms(snowflake_id):
+    """Unix time in milliseconds at which an id was generated."""
+    return (snowflake_id >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH_MS
+
+
+def first_snowflake_at(timestamp_ms):
+    """Lowest id any worker can issue at Unix time ``timestamp_ms``."""
+    return max(timestamp_ms - EPOCH_MS, 0) << (WORKER_BITS + SEQUENCE_BITS)
+
+
+def lease_seconds():
+    return getattr(settings, 'CHAT_WORKER_LEASE_SECONDS', 60)
+
+
+def claim_worker_id(owner, duration):
+    """
+    Lease a free worker id.
+
+    Only expired leases are claimed, each with a conditional UPDATE, so two
+    processes racing for the same id cannot both win it.
+
+    Args:
+        owner: Identifier of the claiming process
+        duration: Lease duration in seconds
+
+    Returns:
+        int: The leased worker id, or None if every id is leased
+    """
+    from .models import SnowflakeWorkerLease
+
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=duration)
+    expired = SnowflakeWorkerLease.objects.filter(expires_at__lt=now).values_list('worker_id', flat=True)
+    for worker_id in expired.order_by('worker_id'):
+        claimed = SnowflakeWorkerLease.objects.filter(
+            worker_id=worker_id, expires_at__lt=now
+        ).update(owner=owner, expires_at=expires_at)
+        if claimed:
+            return worker_id
+    return None
+
+
+def renew_worker_lease(worker_id, owner, duration):
+    """Extend a lease; False if it expired and was claimed by another process."""
+    from .models import SnowflakeWorkerLease
+
+    return SnowflakeWorkerLease.objects.filter(worker_id=worker_id, owner=owner).update(
+        expires_at=timezone.now() + timedelta(seconds=duration)
+    ) == 1
+
+
+def release_worker_lease(worker_id, owner):
+    from .models import SnowflakeWorkerLease
+
+    SnowflakeWorkerLease.objects.filter(worker_id=worker_id, owner=owner).update(
+        owner='', expires_at=timezone.now()
+    )
+
+
+class WorkerLease:
+    """This process's lease on a worker id, renewed by a daemon thread."""
+
+    def __init__(self):
+        self.owner = f'{socket.gethostname()[:60]}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.worker_id = None
+        # time.monotonic() after which the id must no longer be used
+        self.valid_until = 0.0
+        self._renewer = None
+
+    @property
+    def is_valid(self):
+        return self.worker_id is not None and time.monotonic() < self.valid_until
+
+    def acquire(self):
+        """Lease a worker id (database access; not on an event loop thread)."""
+        duration = lease_seconds()
+        started = time.monotonic()
+        worker_id = claim_worker_id(self.owner, duration)
+        if worker_id is None:
+            raise ImproperlyConfigured(
+                f'All {MAX_WORKER_ID + 1} snowflake worker ids are leased; run fewer processes '
+                'or set CHAT_WORKER_ID explicitly'
+            )
+        if worker_id != self.worker_id:
+            logger.info(f"Leased snowflake worker id {worker_id} ({self.owner})")
+        self.worker_id = worker_id
+        self.valid_until = started + duration
+
+        if self._renewer is None:
+            self._renewer = threading.Thread(target=self._renew_forever, name='snowflake-lease', daemon=True)
+            self._renewer.start()
+            atexit.register(self.release)
+        return worker_id
+
+    def renew(self):
+        duration = lease_seconds()
+        started = time.monotonic()
+        if renew_worker_lease(self.worker_id, self.owner, duration):
+            self.valid_until = started + duration
+        else:
+            logger.warning(f"Lost the lease on snowflake worker id {self.worker_id}; leasing a new one")
+            self.valid_until = 0.0
+
+    def _renew_forever(self):
+        while True:
+            time.sleep(lease_seconds() / 3)
+            if self.worker_id is None:
+                continue
+            try:
+                self.renew()
+            except Exception as e:
+                # Retried on the next round; ids stop being issued once the lease runs out
+                logger.warning(f"Error renewing snowflake worker lease {self.worker_id}: {str(e)}")
+            finally:
+                close_old_connections()
+
+    def release(self):
+        if self.worker_id is None:
+            return
+        try:
+            release_worker_lease(self.worker_id, self.owner)
+        except Exception as e:
+            logger.warning(f"Error releasing snowflake worker lease {self.worker_id}: {str(e)}")
+
+
+_generator = None
+_generator_lock = threading.Lock()
+_lease = None
+
+
+def _current_generator():
+    global _generator, _lease
+    with _generator_lock:
+        worker_id = getattr(settings, 'CHAT_WORKER_ID', None)
+        if worker_id is not None:
+            if _generator is None:
+                _generator = SnowflakeGenerator(worker_id)
+            return _generator
+
+        if _lease is None:
+            _lease = WorkerLease()
+        if not _lease.is_valid:
+            worker_id = _lease.acquire()
+            # Keep the generator (and its last timestamp) when the same id is leased again
+            if _generator is None or _generator.worker_id != worker_id:
+                _generator = SnowflakeGenerator(worker_id)
+        return _generator
+
+
+def _needs_generator():
+    return _generator is None or (_lease is not None and not _lease.is_valid)
+
+
+def next_snowflake_id():
+    """Return the next id from this process's generator (may query the database: not on an event loop)."""
+    generator = _generator
+    if _needs_generator():
+        generator = _current_generator()
+    return generator.next_id()
+
+
+async def anext_snowflake_id():
+    """next_snowflake_id() for async code: a lease is taken or renewed on a database thread."""
+    generator = _generator
+    if _needs_generator():
+        generator = await database_sync_to_async(_current_generator)()
+    return generator.next_id()
+
+
+def prepare_generator():
+    """Lease this process's worker id ahead of its first chat id (nothing to do with CHAT_WORKER_ID)."""
+    _current_generator()
@@ -0,0 +1,118 @@
+"""
+Structured, lazily formatted and sampled logging for hot paths.
+
+Hot paths (chat sockets, matching, trip lists) log through get_logger()
+instead of f-strings on a stdlib logger:
+
+    log = get_logger(__name__)
+    log.debug('chat_connect', trip_id=trip_id, user_id=user.id)
+
+- Lazy: nothing is formatted unless the record is emitted. The level check
+  and the sampling decision come first; field values may be callables
+  (e.g. ``lambda: queryset.count()``), which are only called when emitted.
+- Sampled: DEBUG and INFO records of a logger are kept with the rate
+  configured for it (or its closest parent) in LOG_SAMPLE_RATES; warnings
+  and errors are never sampled.
+- Structured: the event name and fields travel in the record
+  (``record.event`` / ``record.fields``) and are rendered by StructuredFormatter
+  as ``event key=value ...`` or, with LOG_FORMAT = 'json', as one JSON object
+  per line.
+
+Work that only exists to feed logs, such as extra queries, is gated by
+debug_queries_enabled() (LOG_DEBUG_QUERIES, off by default).
+"""
+import json
+import logging
+import random
+from functools import lru_cache
+
+from django.conf import settings
+
+
+def debug_queries_enabled():
+    """Whether code may run database queries whose only purpose is logging."""
+    return getattr(settings, 'LOG_DEBUG_QUERIES', False)
+
+
+@lru_cache(maxsize=256)
+def sample_rate(name):
+    """Sample rate of a logger: its own entry in LOG_SAMPLE_RATES or its closest parent's."""
+    rates = getattr(settings, 'LOG_SAMPLE_RATES', {})
+    while name:
+        if name in rates:
+            return rates[name]
+        name = name.rpartition('.')[0]
+    return rates.get('', 1.0)
+
+
+class StructuredLogger:
+    """Wraps a stdlib logger with lazy, sampled ``event, **fields`` calls."""
+
+    __slots__ = ('logger',)
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def is_enabled(self, level):
+        """Level and sampling check; call it before preparing expensive fields."""
+        if not self.logger.isEnabledFor(level):
+            return False
+        if level >= logging.WARNING:
+            return True
+        rate = sample_rate(self.logger.name)
+        return rate >= 1 or random.random() < rate
+
+    def log(self, level, event, **fields):
+        if not self.is_enabled(level):
+            return
+        for key, value in fields.items():
+            if callable(value):
+                fields[key] = value()
+        # The message stays the bare event name; formatters render the fields
+        self.logger.log(level, event, extra={'event': event, 'fields': fields}, stacklevel=3)
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+
+def get_logger(name):
+    return StructuredLogger(logging.getLogger(name))
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Renders structured records as ``event key=value ...`` (or JSON lines with
+    ``json_lines=True``); plain records are formatted as usual.
+    """
+
+    def __init__(self, *args, json_lines=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None)
+        if self.json_lines:
+            payload = {
+                'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'event': getattr(record, 'event', None) or record.getMessage(),
+                **(fields or {})
+            }
+            if record.exc_info:
+                payload['exc_info'] = self.formatException(record.exc_info)
+            return json.dumps(payload, default=str)
+
+        text = super().format(record)
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value!r}' for key, value in fields.items())
+        return text
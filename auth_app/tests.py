@@ -1,3 +1,1799 @@
-from django.test import TestCase
+import asyncio
+import atexit
+import json
+import logging
+import random
+import shutil
+import tempfile
+import time
+import weakref
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import caches
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import chat_limits, compatibility_store, snowflake
+from .channel_layers import SQLiteChannelLayer
+from .chat_archive import archive_trip
+from .chat_limits import TokenBucket, chat_counters, take_token, user_bucket
+from .chat_cursors import is_message_read, mark_messages_read, unread_count
+from .chat_persistence import ChatWriteBehindQueue, persist_messages_one_by_one
+from .chat_search import mark_terms, search_messages, search_terms
+from .consumers import ChatSocketMixin
+from .compatibility import ScoringContext, compatibility_scores, shared_activity_count
+from .interval_index import IntervalTree, TripIntervalIndex
+from .models import (ChatMessage, ChatReadCursor, PreferredDestination, SnowflakeWorkerLease, TravelInterest, Trip,
+                     TripCompatibility, UserPreferences, UserProfile)
+from .recent_messages import RecentMessageBuffers
+from .routing import websocket_urlpatterns
+from .score_cache import ScoreCache, score_cache
+from .similarity_index import NUM_BANDS, SimilarTripIndex, band_keys, jaccard, minhash_signature
+from .wire_formats import (SUBPROTOCOL_JSON_MIN, SUBPROTOCOL_MSGPACK, chat_frame, compact_chat_message, decode_frame,
+                           dumps_compact, encode_chat_frame, encode_frame, history_frame, select_subprotocol)
+from .lifespan import lifespan_application
+from .membership_cache import TripMembershipCache, trip_membership_cache
+from .presence import PresenceRegistry
+from .ranking import decode_cursor, encode_cursor, top_k
+from .structured_logging import StructuredFormatter, get_logger, sample_rate
+from .snowflake import (MAX_WORKER_ID, SEQUENCE_BITS, anext_snowflake_id, claim_worker_id, first_snowflake_at,
+                        next_snowflake_id, release_worker_lease, renew_worker_lease)
+
+
+# A 'shared' cache private to the test process, cleared by the tests that use it
+LOCAL_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared'},
+}
+
+
+def make_user(username, frequency=None, budget=None):
+    user = UserProfile.objects.create(username=username, email=f'{username}@example.com')
+    if frequency or budget:
+        UserPreferences.objects.create(user=user, travel_frequency=frequency, travel_budget=budget)
+    return user
+
+
+def make_trip(user, destination, start_in_days, days, activities=(), members=()):
+    start = timezone.now() + timedelta(days=start_in_days)
+    trip = Trip.objects.create(
+        user=user,
+        destination=destination,
+        start_date=start,
+        end_date=start + timedelta(days=days),
+        max_members=10
+    )
+    trip.activities.set(activities)
+    trip.members.add(*members)
+    return trip
+
+
+def baseline_compatibility_score(trip1, trip2):
+    """The per-pair score the vectorized scorer replaced (four queries per pair)."""
+    if trip1.destination_id != trip2.destination_id:
+        return 0
+
+    date_score = 0
+    start_overlap = max(trip1.start_date, trip2.start_date)
+    end_overlap = min(trip1.end_date, trip2.end_date)
+    if start_overlap <= end_overlap:
+        overlap_days = (end_overlap - start_overlap).days + 1
+        total_days = min((trip1.end_date - trip1.start_date).days + 1, (trip2.end_date - trip2.start_date).days + 1)
+        date_score = (overlap_days / total_days) * 100
+
+    activities_score = 0
+    trip1_activities = set(trip1.activities.values_list('id', flat=True))
+    trip2_activities = set(trip2.activities.values_list('id', flat=True))
+    if trip1_activities and trip2_activities:
+        activities_score = len(trip1_activities & trip2_activities) / len(trip1_activities) * 100
+
+    preferences_score = 0
+    try:
+        trip1_prefs = UserPreferences.objects.get(user=trip1.user)
+        trip2_prefs = UserPreferences.objects.get(user=trip2.user)
+        if trip1_prefs.travel_frequency == trip2_prefs.travel_frequency:
+            preferences_score += 10
+        if trip1_prefs.travel_budget == trip2_prefs.travel_budget:
+            preferences_score += 10
+    except UserPreferences.DoesNotExist:
+        pass
+
+    return round(date_score * 0.3 + activities_score * 0.5 + preferences_score * 0.2, 2)
+
+
+async def open_socket(path, user, subprotocols=None):
+    """Connect a WebSocket as ``user`` (authentication middleware left out)."""
+    communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path, subprotocols=subprotocols)
+    communicator.scope['user'] = user
+    connected, subprotocol = await communicator.connect()
+    assert connected, f'{path} refused {user.username}'
+    communicator.accepted_subprotocol = subprotocol
+    return communicator
+
+
+def old_message_id(seconds_ago, sequence=0):
+    """A snowflake id issued ``seconds_ago`` seconds ago."""
+    return first_snowflake_at(int((time.time() - seconds_ago) * 1000)) + sequence
+
+
+class CompatibilityScoringTests(TestCase):
+    """The vectorized scorer (compatibility.py) against the original per-pair score."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.goa = PreferredDestination.objects.create(name='Goa')
+        cls.manali = PreferredDestination.objects.create(name='Manali')
+        cls.activities = [TravelInterest.objects.create(name=f'Activity {i}') for i in range(6)]
+
+    def test_vectorized_scores_match_baseline(self):
+        a = self.activities
+        reference = make_trip(make_user('ref', 'Frequently', 'low'), self.goa, 10, 5, a[:3])
+        candidates = [
+            make_trip(make_user('same', 'Frequently', 'low'), self.goa, 10, 5, a[:3]),
+            make_trip(make_user('partial', 'Rarely', 'low'), self.goa, 12, 10, a[2:5]),
+            make_trip(make_user('no_prefs'), self.goa, 14, 1, a[:1]),
+            make_trip(make_user('no_activities', 'Frequently', 'high'), self.goa, 8, 3),
+            make_trip(make_user('no_overlap', 'Occasionally', 'medium'), self.goa, 40, 2, a),
+            make_trip(make_user('elsewhere', 'Frequently', 'low'), self.manali, 10, 5, a[:3]),
+        ]
+
+        scores = compatibility_scores(reference, candidates)
+
+        for candidate in candidates:
+            self.assertAlmostEqual(
+                scores[candidate.id], baseline_compatibility_score(reference, candidate), places=2,
+                msg=candidate.user.username
+            )
+        self.assertEqual(scores[candidates[-1].id], 0)
+
+
+class IntervalTreeTests(SimpleTestCase):
+    """IntervalTree against a brute-force scan, across its lazy rebuilds."""
+
+    def assert_matches_brute_force(self, tree, intervals, rng):
+        for _ in range(50):
+            start = rng.randint(0, 1000)
+            end = start + rng.randint(0, 100)
+            expected = sorted(
+                (key, s, e, value) for key, (s, e, value) in intervals.items() if s <= end and e >= start
+            )
+            self.assertEqual(sorted(tree.overlapping(start, end)), expected)
+
+    def test_add_remove_and_overlap(self):
+        rng = random.Random(7)
+        tree = IntervalTree()
+        intervals = {}
+        for step in range(600):
+            key = rng.randrange(200)
+            if key in intervals and rng.random() < 0.4:
+                tree.remove(key)
+                del intervals[key]
+            else:
+                # Adding an existing key replaces its interval
+                start = rng.randint(0, 1000)
+                intervals[key] = (start, start + rng.randint(0, 50), f'trip {key}')
+                tree.add(key, *intervals[key])
+            if step % 40 == 0:
+                self.assert_matches_brute_force(tree, intervals, rng)
+        self.assertEqual(len(tree), len(intervals))
+        self.assert_matches_brute_force(tree, intervals, rng)
+
+    def test_closed_interval_bounds(self):
+        tree = IntervalTree()
+        tree.add(1, 10, 20)
+        self.assertEqual(tree.overlapping(20, 30), [(1, 10, 20, None)])
+        self.assertEqual(tree.overlapping(0, 10), [(1, 10, 20, None)])
+        self.assertEqual(tree.overlapping(21, 30), [])
+        tree.remove(1)
+        tree.remove(1)
+        self.assertEqual(tree.overlapping(0, 30), [])
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class TripIntervalIndexTests(TestCase):
+    """The interval index follows committed trip changes, including those of other processes."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.goa = PreferredDestination.objects.create(name='Goa')
+        cls.owner = make_user('owner')
+        cls.buddy = make_user('buddy')
+
+    def setUp(self):
+        caches['shared'].clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.trip = make_trip(self.owner, self.goa, 10, 5)
+
+    def overlapping_ids(self, index):
+        return {trip_id for trip_id, _, _ in index.overlapping(self.goa.id, self.trip.start_date, self.trip.end_date)}
+
+    def test_find_travel_buddies_sees_trip_saved_by_another_process(self):
+        # A second index stands in for another worker process that loaded the tree first
+        other_process = TripIntervalIndex()
+        self.assertEqual(self.overlapping_ids(other_process), {self.trip.id})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            buddy_trip = make_trip(self.buddy, self.goa, 12, 5)
+
+        with mock.patch('auth_app.views.trip_interval_index', other_process):
+            response = self.client.post(
+                reverse('find-travel-buddies'),
+                {
+                    'trip_id': self.trip.id,
+                    'destination': self.goa.name,
+                    'start_date': self.trip.start_date.isoformat(),
+                    'end_date': self.trip.end_date.isoformat(),
+                },
+                content_type='application/json',
+                HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.owner)}'
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([buddy['id'] for buddy in response.json()['buddies']], [self.buddy.id])
+        self.assertEqual(self.overlapping_ids(other_process), {self.trip.id, buddy_trip.id})
+
+    def test_own_changes_are_applied_without_reloading(self):
+        index = TripIntervalIndex()
+        self.overlapping_ids(index)
+        with mock.patch('auth_app.signals.trip_interval_index', index), \
+                mock.patch.object(index, '_load', wraps=index._load) as load:
+            with self.captureOnCommitCallbacks(execute=True):
+                buddy_trip = make_trip(self.buddy, self.goa, 12, 5)
+            self.assertEqual(self.overlapping_ids(index), {self.trip.id, buddy_trip.id})
+
+            with self.captureOnCommitCallbacks(execute=True):
+                buddy_trip.status = 'cancelled'
+                buddy_trip.save()
+            self.assertEqual(self.overlapping_ids(index), {self.trip.id})
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.trip.delete()
+            self.assertEqual(self.overlapping_ids(index), set())
+        load.assert_not_called()
+
+    def test_rolled_back_save_leaves_no_trip(self):
+        index = TripIntervalIndex()
+        self.overlapping_ids(index)
+        with mock.patch('auth_app.signals.trip_interval_index', index):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                with self.assertRaises(RuntimeError), transaction.atomic():
+                    make_trip(self.buddy, self.goa, 12, 5)
+                    raise RuntimeError
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.overlapping_ids(index), {self.trip.id})
+
+    def test_moving_a_trip_updates_both_destinations(self):
+        manali = PreferredDestination.objects.create(name='Manali')
+        other_process = TripIntervalIndex()
+        self.overlapping_ids(other_process)
+        other_process.overlapping(manali.id, self.trip.start_date, self.trip.end_date)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.trip.destination = manali
+            self.trip.save()
+
+        self.assertEqual(self.overlapping_ids(other_process), set())
+        self.assertEqual(
+            [trip_id for trip_id, _, _ in other_process.overlapping(manali.id, self.trip.start_date, self.trip.end_date)],
+            [self.trip.id]
+        )
+
+    def test_unreadable_shared_cache_falls_back_to_the_database(self):
+        index = TripIntervalIndex()
+        self.overlapping_ids(index)
+        with self.captureOnCommitCallbacks(execute=True):
+            buddy_trip = make_trip(self.buddy, self.goa, 12, 5)
+        with mock.patch.object(index, '_shared_generations', side_effect=ConnectionError):
+            self.assertEqual(self.overlapping_ids(index), {self.trip.id, buddy_trip.id})
+
+
+@override_settings(COMPATIBILITY_REFRESH_IN_BACKGROUND=False)
+class CompatibilityRefreshTests(TestCase):
+    """Stored TripCompatibility rows are refreshed only when a scoring input changes."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.goa = PreferredDestination.objects.create(name='Goa')
+        cls.activities = [TravelInterest.objects.create(name=f'Activity {i}') for i in range(3)]
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other = make_trip(make_user('other', 'Rarely', 'low'), self.goa, 10, 5, self.activities)
+            self.trip = make_trip(make_user('owner', 'Rarely', 'low'), self.goa, 11, 3, self.activities[:2])
+        self.trip.refresh_from_db()
+
+    def stored_score(self, trip, other):
+        return TripCompatibility.objects.get(trip=trip, other_trip=other).score
+
+    def test_new_trip_is_scored_in_both_directions(self):
+        scores = compatibility_scores(self.trip, [self.other])
+        reverse = compatibility_scores(self.other, [self.trip])
+        self.assertEqual(self.stored_score(self.trip, self.other), scores[self.other.id])
+        self.assertEqual(self.stored_score(self.other, self.trip), reverse[self.trip.id])
+        self.assertIsNotNone(self.trip.compatibility_refreshed_at)
+
+    def test_changes_in_one_transaction_refresh_once(self):
+        with mock.patch.object(
+            compatibility_store, 'refresh_trip_compatibility', wraps=compatibility_store.refresh_trip_compatibility
+        ) as refresh:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.trip.start_date += timedelta(days=20)
+                self.trip.end_date += timedelta(days=20)
+                self.trip.save()
+                self.trip.activities.set(self.activities)
+        refresh.assert_called_once_with(self.trip.id)
+        self.trip.refresh_from_db()
+        expected = compatibility_scores(self.trip, [self.other])[self.other.id]
+        self.assertEqual(self.stored_score(self.trip, self.other), expected)
+
+    def test_unrelated_changes_schedule_nothing(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.trip.description = 'Bring sunscreen'
+            self.trip.save()
+            preferences = UserPreferences.objects.get(user=self.trip.user)
+            preferences.save()
+        self.assertEqual(callbacks, [])
+
+    def test_trips_without_stored_pairs_are_scored_on_first_read(self):
+        TripCompatibility.objects.all().delete()
+        Trip.objects.filter(id=self.trip.id).update(compatibility_refreshed_at=None)
+        self.trip.refresh_from_db()
+
+        compatibility_store.ensure_trip_compatibility(self.trip)
+
+        self.assertTrue(TripCompatibility.objects.filter(trip=self.trip, other_trip=self.other).exists())
+        self.trip.refresh_from_db()
+        self.assertIsNotNone(self.trip.compatibility_refreshed_at)
+
+
+class ActivityMaskTests(TestCase):
+    """The folded activity mask is a prefilter: ids above 63 collide but never hide a shared activity."""
+
+    def test_fold_never_drops_a_shared_activity(self):
+        rng = random.Random(4)
+        for _ in range(2000):
+            ids_a = rng.sample(range(1, 300), rng.randint(0, 6))
+            ids_b = rng.sample(range(1, 300), rng.randint(0, 6))
+            mask_a, mask_b = Trip.activity_mask_for(ids_a), Trip.activity_mask_for(ids_b)
+            shared = len(set(ids_a) & set(ids_b))
+
+            if shared:
+                self.assertNotEqual(mask_a & mask_b, 0, (ids_a, ids_b))
+            self.assertEqual(shared_activity_count(mask_a, ids_a, mask_b, ids_b), shared, (ids_a, ids_b))
+            self.assertLess(mask_a, 2 ** 63)
+
+    def test_compatible_trips_match_high_ids_and_drop_collisions(self):
+        # Ids 37, 100 and 163 all fold onto bit 36
+        folded = {
+            interest_id: TravelInterest.objects.create(id=interest_id, name=f'Activity {interest_id}')
+            for interest_id in (37, 100, 163)
+        }
+        self.assertEqual(len({Trip.activity_mask_for([interest_id]) for interest_id in folded}), 1)
+        goa = PreferredDestination.objects.create(name='Goa')
+        match = make_trip(make_user('match'), goa, 10, 3, [folded[100]])
+        make_trip(make_user('collision'), goa, 10, 3, [folded[163]])
+        make_trip(make_user('low_collision'), goa, 10, 3, [folded[37]])
+
+        client = APIClient()
+        client.force_authenticate(make_user('searcher'))
+        response = client.post(reverse('compatible-trips'), {
+            'destinationId': goa.id,
+            'activities': [100],
+            'startDate': match.start_date.isoformat(),
+            'endDate': match.end_date.isoformat(),
+        }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([trip['id'] for trip in response.json()], [match.id])
+
+
+class RankingTests(SimpleTestCase):
+    """Top-k selection and keyset cursors of the compatible-trip endpoints (ranking.py)."""
+
+    @staticmethod
+    def rows(scores):
+        return [(score, trip_id, f'trip {trip_id}') for trip_id, score in scores.items()]
+
+    def test_top_k_orders_by_score_then_trip_id(self):
+        rows = self.rows({7: 50.0, 3: 80.0, 9: 80.0, 1: 50.0, 5: 10.0})
+        random.Random(0).shuffle(rows)
+
+        page, cursor = top_k(rows, 4)
+
+        self.assertEqual([row[1] for row in page], [3, 9, 1, 7])
+        self.assertEqual(decode_cursor(cursor), (50.0, 7))
+        self.assertEqual(top_k(rows, 5), (sorted(rows, key=lambda row: (-row[0], row[1])), None))
+
+    def test_cursor_pages_neither_repeat_nor_skip_equal_scores(self):
+        rng = random.Random(1)
+        rows = self.rows({trip_id: rng.choice([1 / 3, 0.5, 75.0]) for trip_id in range(1, 40)})
+        expected = [row[1] for row in sorted(rows, key=lambda row: (-row[0], row[1]))]
+
+        seen, cursor = [], None
+        while True:
+            page, next_cursor = top_k(iter(rows), 4, decode_cursor(cursor) if cursor else None)
+            seen += [row[1] for row in page]
+            if next_cursor is None:
+                break
+            cursor = next_cursor
+
+        self.assertEqual(seen, expected)
+
+    def test_cursor_round_trip(self):
+        for score, trip_id in [(1 / 3, 12), (0.0, 1), (100.0, 2 ** 40)]:
+            cursor = encode_cursor(score, trip_id)
+            self.assertNotIn('=', cursor)
+            self.assertEqual(decode_cursor(cursor), (score, trip_id))
+        for cursor in ['', 'not a cursor', encode_cursor(1.0, 2)[:-3]]:
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+
+class ScoreCacheTests(TestCase):
+    """The versioned LRU of pair scores (score_cache.py) and its invalidation by signals."""
+
+    @classmethod
+    def setUpTestData(cls):
+        goa = PreferredDestination.objects.create(name='Goa')
+        cls.activities = [TravelInterest.objects.create(name=f'Activity {i}') for i in range(3)]
+        cls.reference = make_trip(make_user('ref', 'Frequently', 'low'), goa, 10, 5, cls.activities[:2])
+        cls.candidates = [
+            make_trip(make_user(f'user{i}', 'Rarely', 'high'), goa, 10 + i, 3, cls.activities[i:i + 2])
+            for i in range(3)
+        ]
+
+    def setUp(self):
+        score_cache.clear()
+        self.addCleanup(score_cache.clear)
+
+    @staticmethod
+    def key(trip_id, candidate_trip_id, version=0):
+        return ScoreCache.make_key(trip_id, candidate_trip_id, (version, version), (None, None))
+
+    @staticmethod
+    def cached_pairs():
+        return {key[:2] for key in score_cache._entries}
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = ScoreCache(maxsize=2)
+        cache.set_many([(self.key(1, 2), 10.0), (self.key(1, 3), 20.0)])
+        # Reading an entry makes it the most recently used
+        cache.get_many([self.key(1, 2)])
+        cache.set_many([(self.key(4, 5), 30.0)])
+
+        self.assertEqual(cache.get_many([self.key(1, 2), self.key(1, 3), self.key(4, 5)]),
+                         {self.key(1, 2): 10.0, self.key(4, 5): 30.0})
+        self.assertEqual(set(cache._keys_by_trip), {1, 2, 4, 5})
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_versions_with_equal_hashes_get_their_own_entries(self):
+        # hash(-1) == hash(-2) in CPython
+        cache = ScoreCache(maxsize=10)
+        cache.set_many([(self.key(1, 2, version=-1), 10.0)])
+        self.assertEqual(cache.get_many([self.key(1, 2, version=-2)]), {})
+
+    def test_signals_drop_the_entries_of_changed_trips_and_preferences(self):
+        candidate_ids = [candidate.id for candidate in self.candidates]
+        everything = {(self.reference.id, candidate_id) for candidate_id in candidate_ids}
+
+        def rescore():
+            ScoringContext.for_trip(self.reference).score(self.candidates)
+            self.assertEqual(self.cached_pairs(), everything)
+
+        rescore()
+        self.candidates[0].description = 'Bring snorkels'
+        self.candidates[0].save()
+        self.assertEqual(self.cached_pairs(), everything - {(self.reference.id, candidate_ids[0])})
+
+        rescore()
+        self.candidates[1].activities.add(self.activities[0])
+        self.assertEqual(self.cached_pairs(), everything - {(self.reference.id, candidate_ids[1])})
+
+        rescore()
+        UserPreferences.objects.get(user=self.candidates[2].user).delete()
+        self.assertEqual(self.cached_pairs(), everything - {(self.reference.id, candidate_ids[2])})
+
+        rescore()
+        Trip.objects.get(id=self.reference.id).save()
+        self.assertEqual(self.cached_pairs(), set())
+
+
+class CompatibilityShardingTests(TestCase):
+    """Scoring in the process pool gives the same scores as scoring in the calling thread."""
+
+    @classmethod
+    def setUpTestData(cls):
+        goa = PreferredDestination.objects.create(name='Goa')
+        a = [TravelInterest.objects.create(name=f'Activity {i}') for i in range(6)]
+        cls.reference = make_trip(make_user('ref', 'Frequently', 'low'), goa, 10, 5, a[:3])
+        budgets = ['low', 'medium', 'high']
+        cls.candidates = [
+            make_trip(make_user(f'user{i}', 'Frequently', budgets[i % 3]), goa, 8 + i, 1 + i % 4, a[i % 4:i % 4 + 2])
+            for i in range(9)
+        ]
+
+    def setUp(self):
+        score_cache.clear()
+        self.addCleanup(score_cache.clear)
+
+    def scores(self, context, **kwargs):
+        return [(score, trip.id) for score, trip in context.iter_scores(self.candidates, chunk_size=1, **kwargs)]
+
+    @override_settings(COMPATIBILITY_SHARD_SIZE=0)
+    def unsharded_scores(self):
+        return self.scores(ScoringContext.for_trip(self.reference), in_request=False)
+
+    @override_settings(COMPATIBILITY_SHARD_SIZE=2, COMPATIBILITY_SHARD_WORKERS=2)
+    def test_sharded_scores_match_unsharded(self):
+        expected = self.unsharded_scores()
+        score_cache.clear()
+
+        context = ScoringContext.for_trip(self.reference)
+        with mock.patch.object(context, 'score_sharded', wraps=context.score_sharded) as score_sharded:
+            self.assertEqual(self.scores(context, in_request=False), expected)
+        score_sharded.assert_called()
+
+        top = sorted(expected, key=lambda row: (-row[0], row[1]))[:3]
+        self.assertEqual([(score, trip.id) for score, trip in context.score_sharded(self.candidates, k=3)], top)
+
+    @override_settings(COMPATIBILITY_SHARD_SIZE=2, COMPATIBILITY_SHARD_REQUESTS=False)
+    def test_requests_are_not_sharded_by_default(self):
+        context = ScoringContext.for_trip(self.reference)
+        with mock.patch.object(context, 'score_sharded') as score_sharded:
+            self.scores(context)
+        score_sharded.assert_not_called()
+
+
+class MinHashTests(SimpleTestCase):
+    """MinHash signatures and LSH band keys of activity sets."""
+
+    def test_signature_depends_only_on_the_set(self):
+        self.assertIsNone(minhash_signature([]))
+        self.assertEqual(minhash_signature([3, 1, 2, 2]).tolist(), minhash_signature({1, 2, 3}).tolist())
+        self.assertEqual(band_keys(minhash_signature([1, 2, 3])), band_keys(minhash_signature([2, 3, 1])))
+        self.assertEqual(len(band_keys(minhash_signature([1]))), NUM_BANDS)
+
+    def test_signature_agreement_estimates_jaccard(self):
+        rng = random.Random(3)
+        for _ in range(20):
+            a = set(rng.sample(range(1, 200), 20))
+            b = set(rng.sample(sorted(a), 10)) | set(rng.sample(range(200, 400), 10))
+            agreement = (minhash_signature(a) == minhash_signature(b)).mean()
+            self.assertAlmostEqual(agreement, jaccard(a, b), delta=0.2)
+
+    def test_disjoint_sets_share_no_band(self):
+        a = band_keys(minhash_signature(range(1, 6)))
+        b = band_keys(minhash_signature(range(100, 106)))
+        self.assertFalse(any(x == y for x, y in zip(a, b)))
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class SimilarTripIndexTests(TestCase):
+    """The similarity index query, its updates across processes and SimilarTripsView."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.goa = PreferredDestination.objects.create(name='Goa')
+        cls.manali = PreferredDestination.objects.create(name='Manali')
+        cls.activities = [TravelInterest.objects.create(name=f'Activity {i}') for i in range(6)]
+        cls.owner = make_user('owner')
+        cls.buddy = make_user('buddy')
+
+    def setUp(self):
+        caches['shared'].clear()
+        a = self.activities
+        with self.captureOnCommitCallbacks(execute=True):
+            self.trip = make_trip(self.owner, self.goa, 10, 5, a[:4])
+            self.same = make_trip(self.buddy, self.manali, 40, 5, a[:4])
+            self.half = make_trip(self.buddy, self.goa, 60, 5, a[2:6])
+            self.own = make_trip(self.owner, self.manali, 80, 5, a[:4])
+            self.unrelated = make_trip(make_user('other'), self.goa, 10, 5, a[5:])
+        self.trip.refresh_from_db()
+
+    def similar_ids(self, index, **kwargs):
+        return {
+            trip_id: similarity
+            for similarity, trip_id, _, _ in index.similar(self.trip.activity_ids, exclude_trip_id=self.trip.id, **kwargs)
+        }
+
+    def test_similar_excludes_and_applies_the_threshold(self):
+        index = SimilarTripIndex()
+        self.assertEqual(
+            self.similar_ids(index, exclude_user_id=self.owner.id, min_similarity=0.3),
+            {self.same.id: 1.0, self.half.id: 0.3333}
+        )
+        self.assertEqual(self.similar_ids(index, exclude_user_id=self.owner.id, min_similarity=0.5), {self.same.id: 1.0})
+        self.assertIn(self.own.id, self.similar_ids(index, min_similarity=0.5))
+        self.assertEqual(index.similar([]), [])
+
+    def test_changes_of_another_process_are_seen(self):
+        other_process = SimilarTripIndex()
+        self.assertNotIn(self.unrelated.id, self.similar_ids(other_process))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.unrelated.activities.set(self.activities[:4])
+            self.same.status = 'cancelled'
+            self.same.save()
+
+        with mock.patch('auth_app.similarity_index.GENERATION_CHECK_SECONDS', 0):
+            similar = self.similar_ids(other_process)
+        self.assertIn(self.unrelated.id, similar)
+        self.assertNotIn(self.same.id, similar)
+
+    def test_own_changes_are_applied_without_reloading(self):
+        index = SimilarTripIndex()
+        self.similar_ids(index)
+        with mock.patch('auth_app.signals.similar_trip_index', index), \
+                mock.patch.object(index, '_load', wraps=index._load) as load:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.half.activities.set(self.activities[:4])
+            with self.captureOnCommitCallbacks(execute=True):
+                self.same.delete()
+            with mock.patch('auth_app.similarity_index.GENERATION_CHECK_SECONDS', 0):
+                similar = self.similar_ids(index)
+        load.assert_not_called()
+        self.assertEqual(similar[self.half.id], 1.0)
+        self.assertNotIn(self.same.id, similar)
+
+    def test_similar_trips_view(self):
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        with mock.patch('auth_app.views.similar_trip_index', SimilarTripIndex()):
+            response = client.get(reverse('similar_trips', args=[self.trip.id]), {'limit': 1})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([(row['id'], row['similarity']) for row in response.data['results']], [(self.same.id, 1.0)])
+
+            response = client.get(
+                reverse('similar_trips', args=[self.trip.id]), {'limit': 1, 'cursor': response.data['next_cursor']}
+            )
+            self.assertEqual([row['id'] for row in response.data['results']], [self.half.id])
+            self.assertIsNone(response.data['next_cursor'])
+
+
+class SQLiteChannelLayerTests(SimpleTestCase):
+    """Two layer instances on one database file stand in for two worker processes."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.path = f'{directory}/channels.sqlite3'
+
+    def make_layer(self, **config):
+        layer = SQLiteChannelLayer(self.path, poll_interval=0.01, **config)
+        self.addCleanup(layer._executor.shutdown)
+        return layer
+
+    async def assert_nothing_received(self, layer, channel):
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), 0.2)
+
+    def test_group_send_reaches_every_instance(self):
+        first, second = self.make_layer(), self.make_layer()
+
+        async def scenario():
+            first_channel = await first.new_channel()
+            second_channel = await second.new_channel()
+            await first.group_add('chat_1', first_channel)
+            await second.group_add('chat_1', second_channel)
+
+            await first.group_send('chat_1', {'type': 'chat.message', 'message': 'hi'})
+
+            for layer, channel in ((first, first_channel), (second, second_channel)):
+                message = await asyncio.wait_for(layer.receive(channel), 2)
+                self.assertEqual(message, {'type': 'chat.message', 'message': 'hi'})
+
+        asyncio.run(scenario())
+
+    def test_group_discard_stops_delivery(self):
+        first, second = self.make_layer(), self.make_layer()
+
+        async def scenario():
+            first_channel = await first.new_channel()
+            second_channel = await second.new_channel()
+            await first.group_add('chat_1', first_channel)
+            await second.group_add('chat_1', second_channel)
+            await second.group_discard('chat_1', second_channel)
+
+            await first.group_send('chat_1', {'type': 'chat.message', 'message': 'hi'})
+
+            self.assertEqual((await asyncio.wait_for(first.receive(first_channel), 2))['message'], 'hi')
+            await self.assert_nothing_received(second, second_channel)
+
+        asyncio.run(scenario())
+
+    def test_expired_messages_are_dropped(self):
+        sender, receiver = self.make_layer(expiry=0.05), self.make_layer()
+
+        async def scenario():
+            channel = await receiver.new_channel()
+            await receiver.group_add('chat_1', channel)
+            await sender.group_send('chat_1', {'type': 'chat.message', 'message': 'late'})
+            await asyncio.sleep(0.1)
+            await self.assert_nothing_received(receiver, channel)
+
+        asyncio.run(scenario())
+
+
+class SnowflakeWorkerLeaseTests(TestCase):
+    """Worker id leases (snowflake.py)."""
+
+    def test_leases_are_exclusive_until_released(self):
+        first = claim_worker_id('host:1:a', 60)
+        second = claim_worker_id('host:2:b', 60)
+        self.assertIsNotNone(first)
+        self.assertNotEqual(first, second)
+
+        self.assertTrue(renew_worker_lease(first, 'host:1:a', 60))
+        self.assertFalse(renew_worker_lease(first, 'host:2:b', 60))
+
+        release_worker_lease(first, 'host:1:a')
+        self.assertEqual(claim_worker_id('host:3:c', 60), first)
+
+    def test_no_worker_id_when_all_are_leased(self):
+        SnowflakeWorkerLease.objects.update(owner='elsewhere', expires_at=timezone.now() + timedelta(minutes=1))
+        self.assertIsNone(claim_worker_id('host:1:a', 60))
+
+    def test_lease_of_a_crashed_process_is_free_again_after_it_expires(self):
+        SnowflakeWorkerLease.objects.update(owner='elsewhere', expires_at=timezone.now() + timedelta(minutes=1))
+        SnowflakeWorkerLease.objects.filter(worker_id=7).update(owner='crashed', expires_at=timezone.now())
+        self.assertEqual(claim_worker_id('host:1:a', 60), 7)
+
+
+@override_settings(CHAT_WORKER_ID=None)
+class SnowflakeLeaseStartupTests(TransactionTestCase):
+    """Leasing from async code happens on a database thread, never on the event loop."""
+
+    def setUp(self):
+        # Rows created by the migration are gone after other transactional tests flushed the tables
+        for worker_id in range(MAX_WORKER_ID + 1):
+            SnowflakeWorkerLease.objects.get_or_create(worker_id=worker_id, defaults={'expires_at': timezone.now()})
+        patcher = mock.patch.multiple(snowflake, _generator=None, _lease=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.release_lease)
+
+    def release_lease(self):
+        if snowflake._lease is not None:
+            snowflake._lease.release()
+            atexit.unregister(snowflake._lease.release)
+
+    def assert_leased(self):
+        lease = snowflake._lease
+        self.assertTrue(lease.is_valid)
+        self.assertEqual(SnowflakeWorkerLease.objects.get(worker_id=lease.worker_id).owner, lease.owner)
+        return lease
+
+    def test_async_ids_lease_without_blocking_the_event_loop(self):
+        ticks = 0
+        claim = snowflake.claim_worker_id
+
+        def slow_claim(*args):
+            time.sleep(0.2)
+            return claim(*args)
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        async def scenario():
+            ticker = asyncio.create_task(tick())
+            try:
+                return await anext_snowflake_id()
+            finally:
+                ticker.cancel()
+
+        with mock.patch.object(snowflake, 'claim_worker_id', slow_claim):
+            message_id = asyncio.run(scenario())
+
+        self.assertGreater(ticks, 5)
+        lease = self.assert_leased()
+        self.assertEqual((message_id >> SEQUENCE_BITS) & MAX_WORKER_ID, lease.worker_id)
+
+    def test_lifespan_startup_leases_the_worker_id(self):
+        async def scenario():
+            messages = asyncio.Queue()
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            await messages.put({'type': 'lifespan.startup'})
+            task = asyncio.create_task(lifespan_application({'type': 'lifespan'}, messages.get, send))
+            while not sent:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            return sent
+
+        self.assertEqual(asyncio.run(scenario()), [{'type': 'lifespan.startup.complete'}])
+        self.assert_leased()
+
+
+@override_settings(CHAT_WORKER_ID=0)
+class ChatWriteBehindTests(TransactionTestCase):
+    """
+    Write-behind persistence (chat_persistence.py). Failed inserts break the
+    surrounding transaction, so these tests run in autocommit mode.
+    """
+
+    def setUp(self):
+        self.creator = make_user('creator')
+        self.trip = make_trip(self.creator, PreferredDestination.objects.create(name='Goa'), 10, 3)
+
+    def message(self, text, message_id=None):
+        return ChatMessage(
+            id=message_id or next_snowflake_id(),
+            trip_id=self.trip.id,
+            sender=self.creator,
+            message=text,
+            timestamp=timezone.now()
+        )
+
+    def test_stop_drains_the_queue(self):
+        queue = ChatWriteBehindQueue()
+        messages = [self.message(f'message {i}') for i in range(3)]
+
+        async def send_and_stop():
+            for message in messages:
+                queue.enqueue(message)
+            await queue.stop()
+
+        asyncio.run(send_and_stop())
+
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.flushed, 3)
+        self.assertEqual(
+            list(ChatMessage.objects.order_by('id').values_list('id', flat=True)),
+            [message.id for message in messages]
+        )
+
+    def test_colliding_ids_are_reassigned(self):
+        existing = ChatMessage.objects.create(trip=self.trip, sender=self.creator, message='first')
+        colliding = self.message('second', message_id=existing.id)
+
+        self.assertEqual(persist_messages_one_by_one([colliding]), 0)
+
+        self.assertNotEqual(colliding.id, existing.id)
+        self.assertEqual(ChatMessage.objects.get(id=colliding.id).message, 'second')
+        self.assertEqual(ChatMessage.objects.get(id=existing.id).message, 'first')
+
+    def test_already_persisted_messages_are_not_duplicated(self):
+        message = self.message('once')
+        queue = ChatWriteBehindQueue()
+        queue.flush_batch([message])
+        # A batch retried after its insert went through
+        queue.flush_batch([message, self.message('twice')])
+
+        self.assertEqual(queue.dropped, 0)
+        self.assertEqual(ChatMessage.objects.filter(message='once').count(), 1)
+        self.assertEqual(ChatMessage.objects.filter(message='twice').count(), 1)
+
+
+@override_settings(CHAT_WORKER_ID=0)
+class ChatReadCursorTests(TestCase):
+    """Marking chat messages read (chat_cursors.py)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = make_user('creator')
+        cls.member = make_user('member')
+        cls.trip = make_trip(cls.creator, PreferredDestination.objects.create(name='Goa'), 10, 3,
+                             members=[cls.member])
+
+    def send(self, sender, text):
+        return ChatMessage.objects.create(trip=self.trip, sender=sender, message=text)
+
+    def cursor(self):
+        return ChatReadCursor.objects.get(user=self.member, trip=self.trip)
+
+    def test_reading_a_newer_message_does_not_read_older_ones(self):
+        m1, m2, m3, m4, m5 = [self.send(self.creator, f'message {i}') for i in range(5)]
+        self.assertEqual(unread_count(self.member), 5)
+
+        mark_messages_read(self.member, [m3.id])
+        cursor = self.cursor()
+        self.assertEqual(unread_count(self.member), 4)
+        self.assertEqual(cursor.read_message_ids, [m3.id])
+        self.assertFalse(is_message_read(m1.id, cursor.last_read_message_id, cursor.read_message_ids))
+        self.assertTrue(is_message_read(m3.id, cursor.last_read_message_id, cursor.read_message_ids))
+
+        # Reading the gap moves the cursor over the whole read run
+        mark_messages_read(self.member, [m1.id, m2.id])
+        cursor = self.cursor()
+        self.assertEqual(cursor.last_read_message_id, m3.id)
+        self.assertEqual(cursor.read_message_ids, [])
+        self.assertEqual(unread_count(self.member), 2)
+
+    def test_cursor_skips_own_messages(self):
+        m1 = self.send(self.creator, 'hello')
+        self.send(self.member, 'hi')
+        m3 = self.send(self.creator, 'how are you?')
+
+        self.assertEqual(mark_messages_read(self.member, [m1.id, m3.id]), 2)
+
+        self.assertEqual(self.cursor().last_read_message_id, m3.id)
+        self.assertEqual(unread_count(self.member), 0)
+
+    def test_messages_of_other_chats_are_ignored(self):
+        stranger = make_user('stranger')
+        message = self.send(self.creator, 'members only')
+        self.assertEqual(mark_messages_read(stranger, [message.id]), 0)
+        self.assertEqual(unread_count(self.member), 1)
+
+
+@override_settings(CHAT_WORKER_ID=0)
+class ChatHistoryTests(TestCase):
+    """Keyset pages of a trip's chat history (TripChatMessagesView)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = make_user('creator')
+        cls.trip = make_trip(cls.creator, PreferredDestination.objects.create(name='Goa'), 10, 3)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.creator)
+        self.url = reverse('trip_chat', args=[self.trip.id])
+
+    def send(self, count):
+        return [
+            ChatMessage.objects.create(trip=self.trip, sender=self.creator, message=f'message {i}').id
+            for i in range(count)
+        ]
+
+    def page(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return [message['id'] for message in response.data['results']], response.data
+
+    def test_pages_neither_repeat_nor_skip_messages(self):
+        ids = self.send(7)
+
+        page, data = self.page(limit=3)
+        self.assertEqual(page, ids[4:])
+        self.assertTrue(data['has_more'])
+
+        page, data = self.page(limit=3, before_id=page[0])
+        self.assertEqual(page, ids[1:4])
+        self.assertTrue(data['has_more'])
+
+        page, data = self.page(limit=3, before_id=page[0])
+        self.assertEqual(page, ids[:1])
+        self.assertFalse(data['has_more'])
+
+        page, data = self.page(limit=3, after_id=ids[1])
+        self.assertEqual(page, ids[2:5])
+        self.assertTrue(data['has_more'])
+
+    def test_catch_up_reports_a_gap(self):
+        ids = self.send(5)
+
+        page, data = self.page(since=ids[0], limit=2)
+        self.assertEqual(page, ids[-2:])
+        self.assertTrue(data['gap'])
+
+        page, data = self.page(since=ids[2])
+        self.assertEqual(page, ids[3:])
+        self.assertFalse(data['gap'])
+
+    def test_invalid_parameters_are_rejected(self):
+        self.assertEqual(self.client.get(self.url, {'limit': 0}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'before_id': 1, 'after_id': 2}).status_code, 400)
+
+
+@override_settings(CACHES=LOCAL_CACHES, CHAT_MEMBERSHIP_CACHE_TTL_SECONDS=60)
+class TripMembershipCacheTests(TestCase):
+    """Who may join a trip's chat (membership_cache.py)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        goa = PreferredDestination.objects.create(name='Goa')
+        cls.creator = make_user('creator')
+        cls.member = make_user('member')
+        cls.trip = make_trip(cls.creator, goa, 10, 3, members=[cls.member])
+        cls.other_trip = make_trip(cls.creator, goa, 20, 3, members=[cls.member])
+        cls.unrelated_trip = make_trip(cls.creator, goa, 30, 3)
+
+    def setUp(self):
+        caches['shared'].clear()
+
+    def test_entries_are_served_from_memory_until_they_expire(self):
+        cache = TripMembershipCache()
+        self.assertTrue(cache.is_member(self.trip.id, self.member.id))
+        self.assertFalse(cache.is_member(self.trip.id, make_user('stranger').id))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.get(self.trip.id)[0], True)
+        self.assertEqual(cache.load(self.trip.id + 1000), None)
+
+        # A change the signals do not see (raw through-table row) only shows after the TTL
+        late = make_user('late')
+        Trip.members.through.objects.create(trip=self.trip, userprofile=late)
+        self.assertFalse(cache.is_member(self.trip.id, late.id))
+        with override_settings(CHAT_MEMBERSHIP_CACHE_TTL_SECONDS=0):
+            time.sleep(0.01)
+            self.assertTrue(cache.is_member(self.trip.id, late.id))
+
+    def test_changes_reach_other_processes(self):
+        other_process = TripMembershipCache()
+        self.assertTrue(other_process.is_member(self.trip.id, self.member.id))
+
+        self.trip.members.remove(self.member)
+        with mock.patch('auth_app.membership_cache.GENERATION_CHECK_SECONDS', 0):
+            self.assertFalse(other_process.is_member(self.trip.id, self.member.id))
+
+    def test_cancelled_trip_admits_nobody(self):
+        self.assertTrue(trip_membership_cache.is_member(self.trip.id, self.creator.id))
+        self.trip.status = 'cancelled'
+        self.trip.save()
+        self.assertFalse(trip_membership_cache.is_member(self.trip.id, self.creator.id))
+        self.assertFalse(trip_membership_cache.is_member(self.trip.id, self.member.id))
+
+    def test_clearing_a_users_trips_only_drops_those_trips(self):
+        for trip in (self.trip, self.other_trip, self.unrelated_trip):
+            trip_membership_cache.load(trip.id)
+
+        self.member.joined_trips.clear()
+
+        self.assertFalse(trip_membership_cache.get(self.trip.id)[0])
+        self.assertFalse(trip_membership_cache.get(self.other_trip.id)[0])
+        self.assertTrue(trip_membership_cache.get(self.unrelated_trip.id)[0])
+        self.assertFalse(trip_membership_cache.is_member(self.other_trip.id, self.member.id))
+
+
+@override_settings(CACHES=LOCAL_CACHES, CHAT_WORKER_ID=0)
+class ChatSocketMembershipTests(TransactionTestCase):
+    """Chat sockets close once their user may no longer follow the trip's chat."""
+
+    def setUp(self):
+        caches['shared'].clear()
+        self.creator = make_user('creator')
+        self.member = make_user('member')
+        self.trip = make_trip(self.creator, PreferredDestination.objects.create(name='Goa'), 10, 3,
+                              members=[self.member])
+
+    def assert_closed_after(self, user, change):
+        async def scenario():
+            communicator = await open_socket(f'/ws/chat/{self.trip.id}/', user)
+            await database_sync_to_async(change)()
+            self.assertEqual((await communicator.receive_output(2))['type'], 'websocket.close')
+            await communicator.wait()
+
+        asyncio.run(scenario())
+
+    def test_removed_member_is_disconnected(self):
+        self.assert_closed_after(self.member, lambda: self.trip.members.remove(self.member))
+
+    def test_sockets_of_a_cancelled_trip_are_disconnected(self):
+        def cancel():
+            self.trip.status = 'cancelled'
+            self.trip.save()
+
+        self.assert_closed_after(self.creator, cancel)
+
+    def test_non_members_are_refused(self):
+        stranger = make_user('stranger')
+
+        async def scenario():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.trip.id}/')
+            communicator.scope['user'] = stranger
+            connected, _ = await communicator.connect()
+            return connected
+
+        self.assertFalse(asyncio.run(scenario()))
+
+
+class WireFormatTests(SimpleTestCase):
+    """The default, json-min and msgpack chat wire formats (wire_formats.py)."""
+
+    sender = {'sender_id': 7, 'sender_username': 'asha', 'sender_profile_picture': None}
+
+    def broadcast(self, message_id, text):
+        message = ChatMessage(id=message_id, trip_id=1, sender_id=7, message=text, timestamp=timezone.now())
+        return {
+            'type': 'chat_message',
+            'message_id': message_id,
+            'frame': encode_chat_frame(message, self.sender),
+            'compact': dumps_compact(compact_chat_message(message, self.sender))
+        }
+
+    @staticmethod
+    def decode(subprotocol, frame):
+        return decode_frame(subprotocol, frame.get('text_data'), frame.get('bytes_data'))
+
+    def test_every_format_carries_the_same_frame(self):
+        event = self.broadcast(101, 'Namaste ✈')
+        compact = json.loads(event['compact'])
+        self.assertEqual(compact['m'], 'Namaste ✈')
+
+        self.assertEqual(self.decode(None, chat_frame(None, event))['message'], 'Namaste ✈')
+        for subprotocol in (SUBPROTOCOL_JSON_MIN, SUBPROTOCOL_MSGPACK):
+            self.assertEqual(self.decode(subprotocol, chat_frame(subprotocol, event)), dict(compact, message='Namaste ✈'))
+            self.assertEqual(self.decode(subprotocol, chat_frame(subprotocol, event, 3)), {'trip_id': 3, 'data': compact})
+
+        entries = [(101, event['frame'], event['compact'])]
+        self.assertEqual(self.decode(None, history_frame(None, entries))['messages'], [json.loads(event['frame'])])
+        for subprotocol in (SUBPROTOCOL_JSON_MIN, SUBPROTOCOL_MSGPACK):
+            self.assertEqual(self.decode(subprotocol, history_frame(subprotocol, entries, 3)),
+                             {'trip_id': 3, 'data': {'type': 'history', 'messages': [compact]}})
+
+        payload = {'type': 'error', 'code': 'rate_limited'}
+        for subprotocol in (None, SUBPROTOCOL_JSON_MIN, SUBPROTOCOL_MSGPACK):
+            self.assertEqual(self.decode(subprotocol, encode_frame(subprotocol, payload)), payload)
+
+    def test_invalid_frames_are_rejected(self):
+        with self.assertRaises(ValueError):
+            decode_frame(None, bytes_data=b'\x81')
+        with self.assertRaises(ValueError):
+            decode_frame(SUBPROTOCOL_MSGPACK, bytes_data=b'\xc1')
+        with self.assertRaises(ValueError):
+            decode_frame(None, '[1, 2]')
+
+    def test_msgpack_is_packed_once_per_broadcast_only(self):
+        event = self.broadcast(102, 'hi')
+        entries = [(102, event['frame'], event['compact'])]
+        with mock.patch.object(msgpack, 'packb', wraps=msgpack.packb) as packb:
+            # Every socket of the process gets its own copy of the event
+            frames = {chat_frame(SUBPROTOCOL_MSGPACK, dict(event))['bytes_data'] for _ in range(3)}
+            self.assertEqual((len(frames), packb.call_count), (1, 1))
+
+            history_frame(SUBPROTOCOL_MSGPACK, entries)
+            history_frame(SUBPROTOCOL_MSGPACK, entries)
+            self.assertEqual(packb.call_count, 3)
+
+    def test_subprotocol_negotiation(self):
+        self.assertIsNone(select_subprotocol(None))
+        self.assertIsNone(select_subprotocol(['graphql-ws']))
+        self.assertEqual(select_subprotocol(['graphql-ws', SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON_MIN]),
+                         SUBPROTOCOL_MSGPACK)
+        with mock.patch('auth_app.wire_formats.msgpack', None):
+            self.assertEqual(select_subprotocol([SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON_MIN]), SUBPROTOCOL_JSON_MIN)
+
+
+@override_settings(CACHES=LOCAL_CACHES, CHAT_WORKER_ID=0)
+class ChatSocketWireFormatTests(TransactionTestCase):
+    """Sockets negotiating different formats receive the same chat message."""
+
+    def test_sockets_receive_messages_in_their_negotiated_format(self):
+        caches['shared'].clear()
+        creator = make_user('creator')
+        member = make_user('member')
+        trip = make_trip(creator, PreferredDestination.objects.create(name='Goa'), 10, 3, members=[member])
+        path = f'/ws/chat/{trip.id}/'
+
+        async def scenario():
+            plain = await open_socket(path, creator)
+            compact = await open_socket(path, member, [SUBPROTOCOL_JSON_MIN])
+            packed = await open_socket(path, member, ['graphql-ws', SUBPROTOCOL_MSGPACK])
+            self.assertEqual(
+                [plain.accepted_subprotocol, compact.accepted_subprotocol, packed.accepted_subprotocol],
+                [None, SUBPROTOCOL_JSON_MIN, SUBPROTOCOL_MSGPACK]
+            )
+
+            await compact.send_to(text_data=json.dumps({'m': 'hello'}))
+            received = [
+                json.loads(await plain.receive_from()),
+                json.loads(await compact.receive_from()),
+                msgpack.unpackb((await packed.receive_output())['bytes']),
+            ]
+            for communicator in (plain, compact, packed):
+                await communicator.disconnect()
+            return received
+
+        plain, compact, packed = asyncio.run(scenario())
+        self.assertEqual(plain['message'], 'hello')
+        self.assertEqual(plain['sender_id'], member.id)
+        self.assertEqual(compact['m'], 'hello')
+        self.assertEqual(packed, compact)
+        self.assertEqual(compact['i'], plain['message_id'])
+
+
+@override_settings(CHAT_WORKER_ID=0, CHAT_HISTORY_BUFFER_SIZE=3)
+class RecentMessageBufferTests(TransactionTestCase):
+    """
+    Per-process ring buffers (recent_messages.py). Buffers load on a database
+    thread, which only sees committed rows.
+    """
+
+    def setUp(self):
+        self.creator = make_user('creator')
+        self.trip = make_trip(self.creator, PreferredDestination.objects.create(name='Goa'), 10, 3)
+        self.buffers = RecentMessageBuffers()
+        self.queue = ChatWriteBehindQueue()
+        patcher = mock.patch('auth_app.recent_messages.chat_write_behind', self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def message(self, text):
+        return ChatMessage(
+            id=next_snowflake_id(), trip_id=self.trip.id, sender=self.creator, message=text, timestamp=timezone.now()
+        )
+
+    @staticmethod
+    def entry(message_id):
+        return message_id, f'frame {message_id}', f'compact {message_id}'
+
+    def test_first_join_seeds_the_buffer_with_persisted_and_queued_messages(self):
+        saved = [ChatMessage.objects.create(trip=self.trip, sender=self.creator, message=f'saved {i}') for i in range(3)]
+        queued = self.message('queued')
+        other_trip = self.message('elsewhere')
+        other_trip.trip_id = make_trip(self.creator, self.trip.destination, 30, 3).id
+
+        async def scenario():
+            self.queue.enqueue(queued)
+            self.queue.enqueue(other_trip)
+            self.buffers.join(self.trip.id)
+            first = await self.buffers.get(self.trip.id)
+            second = await self.buffers.get(self.trip.id)
+            await self.queue.stop()
+            return first, second
+
+        first, second = asyncio.run(scenario())
+        self.assertEqual([entry[0] for entry in first], [saved[1].id, saved[2].id, queued.id])
+        self.assertEqual(second, first)
+        self.assertEqual(self.buffers.loads, 1)
+
+    def test_buffer_keeps_the_newest_entries_in_order(self):
+        async def scenario():
+            self.buffers.join(self.trip.id)
+            await self.buffers.get(self.trip.id)
+            for message_id in (10, 12, 11, 12, 14, 13, 9):
+                self.buffers.add(self.trip.id, self.entry(message_id))
+            return await self.buffers.get(self.trip.id)
+
+        self.assertEqual(asyncio.run(scenario()), [self.entry(12), self.entry(13), self.entry(14)])
+
+    def test_buffer_is_dropped_when_the_last_socket_leaves(self):
+        async def scenario():
+            self.buffers.join(self.trip.id)
+            self.buffers.join(self.trip.id)
+            await self.buffers.get(self.trip.id)
+            self.buffers.add(self.trip.id, self.entry(1))
+
+            self.buffers.leave(self.trip.id)
+            self.assertEqual(self.buffers.stats()['trips'], 1)
+            self.buffers.leave(self.trip.id)
+            self.assertEqual(self.buffers.stats(), {'trips': 0, 'sockets': 0, 'loads': 1})
+
+            # Nobody receives the trip's messages here any more, so they are not buffered
+            self.buffers.add(self.trip.id, self.entry(2))
+            self.buffers.join(self.trip.id)
+            return await self.buffers.get(self.trip.id)
+
+        self.assertEqual(asyncio.run(scenario()), [])
+        self.assertEqual(self.buffers.loads, 2)
+
+    def test_pending_for_trip_includes_batches_being_inserted(self):
+        messages = [self.message(f'message {i}') for i in range(2)]
+        self.queue._pending.extend(messages)
+        batch = self.queue._take_batch()
+        self.assertEqual(self.queue.pending_for_trip(self.trip.id), messages)
+        self.assertEqual(self.queue.pending_for_trip(self.trip.id + 1), [])
+
+        self.queue.flush_batch(batch)
+        self.assertEqual(self.queue.pending_for_trip(self.trip.id), [])
+
+
+class ManualClock:
+    """A time.monotonic() replacement that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class QueueOnlySocket(ChatSocketMixin):
+    """The outbound queue of a chat socket, without a connection or writer task."""
+
+    def __init__(self, size):
+        self.user = mock.Mock(id=1)
+        self.outbound = asyncio.Queue(maxsize=size)
+        self.close = mock.AsyncMock()
+
+
+class ChatLimitsTests(SimpleTestCase):
+    """Token buckets (chat_limits.py) and the bounded outbound queue of chat sockets."""
+
+    def setUp(self):
+        self.clock = ManualClock()
+        for patcher in (
+            mock.patch('auth_app.chat_limits.time.monotonic', self.clock),
+            mock.patch.object(chat_limits, '_user_buckets', {}),
+            mock.patch.object(chat_limits, '_live_user_buckets', weakref.WeakValueDictionary()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_bucket_allows_a_burst_then_refills_at_its_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([take_token(bucket) for _ in range(4)], [True, True, True, False])
+
+        self.clock.now += 0.5
+        self.assertTrue(take_token(bucket))
+        self.assertFalse(take_token(bucket))
+
+        # Never refills past the burst
+        self.clock.now += 60
+        self.assertTrue(bucket.is_full())
+        self.assertEqual(bucket.refill(), 3)
+
+    def test_message_needs_a_token_from_the_socket_and_the_user(self):
+        user = user_bucket(1)
+        first_socket, second_socket = TokenBucket(rate=1, burst=2), TokenBucket(rate=1, burst=2)
+        user.burst = user.tokens = 3
+
+        self.assertTrue(take_token(first_socket, user))
+        self.assertTrue(take_token(first_socket, user))
+        # The socket is out of tokens: the user bucket is left alone
+        self.assertFalse(take_token(first_socket, user))
+        self.assertEqual(user.tokens, 1)
+
+        # The user's other socket shares the user bucket
+        self.assertIs(user_bucket(1), user)
+        self.assertTrue(take_token(second_socket, user))
+        self.assertFalse(take_token(second_socket, user))
+        self.assertEqual(second_socket.tokens, 1)
+
+    @mock.patch.object(chat_limits, 'PRUNE_THRESHOLD', 2)
+    def test_pruning_drops_only_idle_buckets_of_disconnected_users(self):
+        connected = user_bucket(1)
+        busy = user_bucket(2)
+        busy.tokens = 0
+        user_bucket(3)
+        # More buckets than the threshold: the next new user triggers pruning
+        user_bucket(4)
+
+        self.assertEqual(set(chat_limits._user_buckets), {2, 4})
+        # A socket still holds the bucket of user 1, which must not be reset
+        connected.tokens = 0
+        self.assertIs(user_bucket(1), connected)
+        self.assertIs(user_bucket(2), busy)
+
+    def test_full_queue_drops_frames_and_closes_the_socket_once(self):
+        socket = QueueOnlySocket(size=2)
+        dropped = chat_counters['dropped_frames']
+
+        async def scenario():
+            for i in range(4):
+                await socket.queue_frame({'text_data': str(i)})
+
+        asyncio.run(scenario())
+        self.assertEqual(socket.outbound.qsize(), 2)
+        self.assertEqual(chat_counters['dropped_frames'] - dropped, 2)
+        socket.close.assert_awaited_once_with(code=1013)
+
+    @override_settings(CHAT_SLOW_CONSUMER_POLICY='drop')
+    def test_drop_policy_keeps_slow_sockets_open(self):
+        socket = QueueOnlySocket(size=1)
+
+        async def scenario():
+            for i in range(3):
+                await socket.queue_frame({'text_data': str(i)})
+
+        asyncio.run(scenario())
+        self.assertEqual(socket.outbound.qsize(), 1)
+        socket.close.assert_not_awaited()
+
+
+@override_settings(CHAT_PRESENCE_INTERVAL_MS=10, CHAT_PRESENCE_TTL_SECONDS=30, CHAT_TYPING_TIMEOUT_SECONDS=5)
+class PresenceTests(SimpleTestCase):
+    """Batched presence diffs, heartbeats and expiry of remote users (presence.py)."""
+
+    def setUp(self):
+        self.registry = PresenceRegistry()
+        self.channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        patcher = mock.patch('auth_app.presence.get_channel_layer', return_value=self.channel_layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sent_events(self):
+        return [call.args[1] for call in self.channel_layer.group_send.await_args_list]
+
+    def remote_event(self, sequence, online=(), offline=(), typing=()):
+        return {
+            'id': f'other:{sequence}',
+            'online': [{'id': user_id, 'username': f'user {user_id}'} for user_id in online],
+            'offline': list(offline),
+            'typing': list(typing),
+            'stopped_typing': [],
+            'sync': False,
+        }
+
+    def test_changes_of_an_interval_go_out_as_one_diff(self):
+        async def scenario():
+            self.registry.connect(1, 10, 'ana')
+            self.registry.connect(1, 11, 'ben')
+            for _ in range(5):
+                self.registry.set_typing(1, 10)
+            await asyncio.sleep(0.1)
+
+        asyncio.run(scenario())
+        [event] = self.sent_events()
+        self.assertEqual(event['online'], [{'id': 10, 'username': 'ana'}, {'id': 11, 'username': 'ben'}])
+        self.assertEqual(event['typing'], [10])
+        self.assertTrue(event['sync'])
+        self.assertFalse(event['heartbeat'])
+        self.assertEqual(json.loads(event['frame'])['online'], event['online'])
+
+    def test_remote_users_expire_without_heartbeats(self):
+        clock = ManualClock()
+        with mock.patch('auth_app.presence.time.monotonic', clock), \
+                mock.patch.object(self.registry, '_ensure_flusher'):
+            self.registry.connect(1, 10, 'ana')
+            room = self.registry.rooms[1]
+            self.registry._build_event(1, room)
+
+            self.registry.apply(1, self.remote_event(0, online=[20], typing=[20]))
+            self.assertEqual(self.registry.snapshot(1)['typing'], [20])
+
+            # The remote process keeps user 20 alive; this one heartbeats user 10
+            clock.now += 11
+            self.registry.apply(1, self.remote_event(1, online=[20]))
+            self.registry._expire(room, clock())
+            heartbeat = self.registry._build_event(1, room)
+            self.assertTrue(heartbeat['heartbeat'])
+            self.assertEqual([user['id'] for user in heartbeat['online']], [10])
+            self.assertEqual(json.loads(heartbeat['frame'])['online'], [])
+            self.assertEqual(self.registry.snapshot(1)['typing'], [])
+
+            # Its process stops announcing user 20
+            clock.now += 31
+            self.registry._expire(room, clock())
+            self.assertEqual([user['id'] for user in self.registry.snapshot(1)['online']], [10])
+            event = self.registry._build_event(1, room)
+            self.assertEqual(event['offline'], [20])
+            self.assertFalse(event['heartbeat'])
+
+            # Only local users left: nothing to send, however long it stays quiet
+            clock.now += 60
+            self.registry._expire(room, clock())
+            self.assertFalse(room.has_pending())
+
+    def test_sync_request_is_answered_with_a_visible_diff(self):
+        with mock.patch.object(self.registry, '_ensure_flusher'):
+            self.registry.connect(1, 10, 'ana')
+            room = self.registry.rooms[1]
+            self.registry._build_event(1, room)
+
+            self.registry.apply(1, dict(self.remote_event(0, online=[20]), sync=True))
+            self.registry._expire(room, time.monotonic())
+            event = self.registry._build_event(1, room)
+        self.assertFalse(event['heartbeat'])
+        self.assertEqual(json.loads(event['frame'])['online'], [{'id': 10, 'username': 'ana'}])
+
+
+@override_settings(CHAT_PRESENCE_INTERVAL_MS=10)
+class ChatSocketPresenceTests(TransactionTestCase):
+    """Only chat sockets opened with ?presence=1 get presence frames."""
+
+    def setUp(self):
+        caches['shared'].clear()
+        self.creator = make_user('creator')
+        self.member = make_user('member')
+        self.trip = make_trip(self.creator, PreferredDestination.objects.create(name='Goa'), 10, 3,
+                              members=[self.member])
+
+    def test_presence_frames_are_opt_in(self):
+        async def scenario():
+            plain = await open_socket(f'/ws/chat/{self.trip.id}/', self.creator)
+            watching = await open_socket(f'/ws/chat/{self.trip.id}/?presence=1', self.member)
+
+            snapshot = json.loads(await watching.receive_from())
+            diff = json.loads(await watching.receive_from())
+            quiet = await plain.receive_nothing(0.2)
+
+            await plain.disconnect()
+            await watching.disconnect()
+            return snapshot, diff, quiet
+
+        snapshot, diff, quiet = asyncio.run(scenario())
+        self.assertEqual(snapshot['type'], 'presence')
+        self.assertEqual({user['id'] for user in snapshot['online']}, {self.creator.id, self.member.id})
+        self.assertEqual(diff['type'], 'presence_diff')
+        self.assertTrue(quiet)
+
+
+@override_settings(CHAT_WORKER_ID=0, CHAT_PRESENCE_INTERVAL_MS=60000)
+class UserSocketTests(TransactionTestCase):
+    """The multiplexed user socket (UserConsumer): subscriptions and routing of trip chats."""
+
+    def setUp(self):
+        caches['shared'].clear()
+        self.creator = make_user('creator')
+        self.member = make_user('member')
+        goa = PreferredDestination.objects.create(name='Goa')
+        self.trip = make_trip(self.creator, goa, 10, 3, members=[self.member])
+        self.other_trip = make_trip(self.creator, goa, 30, 3)
+
+    @staticmethod
+    async def receive(communicator):
+        return json.loads(await communicator.receive_from())
+
+    @staticmethod
+    async def send(communicator, frame_type, trip_id, **fields):
+        await communicator.send_to(text_data=json.dumps(dict(fields, type=frame_type, trip_id=trip_id)))
+
+    def test_subscriptions_are_limited_to_the_users_trips(self):
+        async def scenario():
+            socket = await open_socket('/ws/user/', self.member)
+            frames = [await self.receive(socket)]
+
+            await self.send(socket, 'subscribe', self.other_trip.id)
+            await self.send(socket, 'message', self.trip.id, message='too early')
+            await self.send(socket, 'subscribe', self.trip.id, history=False)
+            frames += [await self.receive(socket) for _ in range(4)]
+
+            await self.send(socket, 'unsubscribe', self.trip.id)
+            await self.send(socket, 'message', self.trip.id, message='too late')
+            frames += [await self.receive(socket) for _ in range(2)]
+            self.assertTrue(await socket.receive_nothing(0.1))
+            await socket.disconnect()
+            return frames
+
+        ready, forbidden, not_subscribed, subscribed, snapshot, unsubscribed, still_not_subscribed = asyncio.run(scenario())
+        self.assertEqual(ready, {'type': 'ready', 'trips': [self.trip.id]})
+        self.assertEqual(forbidden, {'type': 'error', 'code': 'forbidden', 'trip_id': self.other_trip.id})
+        self.assertEqual(not_subscribed, {'type': 'error', 'code': 'not_subscribed', 'trip_id': self.trip.id})
+        self.assertEqual(subscribed, {'type': 'subscribed', 'trip_id': self.trip.id})
+        self.assertEqual(snapshot['trip_id'], self.trip.id)
+        self.assertEqual(snapshot['data']['type'], 'presence')
+        self.assertEqual(unsubscribed, {'type': 'unsubscribed', 'trip_id': self.trip.id})
+        self.assertEqual(still_not_subscribed, not_subscribed)
+
+    def test_messages_reach_subscribers_and_notify_other_members(self):
+        async def scenario():
+            sender = await open_socket('/ws/user/', self.creator)
+            follower = await open_socket('/ws/user/', self.member)
+            await self.receive(sender)
+            await self.receive(follower)
+
+            await self.send(sender, 'subscribe', self.trip.id, history=False)
+            await self.receive(sender)
+            await self.receive(sender)
+            await self.send(sender, 'message', self.trip.id, message='Meet at 9')
+            delivered = await self.receive(sender)
+            notified = await self.receive(follower)
+
+            await sender.disconnect()
+            await follower.disconnect()
+            return delivered, notified
+
+        delivered, notified = asyncio.run(scenario())
+        message = ChatMessage.objects.get(trip=self.trip)
+        self.assertEqual(delivered['trip_id'], self.trip.id)
+        self.assertEqual(delivered['data']['message'], 'Meet at 9')
+        self.assertEqual(delivered['data']['message_id'], message.id)
+        self.assertEqual(notified, {
+            'type': 'chat_notification', 'trip_id': self.trip.id, 'message_id': message.id, 'sender_id': self.creator.id
+        })
+
+    def test_message_to_a_deleted_trip_gets_an_error_frame(self):
+        async def scenario():
+            socket = await open_socket('/ws/user/', self.member)
+            await self.receive(socket)
+            await self.send(socket, 'subscribe', self.trip.id, history=False)
+            await self.receive(socket)
+            await self.receive(socket)
+
+            await database_sync_to_async(Trip.objects.filter(id=self.trip.id).delete)()
+            await self.send(socket, 'message', self.trip.id, message='Anyone?')
+            error = await self.receive(socket)
+            # The socket survives
+            await self.send(socket, 'unsubscribe', self.trip.id)
+            unsubscribed = await self.receive(socket)
+            await socket.disconnect()
+            return error, unsubscribed
+
+        error, unsubscribed = asyncio.run(scenario())
+        self.assertEqual(error, {'type': 'error', 'code': 'trip_not_found', 'trip_id': self.trip.id})
+        self.assertEqual(unsubscribed['type'], 'unsubscribed')
+
+
+@override_settings(CHAT_WORKER_ID=0)
+class ChatSearchTests(TestCase):
+    """Full-text chat search (SQLite FTS5 in tests) and the MySQL snippet helper."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = make_user('creator')
+        cls.trip = make_trip(cls.creator, PreferredDestination.objects.create(name='Goa'), 10, 3)
+        cls.other_trip = make_trip(cls.creator, PreferredDestination.objects.create(name='Manali'), 10, 3)
+
+    def send(self, trip, text):
+        return ChatMessage.objects.create(trip=trip, sender=self.creator, message=text).id
+
+    def test_prefix_search_pages_through_matches(self):
+        meet = self.send(self.trip, 'Meet at the beach tomorrow')
+        party = self.send(self.trip, 'Beach party tonight')
+        self.send(self.trip, 'Bring sunscreen')
+        self.send(self.other_trip, 'Beach volleyball')
+
+        page = search_messages(self.trip.id, search_terms('bea'), order='recent', limit=1)
+        self.assertEqual([hit[0] for hit in page['hits']], [party])
+        self.assertEqual(page['hits'][0][2], '<mark>Beach</mark> party tonight')
+
+        cursor = (None, int(page['next_cursor']))
+        page = search_messages(self.trip.id, search_terms('bea'), order='recent', limit=1, cursor=cursor)
+        self.assertEqual([hit[0] for hit in page['hits']], [meet])
+        self.assertIsNone(page['next_cursor'])
+
+    def test_edits_and_deletes_update_the_index(self):
+        message_id = self.send(self.trip, 'Sunset cruise')
+        ChatMessage.objects.filter(id=message_id).update(message='Sunrise hike')
+        self.assertEqual(search_messages(self.trip.id, ['cruise'])['hits'], [])
+        self.assertEqual(len(search_messages(self.trip.id, ['sunrise'])['hits']), 1)
+
+        ChatMessage.objects.filter(id=message_id).delete()
+        self.assertEqual(search_messages(self.trip.id, ['sunrise'])['hits'], [])
+
+    def test_mark_terms(self):
+        self.assertEqual(mark_terms('Go to the beach', ['go', 'be']), '\x02Go\x03 to the \x02beach\x03')
+        words = ' '.join(f'w{i}' for i in range(40))
+        snippet = mark_terms(f'{words} beaches', ['bea'])
+        self.assertTrue(snippet.startswith('…'))
+        self.assertTrue(snippet.endswith('\x02beaches\x03'))
+
+
+@override_settings(CHAT_WORKER_ID=0, CHAT_ARCHIVE_BLOCK_SIZE=4)
+class ChatArchiveTests(TestCase):
+    """Archiving finished trips' chat (chat_archive.py) and reading it back through history pages."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = make_user('creator')
+        cls.trip = make_trip(cls.creator, PreferredDestination.objects.create(name='Goa'), -200, 3)
+
+    def setUp(self):
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir, ignore_errors=True)
+        settings_override = override_settings(CHAT_ARCHIVE_DIR=archive_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.creator)
+        self.url = reverse('trip_chat', args=[self.trip.id])
+
+    def send_old(self, count, hours_ago=2):
+        return [
+            ChatMessage.objects.create(
+                id=old_message_id(hours_ago * 3600 - i), trip=self.trip, sender=self.creator, message=f'old {i}'
+            ).id
+            for i in range(count)
+        ]
+
+    def send(self, count):
+        return [
+            ChatMessage.objects.create(trip=self.trip, sender=self.creator, message=f'new {i}').id
+            for i in range(count)
+        ]
+
+    def page(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return [message['id'] for message in response.data['results']], response.data
+
+    def test_archive_keeps_recent_messages(self):
+        old = self.send_old(10)
+        recent = [
+            ChatMessage.objects.create(id=old_message_id(60), trip=self.trip, sender=self.creator, message='late').id
+        ] + self.send(2)
+
+        segment = archive_trip(self.trip.id)
+
+        self.assertEqual(segment.message_count, len(old))
+        self.assertEqual((segment.first_message_id, segment.last_message_id), (old[0], old[-1]))
+        self.assertEqual(sorted(ChatMessage.objects.filter(trip=self.trip).values_list('id', flat=True)), recent)
+        self.assertIsNone(archive_trip(self.trip.id))
+
+    def test_pages_cross_the_archive_boundary(self):
+        old = self.send_old(10)
+        archive_trip(self.trip.id)
+        new = self.send(3)
+        everything = old + new
+
+        ids, data = self.page(limit=5)
+        self.assertEqual(ids, everything[-5:])
+        self.assertTrue(data['has_more'])
+
+        ids, data = self.page(limit=5, before_id=ids[0])
+        self.assertEqual(ids, everything[3:8])
+        self.assertTrue(data['has_more'])
+
+        ids, data = self.page(limit=5, before_id=ids[0])
+        self.assertEqual(ids, everything[:3])
+        self.assertFalse(data['has_more'])
+
+        ids, data = self.page(limit=4, after_id=old[7])
+        self.assertEqual(ids, everything[8:12])
+        self.assertTrue(data['has_more'])
+
+        response = self.client.get(self.url)
+        self.assertEqual([message['id'] for message in response.data], everything)
+
+    def test_search_reports_the_archive_boundary(self):
+        search_url = reverse('trip_chat_search', args=[self.trip.id])
+        response = self.client.get(search_url, {'q': 'old'})
+        self.assertIsNone(response.data['archived_through_id'])
+
+        old = self.send_old(3)
+        archive_trip(self.trip.id)
+        ChatMessage.objects.create(trip=self.trip, sender=self.creator, message='old friends')
+
+        response = self.client.get(search_url, {'q': 'old'})
+        self.assertEqual([hit['message'] for hit in response.data['results']], ['old friends'])
+        self.assertEqual(response.data['archived_through_id'], old[-1])
+
+
+@override_settings(LOG_SAMPLE_RATES={'auth_app.sampled': 0.0, 'auth_app.sampled.half': 0.5})
+class StructuredLoggingTests(SimpleTestCase):
+    """Sampling and rendering of structured log records (structured_logging.py)."""
+
+    def setUp(self):
+        # Rates are cached per logger name
+        sample_rate.cache_clear()
+        self.addCleanup(sample_rate.cache_clear)
+
+    def test_sampling_drops_only_debug_and_info(self):
+        log = get_logger('auth_app.sampled.chat')
+        expensive = mock.Mock(return_value=3)
+
+        with self.assertLogs('auth_app.sampled', level='DEBUG') as captured:
+            for _ in range(50):
+                log.debug('tick', count=expensive)
+                log.info('tick', count=expensive)
+            log.warning('slow_consumer', user_id=1)
+            log.error('save_failed', trip_id=2)
+
+        self.assertEqual([(record.levelname, record.event) for record in captured.records],
+                         [('WARNING', 'slow_consumer'), ('ERROR', 'save_failed')])
+        expensive.assert_not_called()
+
+    def test_sample_rate_comes_from_the_closest_configured_parent(self):
+        self.assertEqual(sample_rate('auth_app.sampled.chat'), 0.0)
+        self.assertEqual(sample_rate('auth_app.sampled.half.worker'), 0.5)
+        self.assertEqual(sample_rate('auth_app.views'), 1.0)
+
+        with mock.patch('auth_app.structured_logging.random.random', side_effect=[0.4, 0.6]):
+            half = get_logger('auth_app.sampled.half.worker')
+            with self.assertLogs('auth_app.sampled.half', level='DEBUG') as captured:
+                half.info('kept')
+                half.info('dropped')
+                half.warning('always_kept')
+        self.assertEqual([record.event for record in captured.records], ['kept', 'always_kept'])
+
+    def test_json_lines_are_valid_json(self):
+        formatter = StructuredFormatter(json_lines=True)
+        with self.assertLogs('auth_app.logging_test', level='INFO') as captured:
+            get_logger('auth_app.logging_test').info(
+                'trip_listed', trip_id=7, destination='Goa "North"\n', at=timezone.now(), ids={1}
+            )
+            try:
+                raise ValueError('boom')
+            except ValueError:
+                logging.getLogger('auth_app.logging_test').exception('Plain message')
+
+        structured, plain = [json.loads(formatter.format(record)) for record in captured.records]
+        self.assertEqual(structured['event'], 'trip_listed')
+        self.assertEqual(structured['level'], 'INFO')
+        self.assertEqual(structured['logger'], 'auth_app.logging_test')
+        self.assertEqual((structured['trip_id'], structured['destination']), (7, 'Goa "North"\n'))
+        self.assertIsInstance(structured['at'], str)
+        self.assertEqual(plain['event'], 'Plain message')
+        self.assertIn('ValueError: boom', plain['exc_info'])
+
+    def test_text_format_appends_the_fields(self):
+        formatter = StructuredFormatter('%(levelname)s %(message)s')
+        with self.assertLogs('auth_app.logging_test', level='INFO') as captured:
+            get_logger('auth_app.logging_test').info('trip_listed', trip_id=7, destination='Goa')
+        self.assertEqual(formatter.format(captured.records[0]), "INFO trip_listed trip_id=7 destination='Goa'")
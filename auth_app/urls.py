@@ -4,9 +4,10 @@ from .views import (UserRegistrationView, TravelInterestListView,
                      PreferredDestinationListView, PreferredDestinationDetailView,
                      BuddyProfileView, SendBuddyRequestView, MyTripsView, HandleBuddyRequestView,
                      TripCreateView, CompatibleTripsView, JoinTripView, TripDetailsView, TripChatMessagesView,
+                     TripChatSearchView,
                      UserStatsView, UserDashboardView, ConnectedBuddiesView, CancelTripView, LeaveTripView,
                      create_razorpay_order, verify_razorpay_payment, TripNotificationView, UnreadNotificationCountView,
-                     ChatNotificationView, UnreadChatNotificationCountView, RemoveTripMemberView)
+                     ChatNotificationView, UnreadChatNotificationCountView, RemoveTripMemberView, SimilarTripsView)
 # Import review views from views.py instead of review_views.py
 from .views import TripReviewView, LatestReviewsView, test_review_endpoint
 # Import admin views
@@ -50,8 +51,10 @@ urlpatterns = [
     path('trip/<int:trip_id>/join/', JoinTripView.as_view(), name='join_trip'),
     path('join-trip/<int:trip_id>/', JoinTripView.as_view(), name='join_trip'),
     path('trip/<int:trip_id>/', TripDetailsView.as_view(), name='trip_details'),
+    path('trip/<int:trip_id>/similar/', SimilarTripsView.as_view(), name='similar_trips'),
     # Chat endpoints
     path('trip/<int:trip_id>/chat/', TripChatMessagesView.as_view(), name='trip_chat'),
+    path('trip/<int:trip_id>/chat/search/', TripChatSearchView.as_view(), name='trip_chat_search'),
     # User stats endpoint
     path('user-stats/', UserStatsView.as_view(), name='user-stats'),
     # User dashboard endpoint
@@ -0,0 +1,85 @@
+"""
+Pushes to the multiplexed user sockets (ws/user/, see UserConsumer).
+
+Every user socket joins the ``user_{user_id}`` group. Code running outside the
+event loop (views, signals) pushes events to that group once the current
+transaction commits, so a rolled back change is never announced:
+
+- ``trip_notification``: a TripNotification was created for the user;
+- ``trip_membership``: the user joined or left a trip, so their sockets start
+  or stop following its chat group. It is also sent to the ``chat_{trip_id}``
+  group when a trip is cancelled, so every socket following its chat drops it.
+
+Pushes are best effort: a user without a socket simply reads the
+notifications over REST, as before.
+"""
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def user_group_name(user_id):
+    return f'user_{user_id}'
+
+
+def push_to_group(group, event):
+    """
+    Send a group event after the transaction commits.
+
+    Args:
+        group: Channels group name
+        event: Channels event; ``type`` names the consumer handler
+    """
+    def send():
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        try:
+            async_to_sync(channel_layer.group_send)(group, event)
+        except Exception as e:
+            logger.error(f"Error pushing {event['type']} to {group}: {str(e)}")
+
+    transaction.on_commit(send)
+
+
+def push_to_user(user_id, event):
+    """
+    Send a group event to every socket of a user after the transaction commits.
+
+    Args:
+        user_id: Recipient
+        event: Channels event; ``type`` names the UserConsumer handler
+    """
+    push_to_group(user_group_name(user_id), event)
+
+
+def notification_payload(notification):
+    """
+    Push payload of a TripNotification: the fields of the REST notification
+    list that need no extra query (the related user is loaded by the code
+    creating the notification).
+    """
+    return {
+        'id': notification.id,
+        'trip': notification.trip_id,
+        'notification_type': notification.notification_type,
+        'message': notification.message,
+        'related_user': notification.related_user_id,
+        'related_user_name': notification.related_user.username if notification.related_user_id else None,
+        'is_read': notification.is_read,
+        'created_at': notification.created_at.isoformat()
+    }
+
+
+def push_trip_membership(user_id, trip_id, joined):
+    """Tell the sockets of a user to follow (or stop following) a trip's chat."""
+    push_to_user(user_id, {'type': 'trip_membership', 'trip_id': trip_id, 'joined': joined})
+
+
+def push_trip_closed(trip_id):
+    """Tell every socket following a trip's chat that nobody is a member any more (trip cancelled)."""
+    push_to_group(f'chat_{trip_id}', {'type': 'trip_membership', 'trip_id': trip_id, 'joined': False})
@@ -5,12 +5,13 @@ from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.exceptions import PermissionDenied
 from django.shortcuts import get_object_or_404
-from .models import UserProfile, TravelInterest, PreferredDestination, Trip, TravelBuddyRequest, DestinationTravelInterest, UserPreferences, ChatMessage, TripReview, TripNotification, ChatNotification, Subscription
+from .models import UserProfile, TravelInterest, PreferredDestination, Trip, TravelBuddyRequest, DestinationTravelInterest, UserPreferences, ChatMessage, TripReview, TripNotification, Subscription, TripCompatibility
 from .serializers import (UserProfileSerializer, TravelInterestSerializer, 
                        PreferredDestinationSerializer, PreferredDestinationDetailSerializer, TripSerializer,
                        TravelBuddyRequestSerializer, UserPreferencesSerializer, UserProfileCompatibilitySerializer, 
                        BuddyProfileSerializer, MyBuddiesSerializer, CompatibleTripSerializer, TripDetailSerializer,
-                       ChatMessageSerializer, TripReviewSerializer, TripNotificationSerializer, ChatNotificationSerializer)
+                       ChatMessageSerializer, TripReviewSerializer, TripNotificationSerializer, ChatNotificationSerializer,
+                       SimilarTripSerializer)
 from django.contrib.auth import authenticate
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
@@ -18,8 +19,9 @@ from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, BlacklistedToken
 from datetime import datetime, timedelta, date
+from functools import partial
 from django.utils import timezone
-from django.db.models import Q, Count, F, Exists, OuterRef
+from django.db.models import Q, Count, F, Exists, OuterRef, prefetch_related_objects
 import jwt
 from django.conf import settings
 import json
@@ -36,9 +38,23 @@ from django.views.decorators.http import require_http_methods
 import random
 import string
 from django.core.mail import send_mail
-
-# Create a logger
+from . import chat_archive, chat_cursors
+from .chat_history import get_history_params, history_page, wants_history_page
+from .chat_limits import chat_counters
+from .chat_search import get_search_params, search_messages
+from .compatibility import ScoringContext, compatibility_scores, shared_activity_count
+from .compatibility_store import ensure_trip_compatibility
+from .interval_index import trip_interval_index
+from .membership_cache import trip_membership_cache
+from .presence import presence
+from .ranking import DEFAULT_PAGE_SIZE, get_page_params, after_cursor_q, paginate_ranked, top_k
+from .score_cache import score_cache
+from .similarity_index import similar_trip_index
+from .structured_logging import debug_queries_enabled, get_logger
+
+# Create a logger; hot paths use the lazy, sampled structured logger
 logger = logging.getLogger(__name__)
+log = get_logger(__name__)
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
@@ -392,65 +408,6 @@ def update_profile(request):
             'error': str(e)
         }, status=status.HTTP_400_BAD_REQUEST)
 
-# Helper functions for compatibility scoring
-def calculate_date_overlap_score(trip1, trip2):
-    """
-    Calculate date overlap score (30% weight)
-    Returns a score between 0 and 100 based on date overlap
-    """
-    # Calculate overlap
-    start_overlap = max(trip1.start_date, trip2.start_date)
-    end_overlap = min(trip1.end_date, trip2.end_date)
-
-    if start_overlap > end_overlap:
-        return 0  # No overlap
-
-    overlap_days = (end_overlap - start_overlap).days + 1
-    total_days = min((trip1.end_date - trip1.start_date).days + 1, (trip2.end_date - trip2.start_date).days + 1)
-
-    return (overlap_days / total_days) * 100
-
-def calculate_activities_score(trip1, trip2):
-    """
-    Calculate shared activities score (50% weight)
-    Returns a score between 0 and 100 based on shared activities
-    """
-    trip1_activities = set(trip1.activities.values_list('id', flat=True))
-    trip2_activities = set(trip2.activities.values_list('id', flat=True))
-    
-    if not trip1_activities or not trip2_activities:
-        return 0
-
-    shared_activities = len(trip1_activities.intersection(trip2_activities))
-    total_activities = len(trip1_activities)
-
-    return (shared_activities / total_activities) * 100
-
-def calculate_preferences_score(trip1, trip2):
-    """
-    Calculate user preferences score (20% weight)
-    Returns a score between 0 and 100 based on matching preferences
-    """
-    score = 0
-    
-    # Get user preferences
-    try:
-        trip1_prefs = UserPreferences.objects.get(user=trip1.user)
-        trip2_prefs = UserPreferences.objects.get(user=trip2.user)
-        
-        # Check travel frequency match
-        if trip1_prefs.travel_frequency == trip2_prefs.travel_frequency:
-            score += 10
-            
-        # Check travel budget match
-        if trip1_prefs.travel_budget == trip2_prefs.travel_budget:
-            score += 10
-            
-    except UserPreferences.DoesNotExist:
-        pass
-
-    return score
-
 def calculate_compatibility_score(trip1, trip2):
     """
     Calculate compatibility score between two trips based on:
@@ -459,6 +416,9 @@ def calculate_compatibility_score(trip1, trip2):
     3. Shared Activities (50%)
     4. User Preference Match (20%)
     
+    The scoring itself lives in compatibility.ScoringContext; use
+    compatibility_scores() or a ScoringContext when scoring many trips.
+    
     Args:
         trip1 (Trip): First trip object
         trip2 (Trip): Second trip object
@@ -466,19 +426,7 @@ def calculate_compatibility_score(trip1, trip2):
     Returns:
         float: Compatibility score as a percentage (0-100)
     """
-    # Mandatory destination match
-    if trip1.destination_id != trip2.destination_id:
-        return 0
-
-    # Calculate individual scores
-    date_score = calculate_date_overlap_score(trip1, trip2) * 0.3  # 30% weight
-    activities_score = calculate_activities_score(trip1, trip2) * 0.5  # 50% weight
-    preferences_score = calculate_preferences_score(trip1, trip2) * 0.2  # 20% weight
-
-    # Calculate final score
-    final_score = date_score + activities_score + preferences_score
-    
-    return round(final_score, 2)
+    return compatibility_scores(trip1, [trip2])[trip2.id]
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -495,6 +443,9 @@ def get_compatible_trips(request):
         start_date = parser.parse(trip_data['startDate'])
         end_date = parser.parse(trip_data['endDate'])
         
+        # Optional pagination: only the requested page is loaded and serialized
+        limit, cursor = get_page_params(request)
+        
         # Get current user's trip
         current_trip = Trip.objects.get(
             user=request.user,
@@ -503,26 +454,38 @@ def get_compatible_trips(request):
             end_date=end_date
         )
 
-        # Get other trips that match the destination
-        compatible_trips = Trip.objects.filter(
-            destination_id=destination_id,
-            user__is_discoverable=True
+        # Read the precomputed scores of other trips at the destination,
+        # already sorted by compatibility score (highest first) via the index
+        ensure_trip_compatibility(current_trip)
+        compatibilities = TripCompatibility.objects.filter(
+            trip=current_trip,
+            score__gt=0,
+            other_trip__user__is_discoverable=True
         ).exclude(
-            user=request.user
-        ).prefetch_related('activities')
-
-        # Calculate compatibility scores
-        results = []
-        for trip in compatible_trips:
-            score = calculate_compatibility_score(current_trip, trip)
-            if score > 0:
-                results.append({
-                    'trip': trip,
-                    'compatibility_score': score
-                })
+            other_trip__user=request.user
+        ).select_related(
+            'other_trip__user', 'other_trip__destination'
+        ).prefetch_related('other_trip__activities').order_by('-score', 'other_trip_id')
+
+        next_cursor = None
+        if limit is not None:
+            # Keyset pagination on (score, trip_id) served by the (trip, -score) index
+            if cursor is not None:
+                compatibilities = compatibilities.filter(after_cursor_q(cursor))
+            page, next_cursor = paginate_ranked(
+                ((compatibility.score, compatibility.other_trip_id, compatibility)
+                 for compatibility in compatibilities[:limit + 1]),
+                limit
+            )
+            compatibilities = [row[2] for row in page]
 
-        # Sort by compatibility score (highest first)
-        results.sort(key=lambda x: x['compatibility_score'], reverse=True)
+        results = [
+            {
+                'trip': compatibility.other_trip,
+                'compatibility_score': compatibility.score
+            }
+            for compatibility in compatibilities
+        ]
 
         # Serialize the results
         serialized_results = CompatibleTripSerializer(
@@ -531,6 +494,11 @@ def get_compatible_trips(request):
             context={'compatibility_scores': {int(item['trip'].id): item['compatibility_score'] for item in results}}
         ).data
 
+        if limit is not None:
+            return Response({
+                'results': serialized_results,
+                'next_cursor': next_cursor
+            })
         return Response(serialized_results)
 
     except Trip.DoesNotExist:
@@ -1004,10 +972,6 @@ def change_password(request):
 @csrf_exempt
 def find_travel_buddies(request):
     try:
-        # Log request details
-        logger.info(f"Received find_travel_buddies request")
-        logger.info(f"Headers: {dict(request.headers)}")
-        
         # Get and validate JWT token
         token = request.headers.get('Authorization', '').split(' ')[1]
         if not token:
@@ -1034,32 +998,22 @@ def find_travel_buddies(request):
                 return JsonResponse({'detail': 'Missing required trip details'}, status=400)
             
             try:
-                # Log database query details
-                logger.info(f"Fetching trip with ID: {trip_id}")
-                logger.info(f"Fetching user with ID: {user_id}")
-                
                 # Get the current trip and user preferences
                 current_trip = Trip.objects.get(id=trip_id)
                 current_user = UserProfile.objects.get(id=user_id)
                 
-                logger.info(f"Found trip: {current_trip.destination.name} from {current_trip.start_date} to {current_trip.end_date}")
-                logger.info(f"Found user: {current_user.username}")
-                
                 current_preferences = getattr(current_user, 'preferences', None)
+                log.debug(
+                    'find_travel_buddies',
+                    user_id=user_id,
+                    trip_id=current_trip.id,
+                    destination_id=current_trip.destination_id,
+                    has_preferences=current_preferences is not None
+                )
                 
-                if current_preferences:
-                    logger.info(f"User has preferences: budget={current_preferences.travel_budget}, frequency={current_preferences.travel_frequency}")
-                else:
-                    logger.info("User has no preferences set")
-                
-                # Helper function to check if two date ranges overlap
-                def date_ranges_overlap(start1, end1, start2, end2):
-                    return (start1 <= end2 and end1 >= start2)
-                
-                # Find other users with trips to the same destination
+                # Find other users with open trips to the same destination whose dates overlap
                 # Exclude the current user and their current trip
                 # Also exclude users who are already connected via accepted buddy requests
-                logger.info(f"Searching for buddies with trips to {current_trip.destination.name}")
                 
                 # Get all users the current user is already connected with
                 existing_buddies = TravelBuddyRequest.objects.filter(
@@ -1074,47 +1028,45 @@ def find_travel_buddies(request):
                     existing_buddies_set.add(to_user)
                 
                 existing_buddies_set.discard(current_user.id)  # Remove current user if present
-                logger.info(f"Found {len(existing_buddies_set)} existing buddies")
                 
-                buddies = UserProfile.objects.filter(
-                    trips__destination=current_trip.destination,
+                # Query the destination's interval index for overlapping open trips.
+                # For each buddy keep the overlapping trip that starts last, matching
+                # the trips' default '-start_date' ordering.
+                overlapping_trips = {}
+                for trip_id, buddy_id, trip_start in trip_interval_index.overlapping(
+                    current_trip.destination_id,
+                    current_trip.start_date,
+                    current_trip.end_date
+                ):
+                    if buddy_id == user_id or buddy_id in existing_buddies_set:
+                        continue
+                    if buddy_id not in overlapping_trips or trip_start > overlapping_trips[buddy_id][1]:
+                        overlapping_trips[buddy_id] = (trip_id, trip_start)
+                
+                buddies_with_overlap = list(UserProfile.objects.filter(
+                    id__in=overlapping_trips.keys(),
                     is_discoverable=True  # Only show discoverable users
-                ).exclude(
-                    id__in=existing_buddies_set
-                ).exclude(
-                    id=user_id
-                ).distinct()
+                ))
                 
-                logger.info(f"Found {buddies.count()} potential buddies after filtering")
+                log.debug('find_travel_buddies_overlap', user_id=user_id, existing_buddies=len(existing_buddies_set),
+                          buddies=len(buddies_with_overlap))
                 
-                # Filter buddies based on date overlap and shared activities
-                buddies_with_overlap = []
-                for buddy in buddies:
-                    buddy_trips = buddy.trips.filter(
-                        destination=current_trip.destination
+                # Fetch the overlapping trip of every buddy in a single query
+                buddy_trips = {
+                    buddy_trip.user_id: buddy_trip
+                    for buddy_trip in Trip.objects.filter(
+                        id__in=[overlapping_trips[buddy.id][0] for buddy in buddies_with_overlap]
                     )
-                    
-                    for buddy_trip in buddy_trips:
-                        if date_ranges_overlap(
-                            current_trip.start_date,
-                            current_trip.end_date,
-                            buddy_trip.start_date,
-                            buddy_trip.end_date
-                        ):
-                            buddies_with_overlap.append(buddy)
-                            break
-                
-                logger.info(f"Found {len(buddies_with_overlap)} buddies with date overlap")
+                }
                 
-                # Calculate compatibility scores and prepare flat response
+                # Calculate compatibility scores in one batch and prepare flat response
+                scores = compatibility_scores(current_trip, buddy_trips.values())
                 buddy_scores = []
                 for buddy in buddies_with_overlap:
-                    buddy_trip = buddy.trips.filter(
-                        destination=current_trip.destination
-                    ).first()
+                    buddy_trip = buddy_trips.get(buddy.id)
                     
                     if buddy_trip:
-                        score = calculate_compatibility_score(current_trip, buddy_trip)
+                        score = scores[buddy_trip.id]
                         buddy_scores.append({
                             'id': buddy.id,
                             'username': buddy.username,
@@ -1231,27 +1183,61 @@ class TripDetailsView(APIView):
 
 @permission_classes([IsAuthenticated])
 class CompatibleTripsView(APIView):
-    def get_travel_preferences(self, user):
+    def get_travel_preferences(self, preferences):
         """
-        Get formatted travel preferences for a user
+        Get formatted travel preferences from a (travel_frequency, travel_budget) tuple
         """
-        try:
-            prefs = UserPreferences.objects.get(user=user)
-            preferences = []
-            
-            if prefs.travel_budget:
-                budget_display = dict(UserPreferences.TRAVEL_BUDGET_CHOICES).get(prefs.travel_budget, prefs.travel_budget)
-                preferences.append(budget_display)
-                
-            if prefs.travel_frequency:
-                frequency_display = dict(UserPreferences.TRAVEL_FREQUENCY_CHOICES).get(prefs.travel_frequency, prefs.travel_frequency)
-                preferences.append(frequency_display)
-                
-            if preferences:
-                return ', '.join(preferences)
-            return 'Not specified'
-        except UserPreferences.DoesNotExist:
+        if not preferences:
             return 'Not specified'
+        
+        travel_frequency, travel_budget = preferences
+        formatted = []
+        
+        if travel_budget:
+            budget_display = dict(UserPreferences.TRAVEL_BUDGET_CHOICES).get(travel_budget, travel_budget)
+            formatted.append(budget_display)
+            
+        if travel_frequency:
+            frequency_display = dict(UserPreferences.TRAVEL_FREQUENCY_CHOICES).get(travel_frequency, travel_frequency)
+            formatted.append(frequency_display)
+            
+        if formatted:
+            return ', '.join(formatted)
+        return 'Not specified'
+    
+    def serialize_trip(self, trip, compatibility_score, context, member_trip_ids):
+        """
+        Build the response entry for one compatible trip
+        """
+        return {
+            'id': trip.id,
+            'destination': {
+                'id': trip.destination.id,
+                'name': trip.destination.name
+            },
+            'creator': {
+                'id': trip.user.id,
+                'username': trip.user.username,
+                'gender': trip.user.get_gender_display() if trip.user.gender else 'Not specified',
+                'travel_preferences': self.get_travel_preferences(context.preferences_for(trip.user_id)),
+                'date_of_birth': trip.user.dob.isoformat() if trip.user.dob else None
+            },
+            'activities': [
+                {
+                    'id': activity.id,
+                    'name': activity.name
+                }
+                for activity in trip.activities.all()
+            ],
+            'start_date': trip.start_date.isoformat(),
+            'end_date': trip.end_date.isoformat(),
+            'max_members': trip.max_members,
+            'current_members': trip.member_count,
+            'status': trip.status,
+            'description': trip.description or '',
+            'can_join': trip.id not in member_trip_ids,
+            'compatibility_score': compatibility_score
+        }
     
     def post(self, request):
         try:
@@ -1260,11 +1246,14 @@ class CompatibleTripsView(APIView):
             
             # Get trip details from request
             destination_id = request.data.get('destinationId')
-            activities = request.data.get('activities', [])
+            activities = [int(activity_id) for activity_id in request.data.get('activities', [])]
             start_date = datetime.fromisoformat(request.data.get('startDate').replace('Z', '+00:00'))
             end_date = datetime.fromisoformat(request.data.get('endDate').replace('Z', '+00:00'))
+            
+            # Activities of the request as a bitmask, tested against Trip.activity_mask
+            request_mask = Trip.activity_mask_for(activities)
 
-            # Find compatible trips
+            # Find compatible trips (shared activities via bitwise AND, no M2M join)
             compatible_trips = Trip.objects.filter(
                 destination_id=destination_id,
                 status='open',
@@ -1273,124 +1262,178 @@ class CompatibleTripsView(APIView):
             ).exclude(
                 user=user_profile
             ).annotate(
-                shared_activities_count=Count('activities', filter=Q(activities__id__in=activities)),
+                shared_activity_bits=F('activity_mask').bitand(request_mask),
                 member_count=Count('members')
             ).filter(
-                shared_activities_count__gt=0,
                 member_count__lt=F('max_members')
-            ).distinct()
-
-            # Prepare response data
-            trips_data = []
-            
-            # Get user preferences for compatibility scoring
-            try:
-                user_prefs = UserPreferences.objects.get(user=user_profile)
-            except UserPreferences.DoesNotExist:
-                user_prefs = None
-                
-            # Get the activity IDs from the request
-            user_activity_ids = set(activities)
-            
-            # Process each compatible trip
-            for trip in compatible_trips:
-                # Calculate compatibility score directly without using the helper functions
-                # 1. Date overlap (30% weight)
-                date_score = 0
-                if start_date and end_date and trip.start_date and trip.end_date:
-                    # Make sure dates are timezone-aware for comparison
-                    from django.utils import timezone
-                    
-                    # Convert user input dates to timezone-aware if they're naive
-                    user_start_date = timezone.make_aware(start_date) if timezone.is_naive(start_date) else start_date
-                    user_end_date = timezone.make_aware(end_date) if timezone.is_naive(end_date) else end_date
-                    
-                    # Get trip dates and ensure they're timezone-aware
-                    trip_start_date = timezone.make_aware(trip.start_date) if timezone.is_naive(trip.start_date) else trip.start_date
-                    trip_end_date = timezone.make_aware(trip.end_date) if timezone.is_naive(trip.end_date) else trip.end_date
-                    
-                    # Now compare the timezone-aware dates
-                    start_overlap = max(user_start_date, trip_start_date)
-                    end_overlap = min(user_end_date, trip_end_date)
-                    
-                    if start_overlap <= end_overlap:
-                        overlap_days = (end_overlap - start_overlap).days + 1
-                        total_days = min((user_end_date - user_start_date).days + 1, (trip_end_date - trip_start_date).days + 1)
-                        if total_days > 0:
-                            date_score = (overlap_days / total_days) * 100 * 0.3  # 30% weight
-                
-                # 2. Shared activities (50% weight)
-                activities_score = 0
-                trip_activity_ids = set(trip.activities.values_list('id', flat=True))
-                
-                if user_activity_ids and trip_activity_ids:
-                    shared_activities = len(user_activity_ids.intersection(trip_activity_ids))
-                    total_activities = len(user_activity_ids)
-                    if total_activities > 0:
-                        activities_score = (shared_activities / total_activities) * 100 * 0.5  # 50% weight
-                
-                # 3. User preferences (20% weight)
-                preferences_score = 0
-                if user_prefs:
-                    try:
-                        trip_prefs = UserPreferences.objects.get(user=trip.user)
-                        
-                        # Check travel frequency match
-                        if user_prefs.travel_frequency == trip_prefs.travel_frequency:
-                            preferences_score += 10
-                            
-                        # Check travel budget match
-                        if user_prefs.travel_budget == trip_prefs.travel_budget:
-                            preferences_score += 10
-                            
-                        preferences_score = preferences_score * 0.2  # 20% weight
-                    except UserPreferences.DoesNotExist:
-                        pass
-                
-                # Calculate final score
-                compatibility_score = date_score + activities_score + preferences_score
-                trip_data = {
-                    'id': trip.id,
-                    'destination': {
-                        'id': trip.destination.id,
-                        'name': trip.destination.name
-                    },
-                    'creator': {
-                        'id': trip.user.id,
-                        'username': trip.user.username,
-                        'gender': trip.user.get_gender_display() if trip.user.gender else 'Not specified',
-                        'travel_preferences': self.get_travel_preferences(trip.user),
-                        'date_of_birth': trip.user.dob.isoformat() if trip.user.dob else None
-                    },
-                    'activities': [
-                        {
-                            'id': activity.id,
-                            'name': activity.name
-                        }
-                        for activity in trip.activities.all()
-                    ],
-                    'start_date': trip.start_date.isoformat(),
-                    'end_date': trip.end_date.isoformat(),
-                    'max_members': trip.max_members,
-                    'current_members': trip.member_count,
-                    'status': trip.status,
-                    'description': trip.description or '',
-                    'can_join': not is_user_member(trip, user_profile),
-                    'compatibility_score': round(compatibility_score, 2)
-                }
-                trips_data.append(trip_data)
+            ).exclude(
+                shared_activity_bits=0
+            ).select_related('user', 'destination')
+
+            # Optional pagination: (score, trip_id, trip) rows feed a bounded heap
+            limit, cursor = get_page_params(request)
+            
+            # Everything needed for scoring is loaded once into the scoring context
+            context = ScoringContext.for_request(user_profile, destination_id, start_date, end_date, activities)
+            
+            # When the request describes one of the user's saved trips exactly
+            # (same destination, dates and activities), read its precomputed
+            # scores in one query instead of scoring every row. Stored pairs
+            # cover 'open' and 'full' trips, a superset of the candidates here;
+            # candidates without a row are scored below.
+            stored_scores = None
+            reference_trip_id = request.data.get('tripId')
+            reference_trip = Trip.objects.filter(id=reference_trip_id, user=user_profile).first() if reference_trip_id else None
+            if reference_trip is not None and (
+                reference_trip.destination_id == int(destination_id)
+                and reference_trip.start_date == start_date
+                and reference_trip.end_date == end_date
+                and set(reference_trip.activity_ids) == set(activities)
+            ):
+                ensure_trip_compatibility(reference_trip)
+                stored_scores = dict(TripCompatibility.objects.filter(
+                    trip_id=reference_trip.id,
+                    other_trip__in=compatible_trips
+                ).values_list('other_trip_id', 'score'))
+            
+            # Score compatible trips lazily so that, when only a page is needed,
+            # rows are streamed from the database into the bounded heap
+            def scored_trips():
+                candidates = compatible_trips if limit is None else compatible_trips.iterator()
+                # Exact shared count (the SQL mask test can over-match for interest ids above 63)
+                candidates = (
+                    trip for trip in candidates
+                    if shared_activity_count(request_mask, activities, trip.activity_mask, trip.activity_ids)
+                )
+                if stored_scores is not None:
+                    unscored = []
+                    for trip in candidates:
+                        if trip.id in stored_scores:
+                            yield stored_scores[trip.id], trip.id, trip
+                        else:
+                            unscored.append(trip)
+                    # A missing row is a pair that has not been stored (yet): score it
+                    for score, trip in context.iter_scores(unscored):
+                        yield score, trip.id, trip
+                else:
+                    for score, trip in context.iter_scores(candidates):
+                        yield score, trip.id, trip
 
-            # Sort trips by compatibility score (highest first)
-            trips_data.sort(key=lambda x: x['compatibility_score'], reverse=True)
+            next_cursor = None
+            if limit is None:
+                # Sort trips by compatibility score (highest first)
+                ranked = sorted(scored_trips(), key=lambda row: row[0], reverse=True)
+            else:
+                # Only keep the requested page in a bounded heap
+                ranked, next_cursor = top_k(scored_trips(), limit, cursor)
+
+            # Load activity names, creator preferences and the user's memberships
+            # for the returned trips only, in a constant number of queries
+            page_trips = [row[2] for row in ranked]
+            prefetch_related_objects(page_trips, 'activities')
+            context.load_preferences(trip.user_id for trip in page_trips)
+            member_trip_ids = set(Trip.members.through.objects.filter(
+                trip_id__in=[trip.id for trip in page_trips],
+                userprofile_id=user_profile.id
+            ).values_list('trip_id', flat=True))
+            trips_data = [
+                self.serialize_trip(trip, score, context, member_trip_ids)
+                for score, _, trip in ranked
+            ]
 
+            if limit is not None:
+                return JsonResponse({
+                    'results': trips_data,
+                    'next_cursor': next_cursor
+                })
             return JsonResponse(trips_data, safe=False)
 
+        except ValueError as e:
+            return Response({
+                'detail': f'Invalid input data: {str(e)}'
+            }, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error finding compatible trips: {str(e)}")
             return Response({
                 'detail': 'Failed to find compatible trips'
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+class SimilarTripsView(APIView):
+    """
+    Open trips at any destination whose activities are similar to a trip's.
+
+    Candidates come from the MinHash/LSH similarity index, so the cost depends
+    on the number of similar trips rather than on the total number of trips.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, trip_id):
+        try:
+            trip = get_object_or_404(Trip, id=trip_id)
+
+            limit, cursor = get_page_params(request)
+            min_similarity = float(request.query_params.get('min_similarity', 0.3))
+
+            candidates = similar_trip_index.similar(
+                trip.activity_ids,
+                exclude_trip_id=trip.id,
+                exclude_user_id=request.user.id,
+                min_similarity=min_similarity
+            )
+
+            # Only show trips created by discoverable users
+            discoverable_ids = set(UserProfile.objects.filter(
+                id__in={user_id for _, _, user_id, _ in candidates},
+                is_discoverable=True
+            ).values_list('id', flat=True))
+
+            page, next_cursor = top_k(
+                ((similarity, other_trip_id, None)
+                 for similarity, other_trip_id, user_id, _ in candidates
+                 if user_id in discoverable_ids),
+                limit or DEFAULT_PAGE_SIZE,
+                cursor
+            )
+
+            trips_by_id = Trip.objects.select_related(
+                'user', 'destination'
+            ).prefetch_related('activities').in_bulk([row[1] for row in page])
+            # A trip can be deleted between the index lookup and this query
+            similar_trips = [trips_by_id[row[1]] for row in page if row[1] in trips_by_id]
+
+            # Reference pair scores only exist at the same destination
+            scores = compatibility_scores(trip, [
+                other for other in similar_trips if other.destination_id == trip.destination_id
+            ])
+
+            serialized_results = SimilarTripSerializer(
+                similar_trips,
+                many=True,
+                context={
+                    'similarities': {row[1]: row[0] for row in page},
+                    'compatibility_scores': scores
+                }
+            ).data
+
+            return Response({
+                'results': serialized_results,
+                'next_cursor': next_cursor
+            })
+
+        except Http404:
+            return Response({
+                'detail': 'Trip not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        except ValueError as e:
+            return Response({
+                'detail': f'Invalid input data: {str(e)}'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            logger.error(f"Error finding similar trips: {str(e)}")
+            return Response({
+                'detail': 'Failed to find similar trips'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 class MyTripsView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -1401,18 +1444,22 @@ class MyTripsView(APIView):
                 Q(user=request.user) | Q(members=request.user)
             ).distinct()
             
-            # Log the number of trips found, including cancelled ones
-            cancelled_trips = trips.filter(status='cancelled')
-            logger.info(f'Found {trips.count()} total trips for user {request.user.username}, including {cancelled_trips.count()} cancelled trips')
-            
-            # Log each cancelled trip for debugging
-            for trip in cancelled_trips:
-                logger.info(f'Cancelled trip found: ID={trip.id}, Destination={trip.destination.name}, Status={trip.status}, Cancelled by={trip.cancelled_by.username if trip.cancelled_by else "Unknown"}')
-
             # Serialize the trips
             serializer = TripSerializer(trips, many=True)
+            data = serializer.data
+            log.debug('my_trips', user_id=request.user.id, trips=len(data))
+            
+            # Cancelled trip details cost extra queries; only with LOG_DEBUG_QUERIES
+            if debug_queries_enabled() and log.logger.isEnabledFor(logging.DEBUG):
+                for trip in trips.filter(status='cancelled').select_related('destination', 'cancelled_by'):
+                    log.debug(
+                        'my_trips_cancelled',
+                        trip_id=trip.id,
+                        destination=trip.destination.name,
+                        cancelled_by=trip.cancelled_by.username if trip.cancelled_by else None
+                    )
             
-            return Response(serializer.data)
+            return Response(data)
             
         except Exception as e:
             logger.error(f"Error fetching my trips: {str(e)}")
@@ -1525,63 +1572,125 @@ class MyBuddiesView(generics.ListAPIView):
 
 
 class TripChatMessagesView(generics.ListCreateAPIView):
-    """View to list and create chat messages for a specific trip."""
+    """
+    View to list and create chat messages for a specific trip.
+
+    GET without parameters returns the whole history. With ``limit``,
+    ``before_id``, ``after_id`` or ``since`` it returns one keyset page
+    instead (see chat_history.py):
+
+        {"results": [...], "has_more": bool, "gap": bool}
+
+    Messages of finished trips moved to the chat archive are read through
+    transparently in both cases.
+    """
     serializer_class = ChatMessageSerializer
     permission_classes = [permissions.IsAuthenticated]
     
+    def is_trip_member(self, trip):
+        user = self.request.user
+        return trip.user_id == user.id or trip.members.filter(id=user.id).exists()
+    
     def get_queryset(self):
         trip_id = self.kwargs.get('trip_id')
         trip = get_object_or_404(Trip, id=trip_id)
         
         # Check if the user is a member of the trip
-        if self.request.user not in trip.members.all() and self.request.user != trip.user:
+        if not self.is_trip_member(trip):
             return ChatMessage.objects.none()
+        self.archive_trip_id = trip.id
         
-        return ChatMessage.objects.filter(trip_id=trip_id)
+        # Sender data is joined in the same query for the serializer
+        return ChatMessage.objects.filter(trip_id=trip_id).select_related('sender')
+    
+    def list(self, request, *args, **kwargs):
+        self.archive_trip_id = None
+        queryset = self.get_queryset()
+        # Archived messages (members only) are older than every message left in the table
+        older = None
+        if self.archive_trip_id is not None:
+            older = partial(chat_archive.archived_messages, self.archive_trip_id)
+        
+        if not wants_history_page(request.query_params):
+            messages = (older() if older else []) + list(queryset)
+            return Response(self.get_serializer(messages, many=True).data)
+        
+        try:
+            limit, mode, message_id = get_history_params(request.query_params)
+        except ValueError as e:
+            return Response({
+                'detail': f'Invalid input data: {str(e)}'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        page = history_page(queryset, limit, mode, message_id, older)
+        return Response({
+            'results': self.get_serializer(page['messages'], many=True).data,
+            'has_more': page['has_more'],
+            'gap': page['gap']
+        })
     
     def perform_create(self, serializer):
         trip_id = self.kwargs.get('trip_id')
         trip = get_object_or_404(Trip, id=trip_id)
         
         # Check if the user is a member of the trip
-        if self.request.user not in trip.members.all() and self.request.user != trip.user:
+        if not self.is_trip_member(trip):
             raise PermissionDenied("You must be a member of this trip to send messages.")
         
-        # Save the chat message
-        chat_message = serializer.save(sender=self.request.user, trip=trip)
-        
-        # Create chat notifications for all trip members except the sender
-        self.create_chat_notifications(trip, chat_message)
-        
-    def create_chat_notifications(self, trip, chat_message):
-        """Create chat notifications for all trip members except the sender."""
-        sender = self.request.user
-        
-        # Get all trip members (including the creator) except the sender
-        recipients = set()
-        
-        # Add trip creator if not the sender
-        if trip.user != sender:
-            recipients.add(trip.user)
+        # A single insert: recipients find the message through their read cursors
+        serializer.save(sender=self.request.user, trip=trip)
+
+class TripChatSearchView(APIView):
+    """
+    Full-text search over a trip's chat, for its creator and members.
+
+    GET /api/trip/<trip_id>/chat/search/?q=<words>[&order=rank|recent][&limit=20][&cursor=...]
+
+    Returns the matching messages with a highlighted ``snippet`` (HTML-escaped,
+    matches wrapped in <mark>) and ``next_cursor`` for the following page
+    (see chat_search.py):
+
+        {"results": [...], "next_cursor": str or null, "archived_through_id": int or null}
+
+    Archived messages (chat_archive.py) are not searched: ``archived_through_id``
+    is the id of the trip's newest archived message, and messages up to and
+    including it never appear in the results (null if nothing is archived).
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, trip_id):
+        trip = get_object_or_404(Trip, id=trip_id)
+        user = request.user
+        if trip.user_id != user.id and not trip.members.filter(id=user.id).exists():
+            return Response({
+                'detail': 'You must be a member of this trip to search its chat.'
+            }, status=status.HTTP_403_FORBIDDEN)
         
-        # Add all trip members except the sender
-        for member in trip.members.all():
-            if member != sender:
-                recipients.add(member)
+        try:
+            terms, order, limit, cursor = get_search_params(request.query_params)
+        except ValueError as e:
+            return Response({
+                'detail': f'Invalid input data: {str(e)}'
+            }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Create message preview (truncate to 50 chars)
-        message_preview = chat_message.message[:47] + '...' if len(chat_message.message) > 50 else chat_message.message
+        page = search_messages(trip.id, terms, order, limit, cursor)
+        messages = ChatMessage.objects.select_related('sender').in_bulk([hit[0] for hit in page['hits']])
+        results = []
+        for message_id, rank, snippet in page['hits']:
+            if message_id not in messages:
+                # Deleted between the two queries
+                continue
+            data = ChatMessageSerializer(messages[message_id]).data
+            data['snippet'] = snippet
+            data['rank'] = rank
+            results.append(data)
         
-        # Create a notification for each recipient
-        for recipient in recipients:
-            ChatNotification.objects.create(
-                user=recipient,
-                trip=trip,
-                chat_message=chat_message,
-                sender=sender,
-                message_preview=message_preview,
-                is_read=False
-            )
+        return Response({
+            'results': results,
+            'next_cursor': page['next_cursor'],
+            'archived_through_id': chat_archive.newest_archived_id(trip.id),
+        })
+
 
 class TripCreateView(APIView):
     """
@@ -2110,7 +2219,11 @@ class AdminStatsView(APIView):
                 'interests': interests_count,
                 'mappings': mappings_count,
                 'trips': trips_count,
-                'reviews': reviews_count
+                'reviews': reviews_count,
+                'compatibility_cache': score_cache.stats(),
+                'chat_membership_cache': trip_membership_cache.stats(),
+                'chat_frames': dict(chat_counters),
+                'chat_presence': presence.stats()
             }
             
             return Response(stats, status=status.HTTP_200_OK)
@@ -3547,13 +3660,19 @@ class UnreadNotificationCountView(APIView):
 
 
 class ChatNotificationView(APIView):
-    """View to list and manage user's chat notifications."""
+    """
+    View to list and manage user's chat notifications.
+
+    Notifications are derived from the user's chat read cursors: every
+    message of the user's trip chats above their cleared cursor is listed,
+    with the message id as notification id.
+    """
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
         # Get all chat notifications for the current user
-        notifications = ChatNotification.objects.filter(user=request.user).order_by('-created_at')
-        serializer = ChatNotificationSerializer(notifications, many=True)
+        messages = chat_cursors.notification_messages(request.user)
+        serializer = ChatNotificationSerializer(messages, many=True, context={'user': request.user})
         return Response(serializer.data)
     
     def post(self, request):
@@ -3561,24 +3680,17 @@ class ChatNotificationView(APIView):
         clear_all = request.data.get('clear_all', False)
         
         if clear_all:
-            # Delete all chat notifications for the current user
-            count = ChatNotification.objects.filter(user=request.user).delete()[0]
+            # Move all of the user's cursors to the latest message of each trip
+            count = chat_cursors.clear_notifications(request.user)
             return Response({"message": f"All chat notifications cleared", "count": count}, status=status.HTTP_200_OK)
         
         # Mark notifications as read
         notification_ids = request.data.get('notification_ids', [])
         if not notification_ids:
             return Response({"error": "No notification IDs provided"}, status=status.HTTP_400_BAD_REQUEST)
-            
-        notifications = ChatNotification.objects.filter(
-            id__in=notification_ids,
-            user=request.user
-        )
         
-        for notification in notifications:
-            notification.mark_as_read()
-            
-        return Response({"message": f"{len(notifications)} chat notifications marked as read"})
+        count = chat_cursors.mark_messages_read(request.user, notification_ids)
+        return Response({"message": f"{count} chat notifications marked as read"})
 
 
 class UnreadChatNotificationCountView(APIView):
@@ -3586,13 +3698,8 @@ class UnreadChatNotificationCountView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
-        # Count unread chat notifications for the current user
-        unread_count = ChatNotification.objects.filter(
-            user=request.user,
-            is_read=False
-        ).count()
-        
-        return Response({"unread_count": unread_count})
+        # Sum of the id > cursor ranges of the user's trip chats
+        return Response({"unread_count": chat_cursors.unread_count(request.user)})
 
 
 class RemoveTripMemberView(APIView):
@@ -0,0 +1,215 @@
+"""
+WebSocket wire formats of the chat, negotiated through subprotocols.
+
+Clients that do not ask for a subprotocol keep getting the verbose JSON
+frames. Clients can offer one of these in Sec-WebSocket-Protocol instead:
+
+- ``travelbuddy.chat.json-min.v1``: compact JSON text frames with short keys
+  and no whitespace;
+- ``travelbuddy.chat.msgpack.v1``: the same compact objects as MessagePack
+  binary frames (only offered when the msgpack package is installed).
+
+Compact chat messages use these keys:
+
+    i: message id      m: message text     t: timestamp (Unix ms)
+    s: sender id       u: sender username  p: sender picture URL
+
+``formatted_timestamp`` is left out; clients format ``t`` locally. Other
+frames (e.g. history) keep their keys and only lose the whitespace.
+
+On the multiplexed user socket (ws/user/) frames of a trip room are wrapped
+as ``{"trip_id": ..., "data": <frame>}``; the wrapping is a string format of
+the pre-encoded frame, so it costs no re-serialization either.
+Compression on top of this is permessage-deflate, which is negotiated by the
+ASGI server (see CHAT_PERMESSAGE_DEFLATE).
+"""
+import json
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack ships with channels-redis
+    msgpack = None
+
+SUBPROTOCOL_JSON_MIN = 'travelbuddy.chat.json-min.v1'
+SUBPROTOCOL_MSGPACK = 'travelbuddy.chat.msgpack.v1'
+
+
+def supported_subprotocols():
+    subprotocols = [SUBPROTOCOL_JSON_MIN]
+    if msgpack is not None:
+        subprotocols.append(SUBPROTOCOL_MSGPACK)
+    return subprotocols
+
+
+def select_subprotocol(offered):
+    """
+    Pick the first subprotocol offered by the client that the server supports.
+
+    Returns:
+        str: The subprotocol, or None for the default JSON format
+    """
+    supported = supported_subprotocols()
+    for subprotocol in offered or ():
+        if subprotocol in supported:
+            return subprotocol
+    return None
+
+
+def sender_metadata(user):
+    """Sender fields of the chat frames sent by a user, resolved once per connection."""
+    return {
+        'sender_id': user.id,
+        'sender_username': user.username,
+        'sender_profile_picture': user.profile_picture.url if user.profile_picture else None
+    }
+
+
+def encode_chat_frame(chat_message, sender):
+    """Encode the WebSocket frame of a chat message (sent as is to every group member)."""
+    return json.dumps({
+        'message': chat_message.message,
+        **sender,
+        'timestamp': chat_message.timestamp.isoformat(),
+        'formatted_timestamp': chat_message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        'message_id': chat_message.id
+    })
+
+
+def compact_chat_message(chat_message, sender):
+    """Compact representation of a chat message sent by ``sender`` (see sender_metadata)."""
+    return {
+        'i': chat_message.id,
+        'm': chat_message.message,
+        't': int(chat_message.timestamp.timestamp() * 1000),
+        's': sender['sender_id'],
+        'u': sender['sender_username'],
+        'p': sender['sender_profile_picture']
+    }
+
+
+def dumps_compact(payload):
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+
+
+# MessagePack frames of the latest broadcasts, keyed by the broadcast (message
+# or presence diff id) rather than its text, so that every socket of the
+# process receiving a broadcast reuses one packing
+PACKED_BROADCASTS_SIZE = 256
+_packed_broadcasts = OrderedDict()
+
+
+def _broadcast_key(event):
+    if 'message_id' in event:
+        return 'message', event['message_id']
+    if 'id' in event:
+        return 'presence', event['id']
+    return None
+
+
+def _msgpack_from_compact_json(compact_text, cache_key=None):
+    if cache_key is None:
+        return msgpack.packb(json.loads(compact_text))
+    packed = _packed_broadcasts.get(cache_key)
+    if packed is None:
+        packed = _packed_broadcasts[cache_key] = msgpack.packb(json.loads(compact_text))
+        if len(_packed_broadcasts) > PACKED_BROADCASTS_SIZE:
+            _packed_broadcasts.popitem(last=False)
+    return packed
+
+
+def _frame(subprotocol, frame, compact, trip_id=None, broadcast_key=None):
+    # Send the pre-encoded default or compact text, wrapped for the user socket
+    if subprotocol is None:
+        if trip_id is not None:
+            frame = '{"trip_id": %d, "data": %s}' % (trip_id, frame)
+        return {'text_data': frame}
+
+    if trip_id is not None:
+        compact = '{"trip_id":%d,"data":%s}' % (trip_id, compact)
+    if subprotocol == SUBPROTOCOL_MSGPACK:
+        cache_key = None if broadcast_key is None else (broadcast_key, trip_id)
+        return {'bytes_data': _msgpack_from_compact_json(compact, cache_key)}
+    return {'text_data': compact}
+
+
+def chat_frame(subprotocol, event, trip_id=None):
+    """
+    Frame of a pre-encoded group event (chat_message, presence_diff) in a
+    socket's wire format.
+
+    The event carries the default frame ('frame') and the compact JSON frame
+    ('compact'), both encoded once by the sender; the MessagePack frame is
+    packed once per process and broadcast.
+
+    Args:
+        trip_id: Wrap the frame for the user socket
+
+    Returns:
+        dict: text_data or bytes_data keyword argument for send()
+    """
+    return _frame(subprotocol, event['frame'], event['compact'], trip_id, _broadcast_key(event))
+
+
+def history_frame(subprotocol, entries, trip_id=None):
+    """
+    Frame listing recent chat messages, assembled from their pre-encoded
+    frames: ``{"type": "history", "messages": [...]}``.
+
+    Args:
+        entries: (message id, default frame, compact frame) tuples, oldest first
+        trip_id: Wrap the frame for the user socket
+
+    Returns:
+        dict: text_data or bytes_data keyword argument for send()
+    """
+    if subprotocol is None:
+        return _frame(subprotocol, '{"type": "history", "messages": [%s]}' % ', '.join(entry[1] for entry in entries),
+                      None, trip_id)
+    return _frame(subprotocol, None, '{"type":"history","messages":[%s]}' % ','.join(entry[2] for entry in entries),
+                  trip_id)
+
+
+def encode_frame(subprotocol, payload, trip_id=None):
+    """
+    Encode any other frame in a socket's wire format.
+
+    Args:
+        trip_id: Wrap the frame for the user socket
+
+    Returns:
+        dict: text_data or bytes_data keyword argument for send()
+    """
+    if trip_id is not None:
+        payload = {'trip_id': trip_id, 'data': payload}
+    if subprotocol == SUBPROTOCOL_JSON_MIN:
+        return {'text_data': dumps_compact(payload)}
+    if subprotocol == SUBPROTOCOL_MSGPACK:
+        return {'bytes_data': msgpack.packb(payload)}
+    return {'text_data': json.dumps(payload)}
+
+
+def decode_frame(subprotocol, text_data=None, bytes_data=None):
+    """
+    Decode a frame received from a client.
+
+    Compact clients may send ``{"m": ...}`` instead of ``{"message": ...}``.
+
+    Raises:
+        ValueError: If the frame cannot be decoded
+    """
+    if bytes_data is not None:
+        if subprotocol != SUBPROTOCOL_MSGPACK:
+            raise ValueError('Binary frames need the msgpack subprotocol')
+        try:
+            payload = msgpack.unpackb(bytes_data)
+        except Exception as e:
+            raise ValueError(f'Invalid msgpack frame: {str(e)}') from e
+    else:
+        payload = json.loads(text_data)
+
+    if not isinstance(payload, dict):
+        raise ValueError('Frames must be objects')
+    if 'm' in payload and 'message' not in payload:
+        payload['message'] = payload['m']
+    return payload
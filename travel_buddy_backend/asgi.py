@@ -29,6 +29,9 @@ from auth_app.middleware import JwtAuthMiddlewareStack
 # Import websocket routing
 from auth_app.routing import websocket_urlpatterns
 
+# Lifespan handler that drains in-memory work on shutdown
+from auth_app.lifespan import lifespan_application
+
 # Configure the ASGI application
 application = ProtocolTypeRouter({
     # Django's ASGI application for handling HTTP requests
@@ -40,4 +43,7 @@ application = ProtocolTypeRouter({
             websocket_urlpatterns
         )
     ),
+
+    # Startup/shutdown events (uvicorn); drains the chat write-behind queue
+    'lifespan': lifespan_application,
 })
@@ -88,11 +88,58 @@ WSGI_APPLICATION = 'travel_buddy_backend.wsgi.application'
 ASGI_APPLICATION = 'travel_buddy_backend.asgi.application'
 
 # Channel Layers Configuration
-CHANNEL_LAYERS = {
+# Groups (e.g. chat_{trip_id}) must be shared by every ASGI worker, so use a
+# broker-backed layer whenever more than one worker runs:
+# - REDIS_URL: Redis channel layer, for workers on one or more hosts
+# - CHANNEL_LAYER_DB: SQLite file shared by the workers of a single host,
+#   a local stand-in that needs no external service
+# - neither: in-memory layer, only valid with a single worker process
+if env('REDIS_URL', default=''):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [env('REDIS_URL')],
+            },
+        },
+    }
+elif env('CHANNEL_LAYER_DB', default=''):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'auth_app.channel_layers.SQLiteChannelLayer',
+            'CONFIG': {
+                'path': env('CHANNEL_LAYER_DB'),
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+# Caches
+# 'default' is per process. 'shared' is seen by every worker process and holds
+# the small keys that tell workers to reload their in-memory indexes and
+# caches (e.g. rebuild_trip_index): Redis with REDIS_URL (every host), otherwise
+# files under SHARED_CACHE_DIR (the workers of one host)
+CACHES = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     },
 }
+if env('REDIS_URL', default=''):
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': env('REDIS_URL'),
+        'KEY_PREFIX': 'travel_buddy',
+    }
+else:
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': env('SHARED_CACHE_DIR', default=os.path.join(BASE_DIR, 'shared_cache')),
+    }
 
 
 
@@ -213,16 +260,6 @@ REST_FRAMEWORK = {
     ),
 }
 
-# Django Channels Configuration
-ASGI_APPLICATION = 'travel_buddy_backend.asgi.application'
-
-# Channel layer configuration for WebSockets
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-    },
-}
-
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=env.int('ACCESS_TOKEN_LIFETIME_MINUTES', default=60)),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=env.int('REFRESH_TOKEN_LIFETIME_DAYS', default=1)),
@@ -254,3 +291,111 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_LIFETIME': timedelta(minutes=5),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
 }
+
+# Trip matching
+# Maximum number of pairwise compatibility scores kept in each process's LRU cache
+COMPATIBILITY_CACHE_SIZE = env.int('COMPATIBILITY_CACHE_SIZE', default=50000)
+# Candidate sets larger than this are split into shards of this size and scored
+# in a process pool (0 keeps all scoring in the calling thread)
+COMPATIBILITY_SHARD_SIZE = env.int('COMPATIBILITY_SHARD_SIZE', default=5000)
+# Also shard scoring done while serving a request (off: only the background
+# refresh and management commands use the process pool)
+COMPATIBILITY_SHARD_REQUESTS = env.bool('COMPATIBILITY_SHARD_REQUESTS', default=False)
+# Number of scoring worker processes (0 uses one per CPU)
+COMPATIBILITY_SHARD_WORKERS = env.int('COMPATIBILITY_SHARD_WORKERS', default=0)
+# Recompute stored TripCompatibility pairs on a background thread after the
+# commit instead of in the request. Off by default on SQLite: its single
+# writer lock makes the refresh thread and request writes lock each other out
+COMPATIBILITY_REFRESH_IN_BACKGROUND = env.bool(
+    'COMPATIBILITY_REFRESH_IN_BACKGROUND',
+    default=DATABASES['default']['ENGINE'] != 'django.db.backends.sqlite3'
+)
+# Seconds before a process reloads a destination's interval tree of open trips
+# even if no change to it was published
+TRIP_INDEX_TTL_SECONDS = env.int('TRIP_INDEX_TTL_SECONDS', default=300)
+# Seconds before a process reloads its MinHash/LSH index of open trips
+SIMILAR_TRIP_INDEX_TTL_SECONDS = env.int('SIMILAR_TRIP_INDEX_TTL_SECONDS', default=600)
+
+# Chat
+# Broadcast WebSocket chat messages immediately and persist them in batches
+CHAT_WRITE_BEHIND = env.bool('CHAT_WRITE_BEHIND', default=False)
+# Maximum delay and batch size of write-behind flushes
+CHAT_FLUSH_INTERVAL_MS = env.int('CHAT_FLUSH_INTERVAL_MS', default=200)
+CHAT_FLUSH_BATCH_SIZE = env.int('CHAT_FLUSH_BATCH_SIZE', default=500)
+# Snowflake worker id (0-31) of this process; must differ between workers. When
+# unset, each process leases a free id from the database for this many seconds
+# and keeps renewing it (see auth_app/snowflake.py)
+CHAT_WORKER_ID = env.int('CHAT_WORKER_ID', default=None)
+CHAT_WORKER_LEASE_SECONDS = env.int('CHAT_WORKER_LEASE_SECONDS', default=60)
+# Seconds a process trusts its cached trip memberships when authorizing chat sockets
+CHAT_MEMBERSHIP_CACHE_TTL_SECONDS = env.int('CHAT_MEMBERSHIP_CACHE_TTL_SECONDS', default=60)
+# Latest messages per trip kept in memory and sent to sockets on join (0 disables)
+CHAT_HISTORY_BUFFER_SIZE = env.int('CHAT_HISTORY_BUFFER_SIZE', default=50)
+# Chat messages per second and burst allowed per socket and per user (in each process)
+CHAT_RATE_PER_SECOND = env.float('CHAT_RATE_PER_SECOND', default=5)
+CHAT_RATE_BURST = env.int('CHAT_RATE_BURST', default=10)
+CHAT_USER_RATE_PER_SECOND = env.float('CHAT_USER_RATE_PER_SECOND', default=10)
+CHAT_USER_RATE_BURST = env.int('CHAT_USER_RATE_BURST', default=20)
+# Frames queued per socket before it counts as a slow consumer, and what to do
+# then: 'close' the socket (clients reconnect and catch up) or 'drop' frames
+CHAT_SEND_QUEUE_SIZE = env.int('CHAT_SEND_QUEUE_SIZE', default=100)
+CHAT_SLOW_CONSUMER_POLICY = env('CHAT_SLOW_CONSUMER_POLICY', default='close')
+# Presence: interval of the batched presence/typing diffs per room, seconds before
+# users of other workers expire without a heartbeat, and typing indicator timeout
+CHAT_PRESENCE_INTERVAL_MS = env.int('CHAT_PRESENCE_INTERVAL_MS', default=300)
+CHAT_PRESENCE_TTL_SECONDS = env.int('CHAT_PRESENCE_TTL_SECONDS', default=30)
+CHAT_TYPING_TIMEOUT_SECONDS = env.int('CHAT_TYPING_TIMEOUT_SECONDS', default=5)
+# Chat of trips finished this many days ago is moved to compressed archive
+# segments (archive_chat_history command) stored in CHAT_ARCHIVE_DIR, in
+# gzip blocks of CHAT_ARCHIVE_BLOCK_SIZE messages
+CHAT_ARCHIVE_AFTER_DAYS = env.int('CHAT_ARCHIVE_AFTER_DAYS', default=90)
+CHAT_ARCHIVE_DIR = env('CHAT_ARCHIVE_DIR', default=os.path.join(BASE_DIR, 'chat_archive'))
+CHAT_ARCHIVE_BLOCK_SIZE = env.int('CHAT_ARCHIVE_BLOCK_SIZE', default=200)
+# Let the WebSocket server negotiate permessage-deflate compression (uvicorn;
+# daphne does not support it)
+CHAT_PERMESSAGE_DEFLATE = env.bool('CHAT_PERMESSAGE_DEFLATE', default=True)
+
+# Logging
+# Level and format ('text' or 'json' lines) of the console log
+LOG_LEVEL = env('LOG_LEVEL', default='INFO')
+LOG_FORMAT = env('LOG_FORMAT', default='text')
+# Share of DEBUG/INFO records kept per logger (and its children), e.g.
+# LOG_SAMPLE_RATES=auth_app.consumers=0.01,auth_app.views=0.1; warnings and
+# errors are always kept (see auth_app/structured_logging.py)
+LOG_SAMPLE_RATES = {
+    name.strip(): float(rate)
+    for name, _, rate in (entry.partition('=') for entry in env('LOG_SAMPLE_RATES', default='').split(',') if entry.strip())
+}
+# Run database queries that only feed debug logs (keep off in production)
+LOG_DEBUG_QUERIES = env.bool('LOG_DEBUG_QUERIES', default=False)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {
+            '()': 'auth_app.structured_logging.StructuredFormatter',
+            'format': '%(asctime)s %(levelname)-8s %(name)s %(message)s',
+            'json_lines': LOG_FORMAT == 'json',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'structured',
+        },
+    },
+    'root': {
+        'handlers': ['console'],
+        'level': LOG_LEVEL,
+    },
+    'loggers': {
+        # Django's default config gives 'django' its own console handler; without
+        # propagate=False its records would also reach the root handler (twice)
+        'django': {
+            'handlers': ['console'],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
+    },
+}
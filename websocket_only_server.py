@@ -6,8 +6,7 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Handlers and levels come from settings.LOGGING, applied by django.setup()
 logger = logging.getLogger('websocket_only_server')
 
 # Set Django settings module
@@ -25,6 +24,7 @@ except Exception as e:
 # Import after Django setup
 from auth_app.middleware import JwtAuthMiddlewareStack
 from auth_app.routing import websocket_urlpatterns
+from auth_app.lifespan import lifespan_application
 
 # Create a WebSocket-only application
 websocket_application = ProtocolTypeRouter({
@@ -34,6 +34,9 @@ websocket_application = ProtocolTypeRouter({
             websocket_urlpatterns
         )
     ),
+
+    # Startup/shutdown events; drains the chat write-behind queue on shutdown
+    'lifespan': lifespan_application,
 })
 
 # Print available routes
@@ -43,7 +46,14 @@ for route in websocket_urlpatterns:
 
 if __name__ == "__main__":
     import uvicorn
+    from django.conf import settings
     
     # Run the server on port 8001 (different from Django's 8000)
     print("Starting WebSocket-only server on port 8001...")
-    uvicorn.run(websocket_application, host="0.0.0.0", port=8001)
+    uvicorn.run(
+        websocket_application,
+        host="0.0.0.0",
+        port=8001,
+        ws="websockets",
+        ws_per_message_deflate=settings.CHAT_PERMESSAGE_DEFLATE
+    )